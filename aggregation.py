@@ -0,0 +1,417 @@
+import os
+import tempfile
+import time
+import warnings
+from typing import Dict, List, NamedTuple, Optional, Union
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from snapshot_store import SnapshotStore
+
+# named period lengths, in seconds
+PERIODS = {"hour": 60 * 60, "day": 24 * 60 * 60, "week": 7 * 24 * 60 * 60}
+
+# columns without a "category" are summed under this one
+DEFAULT_CATEGORY = "Uncategorized"
+
+
+class BalanceHistory(NamedTuple):
+    """
+    Every stored balance, as parallel arrays - one element per snapshot,
+    ordered by currency, then column, then time - so each column's history
+    is a contiguous, sorted run that can be searched without a Python loop
+    over its rows
+    """
+
+    # every column and currency seen, indexed by column_index and currency_index
+    column_names: np.ndarray
+    currencies: np.ndarray
+
+    column_index: np.ndarray
+    currency_index: np.ndarray
+    timestamps: np.ndarray
+    balances: np.ndarray
+
+
+class ColumnarHistory:
+    """
+    A columnar copy of a SnapshotStore's history, kept in a NumPy .npz file.
+
+    Loading a few arrays takes milliseconds however long the history is,
+    where reading it row by row from SQLite takes seconds once it's
+    hundreds of thousands of rows long - so each sync only reads the rows
+    appended since the last one (the store is append-only), and rewrites the file.
+    """
+
+    # bump whenever the file's arrays change
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+
+    def load(self) -> Optional[Dict[str, np.ndarray]]:
+        try:
+            with np.load(self.path, allow_pickle=False) as arrays:
+                if int(arrays["version"]) != self.VERSION:
+                    return None
+                return dict(arrays)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def sync(self, store: SnapshotStore) -> BalanceHistory:
+        """
+        :param store: The store to copy
+        :type store: SnapshotStore
+        :return: The store's whole history
+        :rtype: BalanceHistory
+        """
+
+        arrays = self.load()
+        if arrays is None:
+            arrays = {
+                "version": np.array(self.VERSION),
+                "rowid": np.array(0),
+                "column_names": np.array(list(), dtype=str),
+                "currencies": np.array(list(), dtype=str),
+                "column_index": np.array(list(), dtype=np.int32),
+                "currency_index": np.array(list(), dtype=np.int16),
+                "timestamps": np.array(list(), dtype=np.float64),
+                "balances": np.array(list(), dtype=np.float64),
+            }
+
+        last_rowid, rows = store.rows_after(int(arrays["rowid"]))
+        if last_rowid < int(arrays["rowid"]):
+            # the store's been recreated, so start over
+            self.clear()
+            return self.sync(store)
+
+        if rows:
+            arrays = self.append(arrays, rows)
+            arrays["rowid"] = np.array(last_rowid)
+            self.save(arrays)
+
+        return BalanceHistory(*(arrays[field] for field in BalanceHistory._fields))
+
+    @staticmethod
+    def append(arrays: Dict[str, np.ndarray], rows: List) -> Dict[str, np.ndarray]:
+        """
+        :param arrays: The history so far
+        :type arrays: Dict[str, np.ndarray]
+        :param rows: New (column name, balance, timestamp, currency) snapshots
+        :type rows: List
+        :return: The history, with the new snapshots in order
+        :rtype: Dict[str, np.ndarray]
+        """
+
+        column_names, balances, timestamps, currencies = zip(*rows)
+
+        indexes = dict()
+        for field, values in [
+            ("column_names", column_names),
+            ("currencies", currencies),
+        ]:
+            # new names are appended, so existing indexes stay valid
+            known = list(arrays[field])
+            known += sorted(set(values) - set(known))
+            arrays[field] = np.array(known, dtype=str)
+            lookup = {name: index for index, name in enumerate(known)}
+            indexes[field] = [lookup[value] for value in values]
+
+        merged = {
+            "column_index": np.concatenate(
+                [arrays["column_index"], np.array(indexes["column_names"], np.int32)]
+            ),
+            "currency_index": np.concatenate(
+                [arrays["currency_index"], np.array(indexes["currencies"], np.int16)]
+            ),
+            "timestamps": np.concatenate(
+                [arrays["timestamps"], np.array(timestamps, np.float64)]
+            ),
+            "balances": np.concatenate(
+                [arrays["balances"], np.array(balances, np.float64)]
+            ),
+        }
+
+        # lexsort is stable, so a later snapshot with the same timestamp still wins
+        order = np.lexsort(
+            (merged["timestamps"], merged["column_index"], merged["currency_index"])
+        )
+        arrays.update({field: values[order] for field, values in merged.items()})
+        return arrays
+
+    def save(self, arrays: Dict[str, np.ndarray]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def clear(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class BalanceSummary(NamedTuple):
+    """
+    The balance sheet's totals at the end of each period, oldest first.
+    Periods before anything was stored are NaN
+    """
+
+    currency: str
+    period_ends: np.ndarray
+    totals: np.ndarray
+    # each category's subtotal, by category
+    subtotals: Dict[str, np.ndarray]
+    # each period's change in total, and as a fraction of the previous total
+    deltas: np.ndarray
+    relative_deltas: np.ndarray
+    # statistics of the total over the window of periods ending with each period
+    window: int
+    rolling: Dict[str, np.ndarray]
+
+    def to_dict(self) -> Dict:
+        """
+        :return: The summary, JSON-serializable - NaN values are None
+        :rtype: Dict
+        """
+
+        def to_list(values: np.ndarray) -> List[Optional[float]]:
+            return [None if np.isnan(value) else float(value) for value in values]
+
+        totals, deltas, relative_deltas = (
+            to_list(values)
+            for values in [self.totals, self.deltas, self.relative_deltas]
+        )
+        subtotals = {
+            category: to_list(values) for category, values in self.subtotals.items()
+        }
+        rolling = {stat: to_list(values) for stat, values in self.rolling.items()}
+
+        return {
+            "currency": self.currency,
+            "window": self.window,
+            "periods": [
+                {
+                    "period_end": float(period_end),
+                    "total": totals[index],
+                    "delta": deltas[index],
+                    "relative_delta": relative_deltas[index],
+                    "subtotals": {
+                        category: values[index]
+                        for category, values in subtotals.items()
+                    },
+                    "rolling": {
+                        stat: values[index] for stat, values in rolling.items()
+                    },
+                }
+                for index, period_end in enumerate(self.period_ends)
+            ],
+        }
+
+    def get_table(self) -> str:
+        """
+        :return: The summary as a table, one row per period
+        :rtype: str
+        """
+
+        stats = list(self.rolling)
+        header = (
+            f"{'period end (UTC)':<16} {'total':>14} {'change':>13} {'change %':>8} "
+            + " ".join(f"{f'{stat} ({self.window})':>14}" for stat in stats)
+            + "".join(f" {category[:14]:>14}" for category in self.subtotals)
+        )
+        lines = [f"Balances in {self.currency.upper()}", header, "-" * len(header)]
+        for index, period_end in enumerate(self.period_ends):
+            values = [
+                format_value(self.totals[index], 14, ",.2f"),
+                format_value(self.deltas[index], 13, "+,.2f"),
+                format_value(self.relative_deltas[index], 8, "+.2%"),
+                *(
+                    format_value(self.rolling[stat][index], 14, ",.2f")
+                    for stat in stats
+                ),
+                *(
+                    format_value(values[index], 14, ",.2f")
+                    for values in self.subtotals.values()
+                ),
+            ]
+            lines.append(
+                f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(period_end)):<16} "
+                + " ".join(values)
+            )
+
+        return "\n".join(lines)
+
+
+def format_value(value: float, width: int, spec: str) -> str:
+    # NaN, ie. nothing to report (or compare against), is a dash
+    return f"{'-' if np.isnan(value) else format(value, spec):>{width}}"
+
+
+def get_period_ends(period: float, periods: int, now: float) -> np.ndarray:
+    """
+    :param period: The length of each period, in seconds
+    :type period: float
+    :param periods: How many periods to summarize
+    :type periods: int
+    :param now: The end of the last period, which is usually cut short
+    :type now: float
+    :return: The end of each period, oldest first - every period but the last
+        ends on a multiple of its length since the epoch, eg. at midnight UTC
+    :rtype: np.ndarray
+    """
+
+    boundaries = (np.floor(now / period) - np.arange(periods - 1, 0, -1)) * period
+    return np.append(boundaries, now)
+
+
+def resample(
+    history: BalanceHistory,
+    column_names: List[str],
+    currency: str,
+    period_ends: np.ndarray,
+) -> np.ndarray:
+    """
+    :param history: The stored history
+    :type history: BalanceHistory
+    :param column_names: The columns to resample
+    :type column_names: List[str]
+    :param currency: The currency of the balances to resample
+    :type currency: str
+    :param period_ends: The times to resample at, in ascending order
+    :type period_ends: np.ndarray
+    :return: A (periods x columns) array of each column's latest balance
+        at or before the end of each period - NaN if it had none
+    :rtype: np.ndarray
+    """
+
+    matrix = np.full((len(period_ends), len(column_names)), np.nan)
+
+    currency_matches = np.flatnonzero(history.currencies == currency)
+    if not len(currency_matches):
+        return matrix
+
+    # the currency's snapshots, and each column's within them, are contiguous
+    start, end = np.searchsorted(
+        history.currency_index, [currency_matches[0], currency_matches[0] + 1]
+    )
+    column_index = history.column_index[start:end]
+    timestamps = history.timestamps[start:end]
+    balances = history.balances[start:end]
+
+    index_by_name = {name: index for index, name in enumerate(history.column_names)}
+    for position, column_name in enumerate(column_names):
+        if column_name not in index_by_name:
+            continue
+
+        start, end = np.searchsorted(
+            column_index, [index_by_name[column_name], index_by_name[column_name] + 1]
+        )
+        latest = np.searchsorted(timestamps[start:end], period_ends, side="right") - 1
+        matrix[:, position] = np.where(
+            latest >= 0, balances[start:end][np.maximum(latest, 0)], np.nan
+        )
+
+    return matrix
+
+
+def summarize(
+    history: BalanceHistory,
+    columns: List[Dict],
+    currency: str = "usd",
+    period: Union[str, float] = "day",
+    periods: int = 30,
+    window: int = 7,
+    now: Optional[float] = None,
+) -> BalanceSummary:
+    """
+    Totals the configured columns at the end of each period, carrying each
+    column's latest balance forward until its next snapshot, and subtotals
+    them by their "category"
+
+    :param history: The stored history
+    :type history: BalanceHistory
+    :param columns: The "columns" list from the configuration file
+    :type columns: List[Dict]
+    :param currency: The currency to summarize balances in
+    :type currency: str
+    :param period: The length of each period - "hour", "day", "week", or seconds
+    :type period: Union[str, float]
+    :param periods: How many periods to summarize, ending now
+    :type periods: int
+    :param window: How many periods the rolling statistics cover
+    :type window: int
+    :param now: The end of the last period - defaults to now
+    :type now: Optional[float]
+    :return: The summary
+    :rtype: BalanceSummary
+    """
+
+    period_ends = get_period_ends(
+        PERIODS[period] if isinstance(period, str) else period,
+        periods,
+        now if now is not None else time.time(),
+    )
+
+    column_names = [column["name"] for column in columns]
+    matrix = resample(history, column_names, currency, period_ends)
+    # periods no column had a balance in yet have no total
+    empty = np.isnan(matrix).all(axis=1)
+    known = np.nan_to_num(matrix)
+
+    totals = np.where(empty, np.nan, known.sum(axis=1))
+
+    categories = sorted(
+        {column.get("category", DEFAULT_CATEGORY) for column in columns}
+    )
+    membership = np.array(
+        [
+            [
+                column.get("category", DEFAULT_CATEGORY) == category
+                for category in categories
+            ]
+            for column in columns
+        ],
+        dtype=np.float64,
+    ).reshape(len(columns), len(categories))
+    subtotals = np.where(empty[:, np.newaxis], np.nan, known @ membership)
+
+    deltas = np.diff(totals, prepend=np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative_deltas = deltas / np.abs(np.roll(totals, 1))
+    relative_deltas[0] = np.nan
+
+    # each period's window of totals, padded so the first periods have
+    # (partial) windows too - NaN periods are left out of the statistics
+    windows = sliding_window_view(
+        np.concatenate([np.full(window - 1, np.nan), totals]), window
+    )
+    with warnings.catch_warnings():
+        # windows of only NaN periods are NaN, and warned about
+        warnings.simplefilter("ignore", RuntimeWarning)
+        rolling = {
+            "mean": np.nanmean(windows, axis=1),
+            "min": np.nanmin(windows, axis=1),
+            "max": np.nanmax(windows, axis=1),
+            "std": np.nanstd(windows, axis=1),
+        }
+
+    return BalanceSummary(
+        currency,
+        period_ends,
+        totals,
+        {category: subtotals[:, index] for index, category in enumerate(categories)},
+        deltas,
+        relative_deltas,
+        window,
+        rolling,
+    )
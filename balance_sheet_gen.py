@@ -1,12 +1,92 @@
 #!/usr/bin/env python3
 
 import argparse
+import datetime
 import json
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import sys
+import time
+from typing import List, Optional
 
-from institutions import *
-from institutions.institution import Institution as Institution
+from communicators import *
+from communicators.communicator import Communicator
+from config_loader import (
+    ConfigError,
+    default_config_cache_dir,
+    load_config,
+    resolve_type_name,
+)
+from daemon import BalanceDaemon
+from engine import FetchEngine
+from institutions.address_state import get_address_state_cache
+from institutions.institution import get_institution_class
+from institutions.instrumentation import Instrumentation, write_atomically
+from institutions.price_oracle import get_price_oracle
+from institutions.session_cache import get_session_cache
+from institutions.transport import deadline, get_transport
+from institutions.valuation import get_valuator
+from isolation import IsolationPool
+from records import BalanceRecord
+from snapshot_store import SnapshotStore
+
+
+def parse_as_of(value: str) -> float:
+    """
+    :param value: An ISO 8601 date or datetime, eg. "2024-06-30" -
+        dates are as of the end of the day, in UTC
+    :type value: str
+    :return: The time, in seconds since the epoch - capped at now
+    :rtype: float
+    """
+
+    try:
+        as_of = datetime.datetime.combine(
+            datetime.date.fromisoformat(value),
+            datetime.time.max,
+            tzinfo=datetime.timezone.utc,
+        )
+    except ValueError:
+        as_of = datetime.datetime.fromisoformat(value)
+        if as_of.tzinfo is None:
+            as_of = as_of.replace(tzinfo=datetime.timezone.utc)
+
+    return min(as_of.timestamp(), time.time())
+
+
+def get_backfill_times(
+    as_of: Optional[str], date_range: Optional[str], step_days: int
+) -> Optional[List[float]]:
+    """
+    :param as_of: A single date to backfill, if any
+    :type as_of: Optional[str]
+    :param date_range: A "start:end" range of dates to backfill, inclusive, if any
+    :type date_range: Optional[str]
+    :param step_days: The number of days between each date in the range
+    :type step_days: int
+    :return: The times to backfill, or None for a normal run
+    :rtype: Optional[List[float]]
+    :raises ValueError: If a date is invalid, or step_days is less than 1
+    """
+
+    if step_days < 1:
+        raise ValueError("The step between dates must be at least 1 day")
+
+    times = set()
+    if as_of:
+        times.add(parse_as_of(as_of))
+
+    if date_range:
+        start, _, end = date_range.partition(":")
+        day = datetime.date.fromisoformat(start)
+        end_day = datetime.date.fromisoformat(end)
+        if end_day < day:
+            raise ValueError(f"The range {date_range} ends before it starts")
+
+        while day <= end_day:
+            times.add(parse_as_of(day.isoformat()))
+            day += datetime.timedelta(days=step_days)
+
+    return sorted(times) if times else None
 
 
 def main():
@@ -17,50 +97,517 @@ def main():
         default="config.json",
         help="The path to a configuration file for this program",
     )
+    parser.add_argument(
+        "--config-cache",
+        action="store_true",
+        help="Reuse the compiled config file from a previous run, if it's unchanged - "
+        "the cached copy holds every credential in the file",
+    )
+    parser.add_argument(
+        "--no-session-cache",
+        action="store_true",
+        help="Always log in, rather than reusing sessions from previous runs",
+    )
+    parser.add_argument(
+        "--no-address-cache",
+        action="store_true",
+        help="Always fetch every wallet address' balance, "
+        "rather than skipping addresses that can't have changed since the last run",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="The maximum number of columns to initialize and fetch at once - "
+        f"overrides the config file's value, defaults to {FetchEngine.DEFAULT_CONCURRENCY}",
+    )
+    parser.add_argument(
+        "--isolate",
+        type=str,
+        default=None,
+        help="A comma-separated list of institution types to fetch in worker processes, "
+        'eg. ofx,coinbasepro - overrides the config file\'s "isolation.types" value',
+    )
+    parser.add_argument(
+        "--snapshot-store",
+        type=str,
+        default=None,
+        help="The path to a SQLite file in which every fetched balance is recorded - "
+        'overrides the config file\'s "snapshot_store" value',
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=None,
+        help="Serve columns from the snapshot store, rather than re-fetching them, "
+        'if their latest snapshot is younger than their "max_age" config value, '
+        "or this many seconds for columns without one",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="The number of seconds the whole run may take - columns that aren't "
+        "fetched in time are reported as stale - "
+        'overrides the config file\'s "deadline" value',
+    )
+    parser.add_argument(
+        "--column-timeout",
+        type=float,
+        default=None,
+        help="The number of seconds each column may take, "
+        'for columns without their own "timeout" - '
+        'overrides the config file\'s "column_timeout" value',
+    )
+    parser.add_argument(
+        "--stale-fallback",
+        action="store_true",
+        help="Report the latest balance from the snapshot store (marked as stale) "
+        "for columns that time out",
+    )
+    parser.add_argument(
+        "--currencies",
+        type=str,
+        default=None,
+        help="A comma-separated list of currencies to report every balance in, "
+        "eg. usd,eur - the first is the primary currency - "
+        'overrides the config file\'s "reporting_currencies" value, defaults to usd',
+    )
+    parser.add_argument(
+        "--as-of",
+        type=str,
+        default=None,
+        help="Backfill every column's balance as of a past date (or datetime), "
+        "eg. 2024-06-30, rather than fetching current balances",
+    )
+    parser.add_argument(
+        "--range",
+        type=str,
+        default=None,
+        help="Backfill every column's balance for each date in a range, "
+        "eg. 2024-01-01:2024-12-31, inclusive",
+    )
+    parser.add_argument(
+        "--range-step",
+        type=int,
+        default=1,
+        help="The number of days between each date backfilled by --range - defaults to 1",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Run continuously, refreshing each column on its own interval "
+        "and serving the latest balances over HTTP",
+    )
+    parser.add_argument(
+        "--listen",
+        type=str,
+        default=None,
+        help="In daemon mode, the host:port to serve balances on - "
+        f"defaults to {BalanceDaemon.DEFAULT_LISTEN}",
+    )
+    parser.add_argument(
+        "--refresh-interval",
+        type=float,
+        default=None,
+        help="In daemon mode, how often (in seconds) to refresh columns "
+        'without their own "refresh_interval" - '
+        f"defaults to {BalanceDaemon.DEFAULT_REFRESH_INTERVAL}",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of how long each column's initialization and fetch took, "
+        "and the HTTP requests, retries and backoff it caused",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print how many HTTP requests were sent, and how many were served "
+        "by an identical in-flight or recent request instead",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="The path to write each column's timings and request counts to, "
+        "in the Prometheus text format - "
+        'overrides the config file\'s "instrumentation.metrics_file" value',
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default=None,
+        help="The path to write a trace of the run to, as OpenTelemetry (OTLP) JSON - "
+        'overrides the config file\'s "instrumentation.trace_file" value',
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Print the balance sheet's totals, category subtotals, changes "
+        "and rolling statistics over the snapshot store's history, after the run",
+    )
+    parser.add_argument(
+        "--summary-file",
+        type=str,
+        default=None,
+        help="The path to write the summary to, as JSON - "
+        'overrides the config file\'s "aggregation.summary_file" value',
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        default="WARNING",
+        help="The logging level, eg. INFO or DEBUG - defaults to WARNING",
+    )
     args = parser.parse_args()
+    started = time.monotonic()
 
     logger = logging.getLogger("balance_sheet_gen")
-    logging.basicConfig()
+    logging.basicConfig(level=args.log_level.upper())
 
-    column_balances = dict()
+    # every column is validated before anything is fetched
+    try:
+        config = load_config(
+            args.config,
+            cache_dir=default_config_cache_dir() if args.config_cache else None,
+        )
+    except ConfigError as ce:
+        parser.exit(1, f"{ce}\n")
 
-    with open(args.config, "r") as f:
-        config = json.load(f)
+    columns = config.get("columns", list())
 
-    # init each column's class and retrieve the accounts' balance
-    futures = dict()
+    valuator = get_valuator()
+    valuator.configure(
+        args.currencies.split(",")
+        if args.currencies
+        else config.get("reporting_currencies", ["usd"])
+    )
+    currencies = valuator.currencies
+
+    snapshot_store = None
+    snapshot_store_path = args.snapshot_store or config.get("snapshot_store")
+    if snapshot_store_path:
+        snapshot_store = SnapshotStore(snapshot_store_path)
+    elif args.max_age is not None:
+        parser.error("--max-age requires a snapshot store")
+    elif args.stale_fallback or config.get("stale_fallback"):
+        parser.error("--stale-fallback requires a snapshot store")
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        for column in config.get("columns", list()):
+    if args.range_step < 1:
+        parser.error("--range-step must be at least 1")
+    try:
+        backfill_times = get_backfill_times(args.as_of, args.range, args.range_step)
+    except ValueError as ve:
+        parser.error(f"Invalid --as-of or --range - {ve}")
+    if backfill_times is not None and args.daemon:
+        parser.error("--as-of and --range can't be used in daemon mode")
+
+    # 0 is a deadline (albeit an unusable one), not a missing value
+    run_deadline = (
+        args.deadline if args.deadline is not None else config.get("deadline")
+    )
+    if run_deadline is not None and run_deadline <= 0:
+        parser.error("The deadline must be greater than 0 seconds")
+    column_timeout = (
+        args.column_timeout
+        if args.column_timeout is not None
+        else config.get("column_timeout")
+    )
+    if column_timeout is not None and column_timeout <= 0:
+        parser.error("The column timeout must be greater than 0 seconds")
+
+    def time_remaining():
+        if run_deadline is None or args.daemon:
+            return None
+        return run_deadline - (time.monotonic() - started)
+
+    # skip any column whose latest snapshot is still fresh
+    # (the daemon does this itself, per column)
+    fresh_snapshots = dict()
+    if (
+        snapshot_store is not None
+        and args.max_age is not None
+        and not args.daemon
+        and backfill_times is None
+    ):
+        fresh_snapshots = snapshot_store.get_fresh(columns, args.max_age, currencies[0])
+
+    columns_to_fetch = [
+        column for column in columns if column.get("name") not in fresh_snapshots
+    ]
+
+    # record where the run's time goes, if anyone's going to look
+    instrumentation = None
+    instrumentation_config = config.get("instrumentation", dict())
+    metrics_file = args.metrics_file or instrumentation_config.get("metrics_file")
+    trace_file = args.trace_file or instrumentation_config.get("trace_file")
+    if args.daemon and (args.profile or metrics_file or trace_file):
+        logger.warning("Instrumentation is only supported for single runs")
+    elif args.profile or metrics_file or trace_file:
+        instrumentation = Instrumentation()
+
+    # summarize the stored history, once this run's balances are in it
+    aggregation_config = config.get("aggregation", dict())
+    summary_file = args.summary_file or aggregation_config.get("summary_file")
+    summarizing = args.summary or bool(summary_file)
+    if summarizing and snapshot_store is None:
+        parser.error("--summary and --summary-file require a snapshot store")
+    if summarizing and args.daemon:
+        logger.warning("Summaries are only supported for single runs")
+        summarizing = False
+    summary_period = aggregation_config.get("period", "day")
+    if summarizing:
+        # numpy is only loaded for summaries
+        from aggregation import PERIODS, ColumnarHistory, summarize
+
+        if summary_period not in PERIODS and not (
+            isinstance(summary_period, (int, float)) and summary_period > 0
+        ):
+            parser.error(
+                f'Invalid aggregation period "{summary_period}" - '
+                f"expected one of {sorted(PERIODS)}, or a number of seconds"
+            )
+        for key in ["periods", "window"]:
+            if aggregation_config.get(key, 1) < 1:
+                parser.error(f'"aggregation.{key}" must be at least 1')
+
+    transport = get_transport()
+    transport.configure(**config.get("transport", dict()))
+
+    # login-based institutions reuse their sessions from previous runs
+    session_cache_config = dict(config.get("session_cache", dict()))
+    if args.no_session_cache:
+        session_cache_config["enabled"] = False
+    get_session_cache().configure(**session_cache_config)
+
+    # wallets skip addresses that can't have changed since they were last seen
+    address_state_config = dict(config.get("address_state", dict()))
+    if args.no_address_cache:
+        address_state_config["enabled"] = False
+    get_address_state_cache().configure(**address_state_config)
+
+    # fetch misbehaving (or GIL-heavy) institution types in worker processes
+    isolation = None
+    isolation_config = config.get("isolation", dict())
+    isolated_types = (
+        args.isolate.split(",") if args.isolate else isolation_config.get("types")
+    )
+    if isolated_types and args.daemon:
+        logger.warning("Isolation is only supported for single runs")
+    elif isolated_types:
+        isolated_types = [resolve_type_name(type_name) for type_name in isolated_types]
+        for type_name in isolated_types:
             try:
-                column_institution = Institution(
-                    type_name=column["type"],
-                    name=column["name"],
-                    config=column,
-                    logger=logger.getChild(column["name"]),
+                get_institution_class(type_name)
+            except (AttributeError, ImportError):
+                parser.error(f'Unknown institution type to isolate "{type_name}"')
+
+        try:
+            isolation = IsolationPool(
+                isolated_types,
+                workers=isolation_config.get("workers", IsolationPool.DEFAULT_WORKERS),
+                max_tasks_per_worker=isolation_config.get("max_tasks_per_worker"),
+                memory_limit_mb=isolation_config.get("memory_limit_mb"),
+                worker_config={
+                    "transport": config.get("transport", dict()),
+                    "session_cache": session_cache_config,
+                    "address_state": address_state_config,
+                },
+                log_level=args.log_level.upper(),
+            )
+        except ValueError as ve:
+            parser.error(f"Invalid isolation configuration - {ve}")
+
+    # resolve every column's prices, in every reporting currency, up front
+    price_oracle = get_price_oracle()
+    price_oracle.configure(**config.get("price_oracle", dict()))
+    coin_ids = set()
+    for column in columns_to_fetch:
+        try:
+            institution_class = get_institution_class(column["type"])
+        except (AttributeError, KeyError):
+            # reported when the column is initialized below
+            continue
+
+        coin_ids.update(institution_class.get_coin_ids(column))
+
+    for coin_id, currency in valuator.get_required_prices(coin_ids):
+        if backfill_times is not None:
+            # a backfill only needs each coin's price history, in one request
+            price_oracle.register_history(
+                [coin_id], backfill_times[0], backfill_times[-1], currency
+            )
+        else:
+            price_oracle.register([coin_id], currency)
+
+    try:
+        with deadline(time_remaining()):
+            if instrumentation is not None:
+                with instrumentation.column(
+                    ["price_oracle"], "PriceOracle"
+                ), instrumentation.phase("prefetch"):
+                    price_oracle.prefetch()
+            else:
+                price_oracle.prefetch()
+    except BaseException as be:
+        logger.error(f"Exception prefetching prices - {type(be).__name__}: {str(be)}")
+
+    # every balance is sent to each communicator as soon as it's available
+    communicators = list()
+    for communicator_config in config.get(
+        "communicators", [{"type": "StdoutCommunicator"}]
+    ):
+        try:
+            communicators.append(
+                Communicator(
+                    type_name=communicator_config["type"],
+                    config=communicator_config,
+                    logger=logger.getChild(communicator_config["type"]),
                 )
+            )
+        except BaseException as be:
+            logger.error(
+                f"Exception initializing {communicator_config.get('type')} - {type(be).__name__}: {str(be)}"
+            )
 
+    # a backfill's many balances are stored in one transaction, at the end
+    backfilled = list()
+
+    def emit(record: BalanceRecord, fetched: bool = True) -> None:
+        if record.backfilled:
+            backfilled.append(record)
+        elif fetched and not record.stale and snapshot_store is not None:
+            snapshot_store.record_many([record])
+
+        for communicator in communicators:
+            try:
+                communicator.write(record)
             except BaseException as be:
                 logger.error(
-                    f"Exception initializing {column['type']} - {type(be).__name__}: {str(be)}"
+                    f"Exception writing to {type(communicator).__name__} - {type(be).__name__}: {str(be)}"
                 )
-                continue
 
-            futures[executor.submit(column_institution.get_balance)] = column["name"]
+    # fresh columns are reported in every currency they were last fetched in
+    if fresh_snapshots:
+        for snapshot in snapshot_store.latest_in(fresh_snapshots, currencies).values():
+            emit(snapshot, fetched=False)
 
-    for future, column_name in futures.items():
+    # init each column's class and retrieve the accounts' balance
+    engine = FetchEngine(
+        concurrency=args.concurrency
+        or config.get("concurrency", FetchEngine.DEFAULT_CONCURRENCY),
+        logger=logger,
+        transport=transport,
+        instrumentation=instrumentation,
+        # the deadline covers the whole run, including the price prefetch
+        deadline=time_remaining(),
+        column_timeout=column_timeout,
+        last_known=(
+            snapshot_store.latest_in(
+                (column.get("name") for column in columns_to_fetch), currencies
+            )
+            if (args.stale_fallback or config.get("stale_fallback"))
+            and backfill_times is None
+            else None
+        ),
+        as_of=backfill_times,
+        isolation=isolation,
+    )
+
+    if args.daemon:
+        daemon_config = config.get("daemon", dict())
+        daemon = BalanceDaemon(
+            engine,
+            columns,
+            refresh_interval=args.refresh_interval
+            or daemon_config.get(
+                "refresh_interval", BalanceDaemon.DEFAULT_REFRESH_INTERVAL
+            ),
+            listen=args.listen
+            or daemon_config.get("listen", BalanceDaemon.DEFAULT_LISTEN),
+            on_result=emit,
+            initial_balances=(
+                snapshot_store.latest_in(
+                    (column.get("name") for column in columns), currencies
+                )
+                if snapshot_store is not None
+                else None
+            ),
+        )
+        daemon.run()
+    else:
+        engine.run(columns_to_fetch, on_result=emit)
+
+    if isolation is not None:
+        isolation.shutdown()
+
+    for communicator in communicators:
         try:
-            column_balances[column_name] = future.result()
+            communicator.close()
         except BaseException as be:
             logger.error(
-                f"Exception getting balance for {column_name} - {type(be).__name__}: {str(be)}"
+                f"Exception closing {type(communicator).__name__} - {type(be).__name__}: {str(be)}"
             )
 
-    # TODO instead of simply printing it,
-    # a class of "communicators" should be used to allow output to files,
-    # networked services, or a combination therein.
-    for column_name, balance in column_balances.items():
-        print(f"{column_name}: {balance}")
+    if snapshot_store is not None:
+        if backfilled:
+            snapshot_store.record_many(backfilled)
+
+        if summarizing:
+            try:
+                history = ColumnarHistory(
+                    aggregation_config.get(
+                        "history_file", f"{snapshot_store.path}.columns.npz"
+                    )
+                ).sync(snapshot_store)
+                summary = summarize(
+                    history,
+                    columns,
+                    currencies[0],
+                    period=summary_period,
+                    periods=aggregation_config.get("periods", 30),
+                    window=aggregation_config.get("window", 7),
+                )
+                if args.summary:
+                    print(summary.get_table())
+                if summary_file:
+                    write_atomically(summary_file, json.dumps(summary.to_dict()))
+            except BaseException as be:
+                logger.error(
+                    f"Exception summarizing balances - {type(be).__name__}: {str(be)}"
+                )
+
+        snapshot_store.close()
+
+    if instrumentation is not None:
+        instrumentation.finish()
+
+        for path, write in [
+            (metrics_file, instrumentation.write_prometheus_file),
+            (trace_file, instrumentation.write_trace_file),
+        ]:
+            if not path:
+                continue
+
+            try:
+                write(path)
+            except BaseException as be:
+                logger.error(
+                    f"Exception writing {path} - {type(be).__name__}: {str(be)}"
+                )
+
+        if args.profile:
+            print(instrumentation.get_profile_table(), file=sys.stderr)
+
+    if args.stats:
+        request_stats = transport.get_stats()
+        print(
+            f"HTTP GET requests - {request_stats['sent']} sent, "
+            f"{request_stats['coalesced']} coalesced with an identical in-flight request, "
+            f"{request_stats['memoized']} served from the dedupe window",
+            file=sys.stderr,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+DEFAULT_FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures"
+)
+
+
+class Route:
+    """
+    A single recorded response, served for every request
+    with a matching method and path.
+    Paths ending in "/" match any path beneath them, eg. "/v1/accounts/",
+    and routes with a "request_contains" value only match requests
+    whose body contains it (eg. OFX's profile and statement requests,
+    which share a URL).
+    Any "{base_url}" in a response is replaced with the server's own URL.
+    """
+
+    def __init__(self, config: Dict, fixture_dir: str):
+        self.method = config.get("method", "GET").upper()
+        self.path = config["path"]
+        self.status = config.get("status", 200)
+        self.content_type = config.get("content_type", "application/json")
+        self.request_contains = config.get("request_contains", "").encode()
+
+        if "body_file" in config:
+            with open(os.path.join(fixture_dir, config["body_file"]), "rb") as f:
+                self.body = f.read()
+        else:
+            self.body = json.dumps(config.get("body")).encode()
+
+    def matches(self, method: str, path: str, body: bytes) -> bool:
+        if method != self.method or self.request_contains not in body:
+            return False
+
+        if self.path.endswith("/"):
+            return path.startswith(self.path)
+
+        return path == self.path
+
+
+class TokenBucket:
+    """
+    A per-host stand-in for a provider's rate limit -
+    requests that find the bucket empty are refused with a 429
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    A local stand-in for every institution's API.
+
+    Each fixture file describes one host's recorded responses.
+    Requests are routed on their first path segment, which names the host,
+    so that eg. "https://blockchain.info/multiaddr" is served from
+    "http://127.0.0.1:<port>/blockchain.info/multiaddr" -
+    see get_url_overrides for the matching transport configuration.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        fixture_dir: str = DEFAULT_FIXTURE_DIR,
+        latency: float = 0,
+        jitter: float = 0,
+        error_rate: float = 0,
+        error_status: int = 503,
+        rate_limit: Optional[float] = None,
+        rate_limit_burst: int = 10,
+        seed: Optional[int] = None,
+    ):
+        """
+        :param address: The (host, port) to listen on - port 0 picks a free port
+        :type address: Tuple[str, int]
+        :param fixture_dir: The directory of fixture files to serve
+        :type fixture_dir: str
+        :param latency: The mean added latency of each response, in seconds
+        :type latency: float
+        :param jitter: Each response's latency varies uniformly by up to this much
+        :type jitter: float
+        :param error_rate: The fraction of requests answered with error_status
+        :type error_rate: float
+        :param error_status: The HTTP status of injected errors
+        :type error_status: int
+        :param rate_limit: If provided, each host's requests per second -
+            requests beyond it are answered with a 429 and a Retry-After header
+        :type rate_limit: Optional[float]
+        :param rate_limit_burst: The number of requests a host allows at once
+        :type rate_limit_burst: int
+        :param seed: A seed for the latency and error injection
+        :type seed: Optional[int]
+        """
+
+        super().__init__(address, ReplayHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_limit = rate_limit
+        self.rate_limit_burst = rate_limit_burst
+        self.random = random.Random(seed)
+
+        self.routes: Dict[str, List[Route]] = dict()
+        for file_name in sorted(os.listdir(fixture_dir)):
+            if not file_name.endswith(".json"):
+                continue
+
+            with open(os.path.join(fixture_dir, file_name), "r") as f:
+                fixture = json.load(f)
+
+            self.routes.setdefault(fixture["host"], list()).extend(
+                Route(route, fixture_dir) for route in fixture["routes"]
+            )
+
+        self.buckets: Dict[str, TokenBucket] = dict()
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def get_url_overrides(self) -> Dict[str, str]:
+        """
+        :return: A transport "url_overrides" mapping,
+            sending every fixture host's requests to this server
+        :rtype: Dict[str, str]
+        """
+
+        return {f"https://{host}": f"{self.base_url}/{host}" for host in self.routes}
+
+    def reset_stats(self) -> None:
+        with self.stats_lock:
+            self.stats = {"requests": dict(), "rate_limited": 0, "errors": 0}
+            self.buckets = dict()
+
+    def get_stats(self) -> Dict:
+        """
+        :return: The number of requests served per host,
+            and the number of rate limit and injected error responses,
+            since the last reset
+        :rtype: Dict
+        """
+
+        with self.stats_lock:
+            return {
+                "requests": dict(self.stats["requests"]),
+                "rate_limited": self.stats["rate_limited"],
+                "errors": self.stats["errors"],
+            }
+
+    def count(self, host: str, outcome: Optional[str] = None) -> None:
+        with self.stats_lock:
+            self.stats["requests"][host] = self.stats["requests"].get(host, 0) + 1
+            if outcome is not None:
+                self.stats[outcome] += 1
+
+    def get_bucket(self, host: str) -> Optional[TokenBucket]:
+        if self.rate_limit is None:
+            return None
+
+        with self.stats_lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate_limit, self.rate_limit_burst)
+            return self.buckets[host]
+
+    def get_delay(self) -> float:
+        return max(0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def handle_error(self, request, client_address):
+        # clients giving up on a slow response isn't worth a traceback
+        logging.getLogger("replay_server").debug(
+            f"Exception handling request from {client_address}", exc_info=True
+        )
+
+    def find_route(
+        self, host: str, method: str, path: str, body: bytes
+    ) -> Optional[Route]:
+        for route in self.routes.get(host, list()):
+            if route.matches(method, path, body):
+                return route
+
+        return None
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.replay("GET")
+
+    def do_POST(self):
+        self.replay("POST")
+
+    def replay(self, method: str) -> None:
+        # always read the request body, so the connection can be reused
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        host, _, path = urlsplit(self.path).path.lstrip("/").partition("/")
+        path = f"/{path}"
+        server: ReplayServer = self.server
+
+        time.sleep(server.get_delay())
+
+        bucket = server.get_bucket(host)
+        if bucket is not None and not bucket.try_acquire():
+            server.count(host, "rate_limited")
+            self.respond(429, b"{}", headers={"Retry-After": "1"})
+            return
+
+        if server.error_rate and server.random.random() < server.error_rate:
+            server.count(host, "errors")
+            self.respond(server.error_status, b"{}")
+            return
+
+        route = server.find_route(host, method, path, body)
+        server.count(host)
+        if route is None:
+            self.respond(404, b"{}")
+            return
+
+        self.respond(
+            route.status,
+            route.body.replace(b"{base_url}", server.base_url.encode()),
+            route.content_type,
+        )
+
+    def respond(
+        self,
+        status: int,
+        body: bytes,
+        content_type: str = "application/json",
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or dict()).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger("replay_server").debug(format % args)
+
+
+def add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds the replay server's options to an argument parser
+
+    :rtype: None
+    """
+
+    parser.add_argument(
+        "--fixture-dir",
+        type=str,
+        default=DEFAULT_FIXTURE_DIR,
+        help="The directory of recorded responses to serve",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="The mean added latency of each response, in seconds",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.02,
+        help="Each response's latency varies uniformly by up to this many seconds",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="The fraction of requests answered with --error-status",
+    )
+    parser.add_argument(
+        "--error-status",
+        type=int,
+        default=503,
+        help="The HTTP status of injected errors - defaults to 503",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=None,
+        help="Each host's requests per second - "
+        "requests beyond it are answered with a 429",
+    )
+    parser.add_argument(
+        "--rate-limit-burst",
+        type=int,
+        default=10,
+        help="The number of requests a host allows at once - defaults to 10",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="A seed for the latency and error injection",
+    )
+
+
+def create_server(
+    args: argparse.Namespace, address: Tuple[str, int] = ("127.0.0.1", 0)
+) -> ReplayServer:
+    return ReplayServer(
+        address,
+        fixture_dir=args.fixture_dir,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        rate_limit=args.rate_limit,
+        rate_limit_burst=args.rate_limit_burst,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve recorded institution responses for benchmarking"
+    )
+    parser.add_argument(
+        "--listen",
+        type=str,
+        default="127.0.0.1:8788",
+        help="The host:port to listen on - defaults to 127.0.0.1:8788",
+    )
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    host, _, port = args.listen.rpartition(":")
+    server = create_server(args, (host, int(port)))
+
+    print(
+        '"transport": {"url_overrides": ' + json.dumps(server.get_url_overrides()) + "}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.get_stats(), indent=4))
+
+
+if __name__ == "__main__":
+    main()
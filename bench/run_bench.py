@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from replay_server import ReplayServer, add_server_arguments, create_server
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_COLUMN_COUNTS = [1, 10, 100, 1000]
+
+# a 44-byte (base64) secret, as cbpro decodes it before signing
+FAKE_API_SECRET = "c2VjcmV0LXNlY3JldC1zZWNyZXQtc2VjcmV0LXNlYw=="
+
+
+def make_column(type_name: str, index: int, server: ReplayServer) -> Dict:
+    """
+    :param type_name: An institution type, eg. "BitcoinInstitution"
+    :type type_name: str
+    :param index: The column's index - used to give each column
+        its own credentials or addresses, so that no two columns
+        are grouped or share a request
+    :type index: int
+    :param server: The replay server the column's institution will talk to
+    :type server: ReplayServer
+    :return: A column configuration matching the replay server's fixtures
+    :rtype: Dict
+    """
+
+    column = {"name": f"{type_name}-{index}", "type": type_name}
+    addrs = [f"addr-{index}-{n}" for n in range(3)]
+
+    if type_name in ("CoinbaseInstitution", "CoinbaseProInstitution"):
+        column.update({"api_key": f"key-{index}", "api_secret": FAKE_API_SECRET})
+        if type_name == "CoinbaseProInstitution":
+            column["passphrase"] = "passphrase"
+    elif type_name == "AtmosInstitution":
+        column.update(
+            {
+                "email": f"user-{index}@example.com",
+                "password": "password",
+                "totp_secret": "",
+                "account_name": "Savings",
+            }
+        )
+    elif type_name == "DiscoverBankInstitution":
+        column.update({"api_key": f"token-{index}", "account_id": "1"})
+    elif type_name == "OfxInstitution":
+        column.update(
+            {
+                "username": f"user-{index}",
+                "password": "password",
+                "account_id": "12345",
+                "account_type": "investment",
+                "institution_info": {
+                    "org": "EXAMPLE",
+                    "broker_id": "example.com",
+                    "fid": "0000",
+                    # ofxtools doesn't use the transport, so point it here directly
+                    "url": f"{server.base_url}/ofx.example.com/ofx",
+                },
+            }
+        )
+    else:
+        column["wallet_addrs"] = addrs
+
+    return column
+
+
+def make_config(
+    column_count: int,
+    types: List[str],
+    server: ReplayServer,
+    records_path: str,
+    concurrency: Optional[int],
+    keep_rate_limits: bool,
+) -> Dict:
+    transport_config = {"url_overrides": server.get_url_overrides()}
+    if not keep_rate_limits:
+        # measure the pipeline, not the politeness delays in front of real APIs
+        transport_config["rate_limits"] = {
+            host.split("://", 1)[1]: {} for host in server.get_url_overrides()
+        }
+
+    config = {
+        "columns": [
+            make_column(types[index % len(types)], index, server)
+            for index in range(column_count)
+        ],
+        "transport": transport_config,
+        "communicators": [{"type": "JsonlCommunicator", "path": records_path}],
+    }
+    if concurrency is not None:
+        config["concurrency"] = concurrency
+
+    return config
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_once(
+    column_count: int,
+    types: List[str],
+    server: ReplayServer,
+    concurrency: Optional[int],
+    keep_rate_limits: bool,
+) -> Dict:
+    """
+    Runs balance_sheet_gen.py, end to end, against the replay server
+
+    :return: The run's wall time, per-column latency percentiles
+        (from process start to each record's timestamp), and request counts
+    :rtype: Dict
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        records_path = os.path.join(tmp_dir, "records.jsonl")
+        config_path = os.path.join(tmp_dir, "config.json")
+        with open(config_path, "w") as f:
+            json.dump(
+                make_config(
+                    column_count,
+                    types,
+                    server,
+                    records_path,
+                    concurrency,
+                    keep_rate_limits,
+                ),
+                f,
+            )
+
+        server.reset_stats()
+        started_at = time.time()
+        proc = subprocess.run(
+            [
+                sys.executable,
+                os.path.join(REPO_ROOT, "balance_sheet_gen.py"),
+                "--config",
+                config_path,
+                "--log-level",
+                "ERROR",
+                "--no-address-cache",
+                "--no-session-cache",
+            ],
+            cwd=REPO_ROOT,
+            # every cache (price, token and product metadata...) starts empty,
+            # so runs are reproducible and never touch the user's own caches
+            env={**os.environ, "XDG_CACHE_HOME": os.path.join(tmp_dir, "cache")},
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        wall_time = time.time() - started_at
+
+        latencies = list()
+        if os.path.exists(records_path):
+            with open(records_path, "r") as f:
+                for line in f:
+                    latencies.append(json.loads(line)["timestamp"] - started_at)
+
+    server_stats = server.get_stats()
+    return {
+        "columns": column_count,
+        "exit_code": proc.returncode,
+        "wall_time": wall_time,
+        "succeeded": len(latencies),
+        "failed": column_count - len(latencies),
+        "p50": percentile(latencies, 0.5),
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "requests": sum(server_stats["requests"].values()),
+        "requests_per_host": server_stats["requests"],
+        "rate_limited": server_stats["rate_limited"],
+        "errors": server_stats["errors"],
+        "stderr": proc.stderr[-2000:],
+    }
+
+
+def print_results(results: List[Dict]) -> None:
+    header = f"{'columns':>8} {'wall (s)':>9} {'ok':>6} {'failed':>6} {'p50 (s)':>8} {'p90 (s)':>8} {'p99 (s)':>8} {'requests':>9} {'429s':>6} {'errors':>6}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['columns']:>8} {result['wall_time']:>9.2f} "
+            f"{result['succeeded']:>6} {result['failed']:>6} "
+            f"{result['p50']:>8.2f} {result['p90']:>8.2f} {result['p99']:>8.2f} "
+            f"{result['requests']:>9} {result['rate_limited']:>6} {result['errors']:>6}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark balance_sheet_gen.py against recorded responses"
+    )
+    parser.add_argument(
+        "--columns",
+        type=str,
+        default=",".join(str(count) for count in DEFAULT_COLUMN_COUNTS),
+        help="A comma-separated list of column counts to benchmark - "
+        f"defaults to {','.join(str(count) for count in DEFAULT_COLUMN_COUNTS)}",
+    )
+    parser.add_argument(
+        "--types",
+        type=str,
+        default=None,
+        help="A comma-separated list of institution types to cycle through - "
+        "defaults to every type with a fixture",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="Passed through as the config file's concurrency",
+    )
+    parser.add_argument(
+        "--keep-rate-limits",
+        action="store_true",
+        help="Keep the transport's default per-host rate limits, "
+        "rather than lifting them for the replay server",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="The path to write the full results to, as JSON, "
+        "eg. to compare against a previous version",
+    )
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    types = (
+        args.types.split(",")
+        if args.types
+        else [
+            "AtmosInstitution",
+            "BitcoinInstitution",
+            "ChiaInstitution",
+            "CoinbaseInstitution",
+            "CoinbaseProInstitution",
+            "DiscoverBankInstitution",
+            "EthereumInstitution",
+            "HeliumInstitution",
+            "OfxInstitution",
+        ]
+    )
+
+    server = create_server(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = list()
+    try:
+        for column_count in (int(count) for count in args.columns.split(",")):
+            result = run_once(
+                column_count, types, server, args.concurrency, args.keep_rate_limits
+            )
+            results.append(result)
+            if result["exit_code"] != 0:
+                print(result["stderr"], file=sys.stderr)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import logging
+from typing import Dict, List, Set
+
+from records import BalanceRecord
+
+
+class Communicator:
+    """
+    Generic base class to manage all other Communicators.
+    A Communicator is a sink that balances are sent to as soon as they're
+    fetched, eg. stdout, a file, or a networked service.
+
+    When a Communicator is created, it will become a specific type of Communicator,
+    based on the type_name parameter passed in with it.
+    If no Communicator exists with the provided classname,
+    an AttributeError is thrown.
+
+    Records are buffered, and handed to write_records() in bulk
+    once "buffer_size" of them have accumulated, and when closed.
+    """
+
+    DEFAULT_BUFFER_SIZE = 100
+
+    def __new__(cls, type_name: str, config: Dict, logger: logging.Logger):
+
+        if cls is not Communicator:
+            return super(Communicator, cls).__new__(cls)
+
+        # Return an uninitialized instance of the subclass -
+        # python then calls its __init__ exactly once
+        return super(Communicator, cls).__new__(get_communicator_class(type_name))
+
+    def __init__(self, type_name: str, config: Dict, logger: logging.Logger):
+        self.config = config
+        self.logger = logger
+
+        self.buffer_size = config.get("buffer_size", self.DEFAULT_BUFFER_SIZE)
+        self.buffer: List[BalanceRecord] = list()
+
+    def write(self, record: BalanceRecord) -> None:
+        """
+        Queues a balance to be sent to this sink
+
+        :param record: A column's balance
+        :type record: BalanceRecord
+        :rtype: None
+        """
+
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Sends all buffered balances to this sink
+
+        :rtype: None
+        """
+
+        if not self.buffer:
+            return
+
+        records, self.buffer = self.buffer, list()
+        self.write_records(records)
+
+    def close(self) -> None:
+        """
+        Flushes any buffered balances and releases this sink's resources
+
+        :rtype: None
+        """
+
+        self.flush()
+
+    def write_records(self, records: List[BalanceRecord]) -> None:
+        """
+        Given a batch of balances, send them to this sink
+
+        :param records: The balances to send, in the order they were fetched
+        :type records: List[BalanceRecord]
+        :rtype: None
+        """
+        raise NotImplementedError()
+
+
+def get_communicator_class(type_name: str) -> type:
+    """
+    Returns the Communicator subclass with the provided name
+
+    :param type_name: The class name of a Communicator, eg. "CsvCommunicator"
+    :type type_name: str
+    :return: The matching Communicator subclass
+    :rtype: type
+    """
+
+    for class_obj in all_subclasses(Communicator):
+        if class_obj.__name__ == type_name:
+            return class_obj
+
+    raise AttributeError("Invalid class name")
+
+
+def all_subclasses(cls) -> Set:
+    """
+    Returns a set of all subclasses of a class, recursively.
+
+    :return: All subclasses of the provided class
+    :rtype: Set
+    """
+
+    return set(cls.__subclasses__()).union(
+        [s for c in cls.__subclasses__() for s in all_subclasses(c)]
+    )
@@ -0,0 +1,117 @@
+import csv
+import datetime
+import logging
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+from records import BalanceRecord
+
+from .communicator import Communicator
+
+
+class CsvCommunicator(Communicator):
+    """
+    Appends one row per run to a CSV balance sheet,
+    with a "date" field followed by a field per column
+    (and per currency, for columns reported in more than USD - eg. "Savings (EUR)").
+
+    Since a row needs every column's balance,
+    balances are held until the communicator is closed.
+    Backfilled balances are written as one row per date, oldest first.
+    The existing sheet is never re-read past its header, unless this run
+    has columns the header lacks - then the sheet is rewritten once
+    with the new columns added.
+    """
+
+    DATE_FIELD = "date"
+
+    def __init__(self, type_name: str, config: Dict, logger: logging.Logger):
+        super(type(self), self).__init__(type_name, config, logger)
+
+        self.path = os.path.expanduser(config["path"])
+
+    def write(self, record: BalanceRecord) -> None:
+        # a row can only be written once every column is in
+        self.buffer.append(record)
+
+    def write_records(self, records: List[BalanceRecord]) -> None:
+        rows = list()
+
+        current = [record for record in records if not record.backfilled]
+        if current:
+            row = {record.label: record.balance for record in current}
+            row[self.DATE_FIELD] = datetime.datetime.fromtimestamp(
+                max(record.timestamp for record in current)
+            ).isoformat(timespec="seconds")
+            rows.append(row)
+
+        # backfilled balances share their as-of timestamp, so each one is a row
+        backfilled: Dict[float, Dict] = dict()
+        for record in records:
+            if record.backfilled:
+                backfilled.setdefault(record.timestamp, dict())[
+                    record.label
+                ] = record.balance
+        for timestamp, row in sorted(backfilled.items()):
+            row[self.DATE_FIELD] = (
+                datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+                .date()
+                .isoformat()
+            )
+        rows = [row for _, row in sorted(backfilled.items())] + rows
+
+        header = self._read_header()
+        if header is None:
+            header = [self.DATE_FIELD] + list(
+                dict.fromkeys(record.label for record in records)
+            )
+            with open(self.path, "w", newline="") as f:
+                csv.writer(f).writerow(header)
+
+        new_fields = list(
+            dict.fromkeys(field for row in rows for field in row if field not in header)
+        )
+        if new_fields:
+            header = header + new_fields
+            self._rewrite_with_header(header)
+
+        with open(self.path, "a", newline="") as f:
+            csv.DictWriter(f, fieldnames=header).writerows(rows)
+
+    def _read_header(self) -> Optional[List[str]]:
+        try:
+            with open(self.path, "r", newline="") as f:
+                return next(csv.reader(f), None)
+        except FileNotFoundError:
+            return None
+
+    def _rewrite_with_header(self, header: List[str]) -> None:
+        """
+        Rewrites the sheet with an extended header,
+        leaving the new fields empty in existing rows
+
+        :param header: The new header, which must start with the old one
+        :type header: List[str]
+        :rtype: None
+        """
+
+        self.logger.warning(
+            f"Adding {len(header) - len(self._read_header())} new column(s) "
+            f"to {self.path}, which requires rewriting it"
+        )
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp"
+        )
+        with os.fdopen(fd, "w", newline="") as out_f, open(
+            self.path, "r", newline=""
+        ) as in_f:
+            reader = csv.reader(in_f)
+            writer = csv.writer(out_f)
+            next(reader)
+            writer.writerow(header)
+            for existing_row in reader:
+                writer.writerow(existing_row + [""] * (len(header) - len(existing_row)))
+
+        os.replace(tmp_path, self.path)
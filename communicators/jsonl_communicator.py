@@ -0,0 +1,30 @@
+import json
+import logging
+import os
+from typing import Dict, List
+
+from records import BalanceRecord
+
+from .communicator import Communicator
+
+
+class JsonlCommunicator(Communicator):
+    """
+    Appends each balance to a file as a line of JSON
+    """
+
+    def __init__(self, type_name: str, config: Dict, logger: logging.Logger):
+        super(type(self), self).__init__(type_name, config, logger)
+
+        self.path = os.path.expanduser(config["path"])
+        self.file = open(self.path, "a")
+
+    def write_records(self, records: List[BalanceRecord]) -> None:
+        self.file.write(
+            "".join(json.dumps(record._asdict()) + "\n" for record in records)
+        )
+        self.file.flush()
+
+    def close(self) -> None:
+        super(JsonlCommunicator, self).close()
+        self.file.close()
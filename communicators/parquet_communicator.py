@@ -0,0 +1,44 @@
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List
+
+from records import BalanceRecord
+
+from .communicator import Communicator
+
+
+class ParquetCommunicator(Communicator):
+    """
+    Writes balances to a directory of Parquet files,
+    readable as a single dataset by pyarrow, pandas, duckdb, etc.
+
+    Parquet files can't be appended to,
+    so each flush writes a new part file rather than rewriting history.
+    Requires pyarrow.
+    """
+
+    def __init__(self, type_name: str, config: Dict, logger: logging.Logger):
+        super(type(self), self).__init__(type_name, config, logger)
+
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("ParquetCommunicator requires pyarrow to be installed")
+
+        self.pyarrow = pyarrow
+        self.path = os.path.expanduser(config["path"])
+        os.makedirs(self.path, exist_ok=True)
+
+    def write_records(self, records: List[BalanceRecord]) -> None:
+        table = self.pyarrow.table(
+            {
+                field: [getattr(record, field) for record in records]
+                for field in BalanceRecord._fields
+            }
+        )
+
+        part_name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        self.pyarrow.parquet.write_table(table, os.path.join(self.path, part_name))
@@ -0,0 +1,37 @@
+import datetime
+import logging
+from typing import Dict, List
+
+from records import BalanceRecord
+
+from .communicator import Communicator
+
+
+class StdoutCommunicator(Communicator):
+    """
+    Prints each balance as "column_name: balance" as soon as it's fetched
+    (with the currency after the column's name, for balances not in USD),
+    marking any stale balance served in place of a timed-out column,
+    and the date of any backfilled balance
+    """
+
+    DEFAULT_BUFFER_SIZE = 1
+
+    def __init__(self, type_name: str, config: Dict, logger: logging.Logger):
+        super(type(self), self).__init__(type_name, config, logger)
+
+    def write_records(self, records: List[BalanceRecord]) -> None:
+        print("\n".join(self.format(record) for record in records), flush=True)
+
+    @staticmethod
+    def format(record: BalanceRecord) -> str:
+        line = f"{record.label}: {record.balance}"
+        if record.stale:
+            line += " (stale)"
+        if record.backfilled:
+            as_of = datetime.datetime.fromtimestamp(
+                record.timestamp, tz=datetime.timezone.utc
+            )
+            line += f" (as of {as_of.date().isoformat()})"
+
+        return line
@@ -0,0 +1,27 @@
+import logging
+from typing import Dict, List
+
+from institutions.transport import get_transport
+from records import BalanceRecord
+
+from .communicator import Communicator
+
+
+class WebhookCommunicator(Communicator):
+    """
+    POSTs batches of balances to an HTTP endpoint as JSON,
+    in the form {"records": [{"column_name": ..., "balance": ..., "timestamp": ...}]}
+    """
+
+    def __init__(self, type_name: str, config: Dict, logger: logging.Logger):
+        super(type(self), self).__init__(type_name, config, logger)
+
+        self.url = config["url"]
+        self.session = get_transport().new_session()
+        self.session.headers.update(config.get("headers", dict()))
+
+    def write_records(self, records: List[BalanceRecord]) -> None:
+        res = self.session.post(
+            self.url, json={"records": [record._asdict() for record in records]}
+        )
+        res.raise_for_status()
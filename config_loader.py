@@ -0,0 +1,399 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from institutions.cache import JsonFileCache, default_cache_dir
+from institutions.institution import get_institution_class
+from institutions.registry import INSTITUTION_MODULES
+
+# Bump whenever compilation changes, so older cached plans are ignored
+COMPILER_VERSION = 2
+
+# Keys every column may have, whatever its type
+COMMON_REQUIRED_CONFIG: Dict[str, type] = {"name": str, "type": str}
+COMMON_OPTIONAL_CONFIG: Dict = {
+    "timeout": (int, float),
+    "max_age": (int, float),
+    "refresh_interval": (int, float),
+    "max_workers": int,
+    "category": str,
+}
+
+logger = logging.getLogger("balance_sheet_gen.config")
+
+
+class ConfigError(Exception):
+    """
+    Raised when a configuration file is invalid, listing every problem found
+    """
+
+    def __init__(self, path: str, errors: List[str]):
+        self.path = path
+        self.errors = errors
+        super().__init__(
+            f"Invalid configuration in {path}:\n"
+            + "\n".join(f"  - {error}" for error in errors)
+        )
+
+
+def load_config(path: str, cache_dir: Optional[str] = None) -> Dict:
+    """
+    Reads, compiles and validates a configuration file.
+
+    Compiling merges in every file listed under "include"
+    (relative to the including file), and expands each column's
+    "template" and "credentials" references into the column itself.
+    Every column is then checked against its institution's schema,
+    so a bad column fails the run before any network work is done.
+
+    If a cache directory is given, the compiled configuration is cached
+    along with a hash of every file it was compiled from, so unchanged
+    configurations skip compilation. Only includes, templates and credentials
+    are cached - columns are always validated against the current schemas.
+    Cached plans hold credentials, so they're only readable by their owner.
+
+    :param path: The path to the configuration file
+    :type path: str
+    :param cache_dir: The directory to cache compiled configurations in -
+        if None, nothing is cached
+    :type cache_dir: Optional[str]
+    :return: The compiled configuration
+    :rtype: Dict
+    :raises ConfigError: If the configuration is invalid
+    """
+
+    path = os.path.abspath(os.path.expanduser(path))
+    with open(path, "rb") as f:
+        source = f.read()
+
+    config = None
+    cache = None
+    if cache_dir is not None:
+        # one plan per configuration file, replaced whenever it's recompiled
+        key = hashlib.sha256(f"{COMPILER_VERSION}\0{path}".encode()).hexdigest()
+        cache = JsonFileCache(os.path.join(cache_dir, f"{key}.json"))
+
+        cached = cache.load()
+        sources = cached.get("sources", dict())
+        if sources.get(path) == hashlib.sha256(source).hexdigest() and all(
+            hash_file(source_path) == digest
+            for source_path, digest in sources.items()
+            if source_path != path
+        ):
+            logger.debug(f"Using the compiled configuration cached for {path}")
+            config = cached["config"]
+
+    if config is None:
+        sources: Dict[str, str] = dict()
+        config = read_config(path, source, sources, tuple())
+        expand_config(path, config)
+
+        if cache is not None:
+            try:
+                os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+                # mkstemp creates the file as 0600
+                cache.save({"sources": sources, "config": config})
+            except OSError as oe:
+                logger.warning(f"Unable to cache the compiled configuration - {oe}")
+
+    validate_config(path, config)
+    return config
+
+
+def default_config_cache_dir() -> str:
+    return os.path.join(default_cache_dir(), "configs")
+
+
+def hash_file(path: str) -> Optional[str]:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def read_config(
+    path: str, source: bytes, sources: Dict[str, str], including: Tuple[str, ...]
+) -> Dict:
+    """
+    Parses a configuration file and merges in its includes, recursively.
+    Included files are merged first, so the including file's values win -
+    except for "columns", which are concatenated,
+    and "templates" and "credentials", which are merged by name.
+
+    :param path: The file's absolute path
+    :type path: str
+    :param source: The file's contents
+    :type source: bytes
+    :param sources: Updated with the hash of every file read
+    :type sources: Dict[str, str]
+    :param including: The files that (transitively) include this one
+    :type including: Tuple[str, ...]
+    :return: The merged, uncompiled configuration
+    :rtype: Dict
+    """
+
+    sources[path] = hashlib.sha256(source).hexdigest()
+    try:
+        config = json.loads(source)
+    except ValueError as ve:
+        raise ConfigError(path, [f"Not valid JSON - {ve}"])
+    if not isinstance(config, dict):
+        raise ConfigError(path, ["Expected a JSON object at the top level"])
+
+    includes = config.pop("include", list())
+    if isinstance(includes, str):
+        includes = [includes]
+
+    merged: Dict = {"columns": list(), "templates": dict(), "credentials": dict()}
+    for include in includes:
+        include_path = os.path.normpath(
+            os.path.join(os.path.dirname(path), os.path.expanduser(include))
+        )
+        if include_path in including + (path,):
+            raise ConfigError(path, [f"{include} includes itself"])
+
+        try:
+            with open(include_path, "rb") as f:
+                include_source = f.read()
+        except OSError as oe:
+            raise ConfigError(path, [f"Unable to read included file {include} - {oe}"])
+
+        merge_config(
+            merged,
+            read_config(include_path, include_source, sources, including + (path,)),
+        )
+
+    merge_config(merged, config)
+    return merged
+
+
+def merge_config(base: Dict, config: Dict) -> None:
+    for key, value in config.items():
+        if key == "columns" and isinstance(value, list):
+            base["columns"] = base["columns"] + value
+        elif key in ("templates", "credentials") and isinstance(value, dict):
+            base[key] = {**base[key], **value}
+        else:
+            base[key] = value
+
+
+def expand_config(path: str, config: Dict) -> None:
+    """
+    Expands every column's templates and credentials, in place
+
+    :raises ConfigError: Listing every column that can't be expanded
+    """
+
+    templates = config.pop("templates", dict())
+    credentials = config.pop("credentials", dict())
+
+    errors = list()
+    if not isinstance(config.get("columns", list()), list):
+        raise ConfigError(path, ['"columns" must be a list'])
+
+    expanded = list()
+    for index, column in enumerate(config.get("columns", list())):
+        label = get_column_label(index, column)
+        if not isinstance(column, dict):
+            errors.append(f"{label} must be an object")
+            continue
+
+        try:
+            expanded.append(expand_column(column, templates, credentials))
+        except ValueError as ve:
+            errors.append(f"{label}: {ve}")
+
+    if errors:
+        raise ConfigError(path, errors)
+
+    config["columns"] = expanded
+
+
+def validate_config(path: str, config: Dict) -> None:
+    """
+    Resolves every (expanded) column's type name, and validates it - in place
+
+    :raises ConfigError: Listing every invalid column
+    """
+
+    errors = list()
+    names = set()
+    for index, column in enumerate(config.get("columns", list())):
+        label = get_column_label(index, column)
+        errors.extend(f"{label}: {error}" for error in validate_column(column))
+
+        if column.get("name") in names:
+            errors.append(f"{label}: Another column has the same name")
+        names.add(column.get("name"))
+
+    if errors:
+        raise ConfigError(path, errors)
+
+
+def get_column_label(index: int, column) -> str:
+    if isinstance(column, dict) and isinstance(column.get("name"), str):
+        return f'Column "{column["name"]}"'
+
+    return f"Column {index}"
+
+
+def expand_column(column: Dict, templates: Dict, credentials: Dict) -> Dict:
+    """
+    :param column: A column's configuration
+    :type column: Dict
+    :param templates: Named blocks of column configuration, which may
+        themselves use templates
+    :type templates: Dict
+    :param credentials: Named blocks of shared credentials
+    :type credentials: Dict
+    :return: The column, with its templates and credentials merged in
+        (the column's own values win)
+    :rtype: Dict
+    :raises ValueError: If a template or credentials block doesn't exist
+    """
+
+    def apply_templates(config: Dict, seen: Tuple[str, ...]) -> Dict:
+        names = config.get("template", list())
+        if isinstance(names, str):
+            names = [names]
+
+        expanded: Dict = dict()
+        for name in names:
+            if name in seen:
+                raise ValueError(f'Template "{name}" uses itself')
+            if name not in templates:
+                raise ValueError(f'No template named "{name}"')
+            expanded.update(apply_templates(templates[name], seen + (name,)))
+
+        expanded.update(config)
+        expanded.pop("template", None)
+        return expanded
+
+    column = apply_templates(column, tuple())
+
+    credentials_name = column.pop("credentials", None)
+    if credentials_name is not None:
+        if credentials_name not in credentials:
+            raise ValueError(f'No credentials named "{credentials_name}"')
+        column = {**credentials[credentials_name], **column}
+
+    return column
+
+
+def resolve_type_name(type_name: str) -> str:
+    """
+    :param type_name: A column's type, eg. "BitcoinInstitution" -
+        the "Institution" suffix and case are optional for built-in types,
+        eg. "bitcoin"
+    :type type_name: str
+    :return: The institution's full type name
+    :rtype: str
+    """
+
+    for candidate in (type_name, f"{type_name}Institution"):
+        for known in INSTITUTION_MODULES:
+            if candidate.lower() == known.lower():
+                return known
+
+    return type_name
+
+
+def validate_column(column: Dict) -> List[str]:
+    """
+    Checks a (compiled) column against its institution's schema,
+    resolving its type name in place
+
+    :param column: A column's configuration
+    :type column: Dict
+    :return: Every problem found
+    :rtype: List[str]
+    """
+
+    errors = validate_schema(column, COMMON_REQUIRED_CONFIG, COMMON_OPTIONAL_CONFIG)
+    if not isinstance(column.get("type"), str):
+        return errors
+
+    column["type"] = resolve_type_name(column["type"])
+    try:
+        institution_class = get_institution_class(column["type"])
+    except AttributeError:
+        return errors + [f'Unknown type "{column["type"]}"']
+    except ImportError as ie:
+        return errors + [f'Unable to load type "{column["type"]}" - {ie}']
+
+    errors.extend(
+        validate_schema(
+            column, institution_class.REQUIRED_CONFIG, institution_class.OPTIONAL_CONFIG
+        )
+    )
+
+    unknown = (
+        column.keys()
+        - COMMON_REQUIRED_CONFIG.keys()
+        - COMMON_OPTIONAL_CONFIG.keys()
+        - institution_class.REQUIRED_CONFIG.keys()
+        - institution_class.OPTIONAL_CONFIG.keys()
+    )
+    if unknown:
+        logger.warning(
+            f'Column "{column.get("name")}" has unknown keys, which are ignored: {sorted(unknown)}'
+        )
+
+    return errors
+
+
+def validate_schema(config: Dict, required: Dict, optional: Dict) -> List[str]:
+    """
+    :param config: A block of configuration
+    :type config: Dict
+    :param required: A mapping of each required key to its type (or tuple of types),
+        or, for nested objects, to the nested object's required keys
+    :type required: Dict
+    :param optional: As required, for keys that may be left out
+    :type optional: Dict
+    :return: Every problem found
+    :rtype: List[str]
+    """
+
+    errors = list()
+    for key, expected in list(required.items()) + list(optional.items()):
+        if key not in config:
+            if key in required:
+                errors.append(f'Missing "{key}"')
+            continue
+
+        value = config[key]
+        if isinstance(expected, dict):
+            if not isinstance(value, dict):
+                errors.append(f'"{key}" must be an object')
+            else:
+                errors.extend(
+                    f'"{key}": {error}'
+                    for error in validate_schema(value, expected, dict())
+                )
+        elif not isinstance(value, expected) or (
+            # bools are ints, but never what's meant
+            isinstance(value, bool)
+            and bool not in (expected if isinstance(expected, tuple) else (expected,))
+        ):
+            errors.append(f'"{key}" must be {describe_type(expected)}')
+
+    return errors
+
+
+def describe_type(expected) -> str:
+    names = {
+        str: "a string",
+        int: "an integer",
+        float: "a number",
+        bool: "true or false",
+        list: "a list",
+        dict: "an object",
+    }
+    expected = expected if isinstance(expected, tuple) else (expected,)
+    if float in expected:
+        expected = tuple(t for t in expected if t is not int)
+    return " or ".join(names.get(t, t.__name__) for t in expected)
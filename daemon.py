@@ -0,0 +1,274 @@
+import asyncio
+import json
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, unquote
+
+from engine import FetchEngine
+from institutions.institution import Institution
+from institutions.instrumentation import run_in_context
+from institutions.transport import deadline
+from records import BalanceRecord
+
+
+class BalanceDaemon:
+    """
+    Long-running alternative to a one-shot FetchEngine run.
+
+    Each column's Institution is constructed once and kept alive,
+    along with its authenticated session, and refreshed on the column's own
+    "refresh_interval". Sessions are only re-established when a refresh
+    fails with an authentication error.
+    The latest balances are served as JSON over a local HTTP endpoint.
+    """
+
+    DEFAULT_REFRESH_INTERVAL = 900
+    DEFAULT_LISTEN = "127.0.0.1:8787"
+
+    # how long to wait before retrying a column that failed to initialize
+    INIT_RETRY_DELAY = 60
+
+    def __init__(
+        self,
+        engine: FetchEngine,
+        columns: List[Dict],
+        refresh_interval: float = DEFAULT_REFRESH_INTERVAL,
+        listen: str = DEFAULT_LISTEN,
+        on_result: Optional[Callable[[BalanceRecord], None]] = None,
+        initial_balances: Optional[Dict[Tuple[str, str], BalanceRecord]] = None,
+    ):
+        """
+        :param engine: The engine used to construct and fetch columns
+        :type engine: FetchEngine
+        :param columns: The "columns" list from the configuration file
+        :type columns: List[Dict]
+        :param refresh_interval: The refresh interval, in seconds,
+            for columns without their own "refresh_interval"
+        :type refresh_interval: float
+        :param listen: The "host:port" to serve balances on
+        :type listen: str
+        :param on_result: If provided, called with each column's balance
+            whenever it's refreshed
+        :type on_result: Optional[Callable[[BalanceRecord], None]]
+        :param initial_balances: Previously fetched balances (eg. from the
+            snapshot store), by (column name, currency),
+            to serve until each column's first refresh.
+            A column isn't refreshed until its initial balance is stale.
+        :type initial_balances: Optional[Dict[Tuple[str, str], BalanceRecord]]
+        """
+
+        self.engine = engine
+        self.logger = engine.logger
+        self.columns = columns
+        self.refresh_interval = refresh_interval
+        self.listen = parse_listen_address(listen)
+        self.on_result = on_result
+
+        # replaced (never mutated) on update, so the HTTP server's threads
+        # can read it without locking
+        self.latest: Dict[Tuple[str, str], BalanceRecord] = dict(
+            initial_balances or dict()
+        )
+
+        self._stopping: Optional[asyncio.Event] = None
+
+    def run(self) -> None:
+        """
+        Runs the daemon until it receives SIGINT or SIGTERM
+
+        :rtype: None
+        """
+
+        asyncio.run(self.serve())
+
+    async def serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stopping.set)
+            except (NotImplementedError, RuntimeError):
+                # eg. not on the main thread, or on Windows
+                pass
+
+        server = ThreadingHTTPServer(self.listen, self._make_handler())
+        server.daemon_threads = True
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        self.logger.info(
+            f"Serving balances on http://{self.listen[0]}:{self.listen[1]}"
+        )
+
+        semaphore = asyncio.Semaphore(self.engine.concurrency)
+        with ThreadPoolExecutor(max_workers=self.engine.concurrency) as executor:
+            loop.set_default_executor(executor)
+            tasks = [
+                asyncio.ensure_future(self._group_loop(group, semaphore))
+                for group in self.engine.group_columns(self.columns)
+            ]
+
+            await self._stopping.wait()
+
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        server.shutdown()
+        server.server_close()
+
+    def stop(self) -> None:
+        """
+        Stops a running daemon. Must be called from the daemon's event loop
+
+        :rtype: None
+        """
+
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def _group_loop(self, group: List[Dict], semaphore: asyncio.Semaphore):
+        """
+        Constructs a group's Institution, then refreshes it forever.
+        A group is refreshed as often as its most frequently refreshed column.
+        """
+
+        interval = min(
+            column.get("refresh_interval", self.refresh_interval) for column in group
+        )
+
+        # don't refresh a group that's already fresh
+        currency = self.engine.valuator.currencies[0]
+        initial = [self.latest.get((column["name"], currency)) for column in group]
+        if all(record is not None for record in initial):
+            oldest = min(record.timestamp for record in initial)
+            await asyncio.sleep(max(0.0, oldest + interval - time.time()))
+
+        institution = None
+        while institution is None:
+            try:
+                async with semaphore:
+                    institution = await self.engine.create_institution(group[0])
+            except Exception as be:
+                self.logger.error(
+                    f"Exception initializing {group[0].get('type')} - {type(be).__name__}: {str(be)}"
+                )
+                await asyncio.sleep(self.INIT_RETRY_DELAY)
+
+        while True:
+            started = time.monotonic()
+            async with semaphore:
+                await self._refresh(group, institution)
+
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    async def _refresh(self, group: List[Dict], institution: Institution) -> None:
+        """
+        Fetches a group's balances within the group's time budget,
+        re-authenticating once if its session expired
+        """
+
+        budget = self.engine.get_budget(group)
+        try:
+            with deadline(budget):
+                results = await asyncio.wait_for(
+                    self._fetch_group(group, institution), budget
+                )
+        except asyncio.TimeoutError:
+            results = {
+                column["name"]: TimeoutError(f"Not refreshed within {budget:.1f}s")
+                for column in group
+            }
+
+        # timed out columns keep serving their latest balance, marked as stale
+        self.engine.report(group, results, self._update, last_known=self.latest)
+
+    async def _fetch_group(
+        self, group: List[Dict], institution: Institution
+    ) -> Dict[str, Union[Dict[str, Decimal], Exception]]:
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                return await self.engine.fetch_group(institution, group)
+            except Exception as be:
+                if not institution.is_auth_error(be):
+                    raise
+
+                self.logger.info(f"Session for {group[0]['name']} expired, refreshing")
+                await loop.run_in_executor(
+                    None, run_in_context(institution.refresh_session)
+                )
+                return await self.engine.fetch_group(institution, group)
+
+        except Exception as be:
+            return {column["name"]: be for column in group}
+
+    def _update(self, record: BalanceRecord) -> None:
+        self.latest = {**self.latest, record.key: record}
+        self.engine.emit(self.on_result, record)
+
+    def _make_handler(self) -> type:
+        daemon = self
+
+        class BalanceRequestHandler(BaseHTTPRequestHandler):
+            """
+            GET /balances -> every column's latest balance
+            GET /balances/<column name> -> a single column's latest balance
+
+            Balances are in the primary reporting currency,
+            or in the currency given by "?currency=", eg. "?currency=eur"
+            """
+
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                path = path.rstrip("/")
+                currency = (
+                    parse_qs(query)
+                    .get("currency", [daemon.engine.valuator.currencies[0]])[0]
+                    .lower()
+                )
+                latest = {
+                    name: record
+                    for (name, record_currency), record in daemon.latest.items()
+                    if record_currency == currency
+                }
+
+                if path == "/balances":
+                    body = {name: record._asdict() for name, record in latest.items()}
+                elif path.startswith("/balances/"):
+                    record = latest.get(unquote(path[len("/balances/") :]))
+                    if record is None:
+                        self.send_error(404, "Unknown column, or not yet fetched")
+                        return
+                    body = record._asdict()
+                else:
+                    self.send_error(404)
+                    return
+
+                payload = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                daemon.logger.debug(format % args)
+
+        return BalanceRequestHandler
+
+
+def parse_listen_address(listen: str) -> Tuple[str, int]:
+    """
+    :param listen: An address of the form "host:port"
+    :type listen: str
+    :return: The (host, port) pair
+    :rtype: Tuple[str, int]
+    """
+
+    host, _, port = listen.rpartition(":")
+    return host or "127.0.0.1", int(port)
@@ -0,0 +1,596 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from decimal import Decimal
+from functools import partial
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from institutions.institution import Institution, get_institution_class
+from institutions.instrumentation import Instrumentation, child_span, run_in_context
+from institutions.transport import (
+    Transport,
+    deadline,
+    get_time_remaining,
+    get_transport,
+)
+from institutions.valuation import Valuator, get_valuator
+from isolation import IsolationPool
+from records import BalanceRecord
+
+
+class FetchEngine:
+    """
+    Constructs every column's Institution and fetches its balance concurrently.
+
+    Both phases run under the same bounded concurrency limit,
+    so a column's (often network-bound) __init__ no longer blocks
+    every column after it.
+    Blocking institutions run on a thread pool sized to the limit,
+    while institutions that implement get_balance_async natively
+    simply run on the event loop.
+    Each group's holdings are valued together by the Valuator,
+    and every column is reported once per reporting currency.
+
+    Given as_of timestamps, the engine backfills instead - each group's
+    holdings at every timestamp are fetched at once (from institutions
+    that support it), valued at that time's prices, and reported with
+    the timestamp they're as of.
+
+    Given an IsolationPool, groups of the types it isolates are fetched
+    in its worker processes instead, and only valued here.
+
+    Each group of columns must finish within its time budget -
+    the smallest "timeout" of its columns (or column_timeout),
+    cut short by the run's overall deadline - or it's abandoned and
+    reported as stale, falling back to its last known balance if one is given.
+    The budget is also enforced by the transport, so an abandoned group's
+    requests stop shortly after it's given up on.
+    """
+
+    DEFAULT_CONCURRENCY = 8
+
+    def __init__(
+        self,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        logger: Optional[logging.Logger] = None,
+        transport: Optional[Transport] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        deadline: Optional[float] = None,
+        column_timeout: Optional[float] = None,
+        last_known: Optional[Dict[Tuple[str, str], BalanceRecord]] = None,
+        valuator: Optional[Valuator] = None,
+        as_of: Optional[List[float]] = None,
+        isolation: Optional[IsolationPool] = None,
+    ):
+        """
+        :param concurrency: The maximum number of groups in flight at once
+        :type concurrency: int
+        :param logger: The logger that errors (and each column's logger) use
+        :type logger: Optional[logging.Logger]
+        :param transport: The transport handed to every Institution
+        :type transport: Optional[Transport]
+        :param instrumentation: If provided, records every group's
+            lifecycle phases and HTTP traffic
+        :type instrumentation: Optional[Instrumentation]
+        :param deadline: If provided, the number of seconds (from the start
+            of a run) by which every column must be fetched or given up on
+        :type deadline: Optional[float]
+        :param column_timeout: If provided, the time budget, in seconds,
+            of columns without their own "timeout"
+        :type column_timeout: Optional[float]
+        :param last_known: Previously fetched balances (eg. from the
+            snapshot store), by (column name, currency),
+            emitted as stale in place of timed out columns
+        :type last_known: Optional[Dict[Tuple[str, str], BalanceRecord]]
+        :param valuator: The Valuator pricing every column's holdings
+        :type valuator: Optional[Valuator]
+        :param as_of: If provided, backfill every column's balance
+            as of each of these times, in seconds since the epoch,
+            rather than fetching current balances
+        :type as_of: Optional[List[float]]
+        :param isolation: If provided, the worker processes that fetch
+            the institution types it isolates
+        :type isolation: Optional[IsolationPool]
+        """
+
+        if concurrency < 1:
+            raise ValueError(f"Concurrency must be at least 1, got {concurrency}")
+
+        self.concurrency = concurrency
+        self.logger = logger or logging.getLogger("balance_sheet_gen")
+        self.transport = transport or get_transport()
+
+        self.instrumentation = instrumentation
+        self.deadline = deadline
+        self.column_timeout = column_timeout
+        self.last_known = last_known or dict()
+        self.valuator = valuator or get_valuator()
+        self.as_of = sorted(as_of) if as_of is not None else None
+        self.isolation = isolation
+
+        # the time.monotonic() value by which the current run must finish
+        self._deadline_at: Optional[float] = None
+
+    def run(
+        self,
+        columns: List[Dict],
+        on_result: Optional[Callable[[BalanceRecord], None]] = None,
+    ) -> Dict[str, float]:
+        """
+        Synchronous entrypoint - runs the engine on a new event loop
+
+        :param columns: The "columns" list from the configuration file
+        :type columns: List[Dict]
+        :param on_result: If provided, called with each column's balance
+            as soon as it's fetched
+        :type on_result: Optional[Callable[[BalanceRecord], None]]
+        :return: A mapping of column name to balance, in the primary
+            reporting currency, for every column that completed successfully
+        :rtype: Dict[str, float]
+        """
+
+        return asyncio.run(self.fetch_balances(columns, on_result))
+
+    async def fetch_balances(
+        self,
+        columns: List[Dict],
+        on_result: Optional[Callable[[BalanceRecord], None]] = None,
+    ) -> Dict[str, float]:
+        """
+        :param columns: The "columns" list from the configuration file
+        :type columns: List[Dict]
+        :param on_result: If provided, called with each column's balance
+            as soon as it's fetched
+        :type on_result: Optional[Callable[[BalanceRecord], None]]
+        :return: A mapping of column name to balance,
+            for every column that completed successfully
+        :rtype: Dict[str, float]
+        """
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        if self.deadline is not None:
+            self._deadline_at = time.monotonic() + self.deadline
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            loop.set_default_executor(executor)
+            group_balances = await asyncio.gather(
+                *(
+                    self._fetch_group(group, semaphore, on_result)
+                    for group in self.group_columns(columns)
+                )
+            )
+
+        balances = dict()
+        for group_balance in group_balances:
+            balances.update(group_balance)
+
+        return {
+            column["name"]: balances[column["name"]]
+            for column in columns
+            if column["name"] in balances
+        }
+
+    def group_columns(self, columns: List[Dict]) -> List[List[Dict]]:
+        """
+        Splits columns into groups that can be served by one Institution -
+        columns of the same type whose Institution gives them the same
+        group key (eg. because they share credentials) are grouped together,
+        and every other column is in a group of its own
+
+        :param columns: The "columns" list from the configuration file
+        :type columns: List[Dict]
+        :return: The groups, in the order of their first column
+        :rtype: List[List[Dict]]
+        """
+
+        groups: Dict[Hashable, List[Dict]] = dict()
+        for index, column in enumerate(columns):
+            try:
+                group_key = get_institution_class(column["type"]).get_group_key(column)
+            except Exception:
+                # reported when the column is initialized
+                group_key = None
+
+            key = (
+                ("column", index) if group_key is None else (column["type"], group_key)
+            )
+            groups.setdefault(key, list()).append(column)
+
+        return list(groups.values())
+
+    async def _fetch_group(
+        self,
+        group: List[Dict],
+        semaphore: asyncio.Semaphore,
+        on_result: Optional[Callable[[BalanceRecord], None]] = None,
+    ) -> Dict[str, float]:
+        """
+        Initializes a group's Institution and returns its columns' balances
+
+        :return: A mapping of column name to balance,
+            for every column in the group that completed successfully
+        :rtype: Dict[str, float]
+        """
+
+        async with semaphore:
+            with self.instrument_group(group) as metrics:
+                budget = self.get_budget(group)
+                try:
+                    if budget is not None and budget <= 0:
+                        raise asyncio.TimeoutError()
+
+                    # the transport gives up on requests that can't finish in time,
+                    # so abandoned groups don't keep their threads busy
+                    with deadline(budget):
+                        results = await asyncio.wait_for(
+                            self._init_and_fetch_group(group), budget
+                        )
+
+                except asyncio.TimeoutError:
+                    results = {
+                        column["name"]: TimeoutError("Not fetched before its deadline")
+                        for column in group
+                    }
+
+                if results is None:
+                    if metrics is not None:
+                        metrics.succeeded = False
+                    return dict()
+
+                if metrics is not None:
+                    metrics.succeeded = not any(
+                        isinstance(result, Exception) for result in results.values()
+                    )
+
+        return self.report(group, results, on_result)
+
+    async def _init_and_fetch_group(
+        self, group: List[Dict]
+    ) -> Optional[Dict[str, Union[Dict[str, Decimal], Exception]]]:
+        """
+        :return: A mapping of column name to its value in each currency,
+            or to the exception raised while fetching it -
+            or None, if the group's Institution couldn't be initialized
+        :rtype: Optional[Dict[str, Union[Dict[str, Decimal], Exception]]]
+        """
+
+        if self.isolation is not None and self.isolation.isolates(group[0]["type"]):
+            return await self.fetch_group_isolated(group)
+
+        try:
+            with self.instrument_phase("init"):
+                institution = await self.create_institution(group[0])
+
+        except TimeoutError:
+            raise asyncio.TimeoutError()
+        except Exception as be:
+            self.logger.error(
+                f"Exception initializing {group[0].get('type')} - {type(be).__name__}: {str(be)}"
+            )
+            return None
+
+        try:
+            with self.instrument_phase("get_balance"):
+                return await self.fetch_group(institution, group)
+        except Exception as be:
+            return {column["name"]: be for column in group}
+
+    async def fetch_group_isolated(
+        self, group: List[Dict]
+    ) -> Optional[Dict[str, Union[Dict, Exception]]]:
+        """
+        Fetches a group's holdings in a worker process, and values them here
+
+        :param group: The configurations of the group's columns
+        :type group: List[Dict]
+        :return: A mapping of column name to its value in each currency
+            (or, for backfills, at each timestamp), or to the exception raised
+            while fetching or valuing it - or None, if the group's Institution
+            couldn't be initialized
+        :rtype: Optional[Dict[str, Union[Dict, Exception]]]
+        """
+
+        try:
+            # the worker's phases are added to the group's metrics as they were timed there
+            results = await self.isolation.fetch_group(
+                group, self.as_of, get_time_remaining()
+            )
+        except TimeoutError:
+            raise asyncio.TimeoutError()
+        except Exception as be:
+            self.logger.error(
+                f"Exception initializing {group[0].get('type')} - {type(be).__name__}: {str(be)}"
+            )
+            return None
+
+        loop = asyncio.get_running_loop()
+        value = (
+            self.valuator.value_history
+            if self.as_of is not None
+            else self.valuator.value_results
+        )
+        with child_span("valuation"):
+            return await loop.run_in_executor(None, run_in_context(value, results))
+
+    def get_budget(self, group: List[Dict]) -> Optional[float]:
+        """
+        :param group: The configurations of the group's columns
+        :type group: List[Dict]
+        :return: How long, in seconds, the group may take from now -
+            or None if it has no limit
+        :rtype: Optional[float]
+        """
+
+        timeouts = [
+            column["timeout"] for column in group if column.get("timeout") is not None
+        ]
+        budget = min(timeouts) if timeouts else self.column_timeout
+
+        if self._deadline_at is not None:
+            remaining = self._deadline_at - time.monotonic()
+            budget = remaining if budget is None else min(budget, remaining)
+
+        return budget
+
+    def instrument_group(self, group: List[Dict]) -> ContextManager:
+        """
+        :return: A context attributing everything in it to the group's columns,
+            yielding their ColumnMetrics - or None, if the engine isn't instrumented
+        :rtype: ContextManager
+        """
+
+        if self.instrumentation is None:
+            return nullcontext()
+
+        return self.instrumentation.column(
+            [column.get("name") for column in group], str(group[0].get("type"))
+        )
+
+    def instrument_phase(self, phase: str) -> ContextManager:
+        """
+        :return: A context timing one phase of the current group's lifecycle
+        :rtype: ContextManager
+        """
+
+        if self.instrumentation is None:
+            return nullcontext()
+
+        return self.instrumentation.phase(phase)
+
+    async def fetch_group(
+        self, institution: Institution, group: List[Dict]
+    ) -> Dict[str, Union[Dict[str, Decimal], Exception]]:
+        """
+        Fetches every column's holdings in a group with its (initialized)
+        Institution, and values them in every reporting currency
+
+        :param institution: The group's Institution
+        :type institution: Institution
+        :param group: The configurations of the group's columns
+        :type group: List[Dict]
+        :return: A mapping of column name to its value in each currency,
+            or to the exception raised while fetching or valuing it
+        :rtype: Dict[str, Union[Dict[str, Decimal], Exception]]
+        """
+
+        if self.as_of is not None:
+            return await self.fetch_group_history(institution, group)
+
+        if len(group) == 1:
+            holdings = {group[0]["name"]: await institution.get_holdings_async()}
+        else:
+            holdings = await institution.get_holdings_many_async(group)
+
+        loop = asyncio.get_running_loop()
+        # valuing may need to fetch prices, so keep it off the event loop
+        with child_span("valuation"):
+            return await loop.run_in_executor(
+                None, run_in_context(self.valuator.value_results, holdings)
+            )
+
+    async def fetch_group_history(
+        self, institution: Institution, group: List[Dict]
+    ) -> Dict[str, Union[Dict[float, Dict[str, Decimal]], Exception]]:
+        """
+        Fetches every column's holdings in a group at each of the engine's
+        as_of timestamps, and values them at each time's prices
+
+        :param institution: The group's Institution
+        :type institution: Institution
+        :param group: The configurations of the group's columns
+        :type group: List[Dict]
+        :return: A mapping of column name to its value in each currency
+            at each timestamp, or to the exception raised while fetching or valuing it
+        :rtype: Dict[str, Union[Dict[float, Dict[str, Decimal]], Exception]]
+        """
+
+        loop = asyncio.get_running_loop()
+        if len(group) == 1:
+            history = {
+                group[0]["name"]: await loop.run_in_executor(
+                    None,
+                    run_in_context(institution.get_historical_holdings, self.as_of),
+                )
+            }
+        else:
+            history = await loop.run_in_executor(
+                None,
+                run_in_context(
+                    institution.get_historical_holdings_many, group, self.as_of
+                ),
+            )
+
+        with child_span("valuation"):
+            return await loop.run_in_executor(
+                None, run_in_context(self.valuator.value_history, history)
+            )
+
+    def report(
+        self,
+        group: List[Dict],
+        results: Dict[str, Union[Dict, Exception]],
+        on_result: Optional[Callable[[BalanceRecord], None]] = None,
+        last_known: Optional[Dict[Tuple[str, str], BalanceRecord]] = None,
+    ) -> Dict[str, float]:
+        """
+        Logs any failed columns in a group's results, and emits the rest,
+        once per reporting currency.
+        Columns that timed out are emitted as stale,
+        with their last known balances, if they have any.
+
+        :param last_known: Overrides the engine's last known balances
+        :type last_known: Optional[Dict[Tuple[str, str], BalanceRecord]]
+        :return: A mapping of column name to balance, in the primary
+            reporting currency, for every column in the group that completed successfully
+            (for backfills, its balance as of the latest timestamp)
+        :rtype: Dict[str, float]
+        """
+
+        if last_known is None:
+            last_known = self.last_known
+
+        balances = dict()
+        for column in group:
+            result = results.get(
+                column["name"], Exception("No balance returned for this column")
+            )
+            if isinstance(result, TimeoutError):
+                self.report_stale(column["name"], result, last_known, on_result)
+                continue
+
+            if isinstance(result, Exception):
+                self.logger.error(
+                    f"Exception getting balance for {column['name']} - {type(result).__name__}: {str(result)}"
+                )
+                continue
+
+            if self.as_of is not None:
+                # backfilled balances are reported as of their own time
+                history = result
+                for timestamp, values in sorted(history.items()):
+                    self.emit_values(on_result, column["name"], values, timestamp, True)
+                result = history[max(history)] if history else dict()
+            else:
+                self.emit_values(on_result, column["name"], result, time.time())
+
+            if result:
+                balances[column["name"]] = float(result[self.valuator.currencies[0]])
+
+        return balances
+
+    def emit_values(
+        self,
+        on_result: Optional[Callable[[BalanceRecord], None]],
+        column_name: str,
+        values: Dict[str, Decimal],
+        timestamp: float,
+        backfilled: bool = False,
+    ) -> None:
+        """
+        Emits a column's value in each reporting currency
+
+        :rtype: None
+        """
+
+        for currency, value in values.items():
+            self.emit(
+                on_result,
+                BalanceRecord(
+                    column_name,
+                    float(value),
+                    timestamp,
+                    currency=currency,
+                    backfilled=backfilled,
+                ),
+            )
+
+    def report_stale(
+        self,
+        column_name: str,
+        exception: TimeoutError,
+        last_known: Dict[Tuple[str, str], BalanceRecord],
+        on_result: Optional[Callable[[BalanceRecord], None]] = None,
+    ) -> None:
+        """
+        Reports a column that wasn't fetched in time,
+        emitting its last known balances (marked as stale) if there are any
+
+        :rtype: None
+        """
+
+        records = [
+            last_known[(column_name, currency)]
+            for currency in self.valuator.currencies
+            if (column_name, currency) in last_known
+        ]
+        if not records:
+            self.logger.error(
+                f"Timed out getting balance for {column_name}, and it has no previous balance - {str(exception)}"
+            )
+            return
+
+        self.logger.warning(
+            f"Timed out getting balance for {column_name}, reporting its balance from {time.ctime(records[0].timestamp)} - {str(exception)}"
+        )
+        for record in records:
+            self.emit(on_result, record._replace(column_name=column_name, stale=True))
+
+    async def create_institution(self, column: Dict) -> Institution:
+        """
+        Initializes a column's Institution on the engine's executor,
+        so that any network calls made by its __init__ don't block the loop
+
+        :param column: The column's configuration
+        :type column: Dict
+        :return: The column's Institution
+        :rtype: Institution
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            run_in_context(
+                partial(
+                    Institution,
+                    type_name=column["type"],
+                    name=column["name"],
+                    config=column,
+                    logger=self.logger.getChild(column["name"]),
+                    transport=self.transport,
+                )
+            ),
+        )
+
+    def emit(
+        self,
+        on_result: Optional[Callable[[BalanceRecord], None]],
+        record: BalanceRecord,
+    ) -> None:
+        """
+        Hands a fetched balance to the on_result callback, if there is one,
+        logging (rather than raising) any exception it throws
+
+        :rtype: None
+        """
+
+        if on_result is None:
+            return
+
+        try:
+            on_result(record)
+        except Exception as be:
+            self.logger.error(
+                f"Exception emitting balance for {record.column_name} - {type(be).__name__}: {str(be)}"
+            )
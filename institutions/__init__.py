@@ -1,8 +1,3 @@
-import os
-
-pkg_dir = os.path.dirname(os.path.abspath(__file__))
-
-__all__ = [
-    fname[:-3] for fname in os.listdir(pkg_dir) if fname.endswith("_institution.py")
-]
-__all__.append("institution")
+# Connector modules are deliberately not imported here -
+# see registry.py, which imports each one only when it's needed.
+__all__ = ["institution", "registry"]
@@ -0,0 +1,195 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from .cache import default_cache_dir
+
+
+class AddressState(NamedTuple):
+    """
+    What was last seen of a wallet address
+    """
+
+    # the address' balance, exactly, in whatever units its institution uses
+    balance: str
+    # the chain's height when the balance was fetched, if the chain reports it
+    height: Optional[int]
+    # when the balance was fetched, in seconds since the epoch
+    checked_at: float
+    # anything else its institution keeps about the address, as JSON -
+    # eg. Ethereum's token balances
+    details: Optional[str] = None
+
+
+class AddressStateCache:
+    """
+    Remembers the last seen balance of every wallet address, and the chain height
+    it was seen at, so wallets can skip addresses that can't have changed.
+
+    States are kept in a single SQLite index - one row per address,
+    without rowids - which stays small and quick to look up
+    even with many thousands of addresses.
+    Every process (and worker) can share it.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS address_states (
+            chain TEXT NOT NULL,
+            address TEXT NOT NULL,
+            balance TEXT NOT NULL,
+            height INTEGER,
+            checked_at REAL NOT NULL,
+            details TEXT,
+            PRIMARY KEY (chain, address)
+        ) WITHOUT ROWID;
+    """
+
+    # indexes created before addresses had details
+    MIGRATIONS = {
+        "details": "ALTER TABLE address_states ADD COLUMN details TEXT",
+    }
+
+    # SQLite's limit on query parameters is 999 on older versions
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        enabled: bool = True,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.path = path
+        self.enabled = enabled
+        self.logger = logger or logging.getLogger("balance_sheet_gen.address_state")
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def configure(
+        self, path: Optional[str] = None, enabled: Optional[bool] = None
+    ) -> None:
+        """
+        Applies the top-level "address_state" configuration block
+
+        :param path: The path to the SQLite index - defaults to the cache directory
+        :type path: Optional[str]
+        :param enabled: Whether to remember addresses' states at all
+        :type enabled: Optional[bool]
+        :rtype: None
+        """
+
+        with self._lock:
+            if path is not None and path != self.path:
+                self.path = path
+                self._close()
+            if enabled is not None:
+                self.enabled = enabled
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Opens the index, if it isn't already. The caller must hold self._lock
+
+        :rtype: sqlite3.Connection
+        """
+
+        if self._conn is None:
+            path = os.path.expanduser(
+                self.path or os.path.join(default_cache_dir(), "address_state.sqlite3")
+            )
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+            self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            with self._conn:
+                self._conn.executescript(self.SCHEMA)
+
+                columns = {
+                    row[1]
+                    for row in self._conn.execute(
+                        "PRAGMA table_info(address_states)"
+                    ).fetchall()
+                }
+                for column, migration in self.MIGRATIONS.items():
+                    if column not in columns:
+                        self._conn.execute(migration)
+
+        return self._conn
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, chain: str, addresses: Iterable[str]) -> Dict[str, AddressState]:
+        """
+        :param chain: The addresses' chain, eg. "bitcoin"
+        :type chain: str
+        :param addresses: The addresses to look up
+        :type addresses: Iterable[str]
+        :return: A mapping of address to its last seen state,
+            for every address that's been seen
+        :rtype: Dict[str, AddressState]
+        """
+
+        if not self.enabled:
+            return dict()
+
+        addresses = list(addresses)
+        states = dict()
+        try:
+            with self._lock:
+                conn = self._connect()
+                for i in range(0, len(addresses), self.QUERY_BATCH_SIZE):
+                    batch = addresses[i : i + self.QUERY_BATCH_SIZE]
+                    rows = conn.execute(
+                        "SELECT address, balance, height, checked_at, details "
+                        "FROM address_states "
+                        f"WHERE chain = ? AND address IN ({', '.join('?' * len(batch))})",
+                        [chain, *batch],
+                    ).fetchall()
+                    states.update(
+                        {address: AddressState(*state) for address, *state in rows}
+                    )
+        except sqlite3.Error as se:
+            self.logger.warning(f"Unable to read address states - {se}")
+
+        return states
+
+    def put(self, chain: str, states: Dict[str, AddressState]) -> None:
+        """
+        :param chain: The addresses' chain, eg. "bitcoin"
+        :type chain: str
+        :param states: A mapping of address to its latest state
+        :type states: Dict[str, AddressState]
+        :rtype: None
+        """
+
+        if not self.enabled or not states:
+            return
+
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO address_states "
+                        "(chain, address, balance, height, checked_at, details) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [(chain, address, *state) for address, state in states.items()],
+                    )
+        except sqlite3.Error as se:
+            self.logger.warning(f"Unable to record address states - {se}")
+
+
+_address_state_cache = AddressStateCache()
+
+
+def get_address_state_cache() -> AddressStateCache:
+    """
+    :return: The AddressStateCache shared by every Institution in this process
+    :rtype: AddressStateCache
+    """
+
+    return _address_state_cache
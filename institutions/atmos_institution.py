@@ -1,29 +1,53 @@
 import logging
-from time import sleep
-from typing import Dict
+from typing import Dict, Hashable, List, Optional, Union
 
 import pyotp
-import requests
 
 from .institution import Institution
+from .session_cache import get_jwt_expiry, get_session_cache
+from .transport import Transport
 
 
 class AtmosInstitution(Institution):
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
-        super(type(self), self).__init__(type_name, name, config, logger)
+    REQUIRED_CONFIG = {
+        "email": str,
+        "password": str,
+        "account_name": str,
+    }
+    OPTIONAL_CONFIG = {"totp_secret": str}
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
+        super(type(self), self).__init__(type_name, name, config, logger, transport)
         self.name = name
         self.config = config
 
         self.API_ROOT = "https://api.joinatmos.com/v1"
 
-        self.api_session = requests.Session()
+        self.api_session = self.transport.new_session()
         self.api_session.headers[
             "User-Agent"
         ] = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:99.0) Gecko/20100101 Firefox/99.0"
         self.api_session.hooks = {
             "response": lambda r, *args, **kwargs: r.raise_for_status()
         }
-        self.login()
+
+        # logging in (and MFA) is the slowest step, so reuse the last session
+        self.session_cache = get_session_cache()
+        if not self.session_cache.restore(
+            self.api_session,
+            type(self).__name__,
+            config["email"],
+            config["password"],
+            headers=["Authorization"],
+        ):
+            self.login()
 
     def login(self):
         login_json = {
@@ -51,14 +75,63 @@ class AtmosInstitution(Institution):
                 "Authorization"
             ] = f"Bearer bearer {mfa_res['token']}"
 
+        self.session_cache.store(
+            self.api_session,
+            type(self).__name__,
+            self.config["email"],
+            self.config["password"],
+            headers=["Authorization"],
+            expires_at=get_jwt_expiry(
+                self.api_session.headers["Authorization"].split(" ")[-1]
+            ),
+        )
+
+    def refresh_session(self) -> None:
+        self.api_session.headers.pop("Authorization", None)
+        self.session_cache.clear(type(self).__name__, self.config["email"])
+        self.login()
+
+    @classmethod
+    def get_group_key(cls, config: Dict) -> Hashable:
+        # every account behind one login is served by a single session
+        return config["email"]
+
     def get_balance(self) -> float:
-        accounts = self.api_session.get(f"{self.API_ROOT}/account/nodes").json()[
-            "nodes"
-        ]
-        for account in accounts:
-            if account["info"]["nickname"] == self.config["account_name"]:
-                return account["info"]["balance"]["amount"]
-
-        raise Exception(
-            f"Account with nickname '{self.config['account_name']}' not found"
+        return self.find_balance(self.get_account_balances(), self.config)
+
+    def get_balances(self, configs: List[Dict]) -> Dict[str, Union[float, Exception]]:
+        account_balances = self.get_account_balances()
+
+        balances = dict()
+        for config in configs:
+            try:
+                balances[config["name"]] = self.find_balance(account_balances, config)
+            except Exception as e:
+                balances[config["name"]] = e
+
+        return balances
+
+    def get_account_balances(self) -> Dict[str, float]:
+        """
+        :return: A mapping of every account's nickname to its balance
+        :rtype: Dict[str, float]
+        """
+
+        accounts = self.call_with_refresh(
+            lambda: self.api_session.get(f"{self.API_ROOT}/account/nodes").json()[
+                "nodes"
+            ]
         )
+        return {
+            account["info"]["nickname"]: account["info"]["balance"]["amount"]
+            for account in accounts
+        }
+
+    @staticmethod
+    def find_balance(account_balances: Dict[str, float], config: Dict) -> float:
+        if config["account_name"] not in account_balances:
+            raise Exception(
+                f"Account with nickname '{config['account_name']}' not found"
+            )
+
+        return account_balances[config["account_name"]]
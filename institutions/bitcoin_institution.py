@@ -1,31 +1,144 @@
 import logging
-from typing import Dict
-
-import requests
-from pycoingecko import CoinGeckoAPI
+from decimal import Decimal
+from functools import partial
+from typing import Dict, List, Optional, Tuple
 
+from .chain_backends import BitcoinCoreBackend, create_backend
 from .institution import Institution
+from .transport import Transport
+from .valuation import Holding
 
 
 class BitcoinInstitution(Institution):
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
-        super(type(self), self).__init__(type_name, name, config, logger)
+    COIN_ID = "bitcoin"
+    REQUIRED_CONFIG = {"wallet_addrs": list}
+    OPTIONAL_CONFIG = {
+        "address_recheck_interval": (int, float),
+        "backend": {"type": str, "url": str},
+    }
+    BACKEND_TYPES = {"bitcoind": BitcoinCoreBackend}
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
+        super(type(self), self).__init__(type_name, name, config, logger, transport)
         self.name = name
         self.config = config
+        self.backend = create_backend(
+            config.get("backend"), self.BACKEND_TYPES, self.transport
+        )
 
         self.ADDRESS_BALANCE_URL = "https://blockchain.info/multiaddr"
-        self.current_exchange_rate = CoinGeckoAPI().get_price("bitcoin", "usd")[
-            "bitcoin"
-        ]["usd"]
-
-    def get_balance(self) -> float:
-        total = 0
-        for wallet_addr in self.config.get("wallet_addrs", list()):
-            res = requests.get(
-                self.ADDRESS_BALANCE_URL, params={"active": wallet_addr}
+        self.CHAIN_HEIGHT_URL = "https://blockchain.info/q/getblockcount"
+
+        # multiaddr takes many addresses at once, pipe-separated -
+        # this keeps the query string to a length every proxy will accept
+        self.MULTIADDR_BATCH_SIZE = 100
+
+        # the most transactions multiaddr returns per page
+        self.MULTIADDR_PAGE_SIZE = 100
+
+    def get_holdings(self) -> List[Holding]:
+        balances = self.map_addresses(
+            self._get_batch_balances,
+            self.config.get("wallet_addrs", list()),
+            self.MULTIADDR_BATCH_SIZE,
+        )
+
+        # satoshis are summed exactly, and scaled exactly
+        return [Holding(self.COIN_ID, sum(balances.values(), Decimal(0)).scaleb(-8))]
+
+    def get_chain_height(self) -> int:
+        # a new block every ten minutes or so, so most runs see the same height
+        return int(self.transport.get(self.CHAIN_HEIGHT_URL).text)
+
+    def get_historical_holdings(
+        self, timestamps: List[float]
+    ) -> Dict[float, List[Holding]]:
+        # every date is answered from one walk back through the transactions
+        histories = self.map_concurrently(
+            partial(self._get_batch_history, since=min(timestamps)),
+            self._get_batches(),
+        )
+
+        holdings = dict()
+        for timestamp in timestamps:
+            # unwind every transaction made after the timestamp
+            total = sum(
+                final_balance
+                - sum(result for tx_time, result in txs if tx_time > timestamp)
+                for final_balance, txs in histories
+            )
+            holdings[timestamp] = [Holding(self.COIN_ID, Decimal(total).scaleb(-8))]
+
+        return holdings
+
+    def _get_batches(self) -> List[List[str]]:
+        wallet_addrs = self.config.get("wallet_addrs", list())
+        return [
+            wallet_addrs[i : i + self.MULTIADDR_BATCH_SIZE]
+            for i in range(0, len(wallet_addrs), self.MULTIADDR_BATCH_SIZE)
+        ]
+
+    def _get_batch_history(
+        self, wallet_addrs: List[str], since: float
+    ) -> Tuple[int, List[Tuple[int, int]]]:
+        """
+        :param wallet_addrs: Up to MULTIADDR_BATCH_SIZE BTC addresses
+        :type wallet_addrs: List[str]
+        :param since: The earliest time whose balance is needed
+        :type since: float
+        :return: The addresses' combined balance, in satoshis,
+            and the (time, net satoshis) of every transaction since `since`
+            (and possibly some before)
+        :rtype: Tuple[int, List[Tuple[int, int]]]
+        """
+
+        final_balance = None
+        txs = list()
+        while True:
+            # transactions come newest first
+            res = self.transport.get(
+                self.ADDRESS_BALANCE_URL,
+                params={
+                    "active": "|".join(wallet_addrs),
+                    "n": self.MULTIADDR_PAGE_SIZE,
+                    "offset": len(txs),
+                },
             ).json()
-            total += (
-                res["wallet"]["final_balance"] * 10 ** -8
-            ) * self.current_exchange_rate
+            if final_balance is None:
+                final_balance = res["wallet"]["final_balance"]
+
+            page = [(tx.get("time", 0), tx["result"]) for tx in res.get("txs", list())]
+            txs.extend(page)
+            if len(page) < self.MULTIADDR_PAGE_SIZE or page[-1][0] <= since:
+                return final_balance, txs
+
+    def _get_batch_balances(self, wallet_addrs: List[str]) -> Dict[Optional[str], int]:
+        """
+        :param wallet_addrs: Up to MULTIADDR_BATCH_SIZE BTC addresses
+        :type wallet_addrs: List[str]
+        :return: A mapping of each address to its balance, in satoshis -
+            or, if the response doesn't break the balance down by address,
+            the addresses' combined balance, under None
+        :rtype: Dict[Optional[str], int]
+        """
+
+        # n=0 - we only want balances, not the transaction list
+        res = self.transport.get(
+            self.ADDRESS_BALANCE_URL, params={"active": "|".join(wallet_addrs), "n": 0}
+        ).json()
+
+        balances = {
+            addr["address"]: addr["final_balance"]
+            for addr in res.get("addresses", list())
+        }
+        if all(wallet_addr in balances for wallet_addr in wallet_addrs):
+            return {wallet_addr: balances[wallet_addr] for wallet_addr in wallet_addrs}
 
-        return round(total, 2)
+        return {None: res["wallet"]["final_balance"]}
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set
+
+# one lock per HeldAssetCache file, shared by every column in the process
+_held_asset_locks: Dict[str, threading.RLock] = dict()
+_held_asset_locks_lock = threading.Lock()
+
+
+def default_cache_dir() -> str:
+    """
+    Returns the directory used for on-disk caches,
+    honoring $XDG_CACHE_HOME if it's set
+
+    :return: The path to this program's cache directory
+    :rtype: str
+    """
+
+    cache_root = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    return os.path.join(cache_root, "balance_sheet_gen")
+
+
+class JsonFileCache:
+    """
+    A small, versioned JSON document stored on disk.
+    Reads return an empty dict if the file is missing, unreadable,
+    or was written with a different version,
+    and writes are atomic so concurrent runs never see a partial file.
+    """
+
+    def __init__(self, path: str, version: int = 1):
+        self.path = os.path.expanduser(path)
+        self.version = version
+
+    def load(self) -> Dict:
+        """
+        :return: The cached document, or an empty dict if there's nothing usable
+        :rtype: Dict
+        """
+
+        try:
+            with open(self.path, "r") as f:
+                doc = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+        if not isinstance(doc, dict) or doc.get("version") != self.version:
+            return dict()
+
+        return doc.get("data", dict())
+
+    def save(self, data: Dict) -> None:
+        """
+        :param data: The JSON-serializable document to store
+        :type data: Dict
+        :rtype: None
+        """
+
+        cache_dir = os.path.dirname(self.path) or "."
+        os.makedirs(cache_dir, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": self.version, "data": data}, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def clear(self) -> None:
+        """
+        Removes the cache file, if it exists
+
+        :rtype: None
+        """
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class HeldAssetCache:
+    """
+    An institution's metadata that rarely changes - eg. the CoinGecko ID of
+    each of its assets - cached on disk for a TTL, along with the assets each
+    account held last time, so they can be priced up front with everything else.
+    Accounts are only ever stored as hashes of their identifiers.
+
+    Every column sharing the file shares its lock, so holding it while
+    checking and refreshing the metadata means it's only fetched once.
+    """
+
+    def __init__(
+        self, filename: str, version: int = 1, logger: Optional[logging.Logger] = None
+    ):
+        """
+        :param filename: The cache's file name, within the cache directory
+        :type filename: str
+        :param version: Bump whenever the cached metadata changes shape
+        :type version: int
+        :param logger: Where to warn about failed writes
+        :type logger: Optional[logging.Logger]
+        """
+
+        self.cache = JsonFileCache(os.path.join(default_cache_dir(), filename), version)
+        self.logger = logger or logging.getLogger("balance_sheet_gen.cache")
+
+        with _held_asset_locks_lock:
+            self.lock = _held_asset_locks.setdefault(self.cache.path, threading.RLock())
+
+    @staticmethod
+    def get_account_id(*identifiers: str) -> str:
+        """
+        :param identifiers: Whatever identifies the account, eg. its API key
+        :type identifiers: str
+        :return: An ID for the account's cached assets, which doesn't reveal
+            its identifiers
+        :rtype: str
+        """
+
+        return hashlib.sha256("|".join(identifiers).encode()).hexdigest()[:16]
+
+    def load_fresh(self, ttl: float) -> Optional[Dict]:
+        """
+        :param ttl: How old, in seconds, the metadata may be
+        :type ttl: float
+        :return: The cached metadata, if it was saved within the last ttl seconds
+        :rtype: Optional[Dict]
+        """
+
+        doc = self.cache.load()
+        if time.time() - doc.get("fetched_at", 0) < ttl:
+            return doc.get("metadata")
+
+        return None
+
+    def load_metadata(self) -> Dict:
+        """
+        :return: The cached metadata, however old it is - eg. to fall back on
+            when it can't be refreshed
+        :rtype: Dict
+        """
+
+        return self.cache.load().get("metadata", dict())
+
+    def save_metadata(self, metadata: Dict) -> None:
+        """
+        :param metadata: The freshly fetched, JSON-serializable metadata
+        :type metadata: Dict
+        :rtype: None
+        """
+
+        with self.lock:
+            doc = self.cache.load()
+            doc.update({"fetched_at": time.time(), "metadata": metadata})
+            self._save(doc, "metadata")
+
+    def get_held(self, account_id: str) -> Set[str]:
+        """
+        :param account_id: The account's ID, from get_account_id
+        :type account_id: str
+        :return: The assets the account held last time
+        :rtype: Set[str]
+        """
+
+        return set(self.cache.load().get("held", dict()).get(account_id, list()))
+
+    def save_held(self, account_id: str, asset_ids: Iterable[str]) -> None:
+        """
+        :param account_id: The account's ID, from get_account_id
+        :type account_id: str
+        :param asset_ids: The assets the account holds now
+        :type asset_ids: Iterable[str]
+        :rtype: None
+        """
+
+        asset_ids = set(asset_ids)
+        with self.lock:
+            doc = self.cache.load()
+            held = doc.setdefault("held", dict())
+            if set(held.get(account_id, list())) == asset_ids:
+                return
+
+            held[account_id] = sorted(asset_ids)
+            self._save(doc, "held assets")
+
+    def _save(self, doc: Dict, description: str) -> None:
+        try:
+            self.cache.save(doc)
+        except OSError as oe:
+            self.logger.warning(f"Unable to cache {description} - {oe}")
@@ -0,0 +1,223 @@
+import itertools
+import os
+import threading
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple, Type
+
+from .transport import Transport
+
+# a Bitcoin Core node runs one scantxoutset at a time, so scans are serialized per node
+_scan_locks: Dict[str, threading.Lock] = dict()
+_scan_locks_lock = threading.Lock()
+
+
+class ChainBackend:
+    """
+    A node or indexer that a wallet institution can query
+    instead of its public explorer, eg. a local Bitcoin Core node.
+
+    Backends return balances in the same units as their institution's
+    explorer, so either can answer for the other (and share cached states).
+    """
+
+    # the most addresses sent in one request - None for every address at once
+    BATCH_SIZE: Optional[int] = 500
+
+    # seconds to wait for a response, if the backend's config doesn't say
+    DEFAULT_TIMEOUT = 30.0
+
+    def __init__(self, config: Dict, transport: Transport):
+        """
+        :param config: The column's "backend" configuration block
+        :type config: Dict
+        :param transport: The transport to send requests through
+        :type transport: Transport
+        """
+
+        self.config = config
+        self.transport = transport
+
+    def get_height(self) -> int:
+        """
+        :return: The height of the backend's chain
+        :rtype: int
+        """
+
+        raise NotImplementedError()
+
+    def get_balances(self, addresses: List[str]) -> Dict[str, object]:
+        """
+        :param addresses: Up to BATCH_SIZE addresses
+        :type addresses: List[str]
+        :return: A mapping of each address to its balance
+        :rtype: Dict[str, object]
+        """
+
+        raise NotImplementedError()
+
+
+class JsonRpcBackend(ChainBackend):
+    """
+    A JSON-RPC node, sent batches of calls in single HTTP requests
+    """
+
+    def __init__(self, config: Dict, transport: Transport):
+        super().__init__(config, transport)
+
+        if not isinstance(config.get("url"), str):
+            raise ValueError(f'{type(self).__name__} requires a "url"')
+
+        self.url = config["url"]
+        self.timeout = config.get("timeout", self.DEFAULT_TIMEOUT)
+        self._ids = itertools.count()
+
+    def get_auth(self) -> Optional[Tuple[str, str]]:
+        """
+        :return: The node's credentials - from its "cookie_file" (as written
+            by Bitcoin Core), or its "username" and "password" - if it has any
+        :rtype: Optional[Tuple[str, str]]
+        """
+
+        if self.config.get("cookie_file"):
+            # rewritten every time the node restarts, so read it every time
+            with open(os.path.expanduser(self.config["cookie_file"])) as f:
+                username, _, password = f.read().strip().partition(":")
+            return username, password
+
+        if self.config.get("username") is not None:
+            return self.config["username"], self.config.get("password", "")
+
+        return None
+
+    def call(self, method: str, params: List):
+        return self.call_batch([(method, params)])[0]
+
+    def call_batch(self, calls: List[Tuple[str, List]]) -> List:
+        """
+        :param calls: (method, params) pairs
+        :type calls: List[Tuple[str, List]]
+        :return: Each call's result, in the same order as calls
+        :rtype: List
+        """
+
+        ids = [next(self._ids) for _ in calls]
+        res = self.transport.post(
+            self.url,
+            json=[
+                {"jsonrpc": "2.0", "id": call_id, "method": method, "params": params}
+                for call_id, (method, params) in zip(ids, calls)
+            ],
+            auth=self.get_auth(),
+            timeout=self.timeout,
+        )
+        res.raise_for_status()
+
+        # responses may come back in any order
+        responses = {
+            response["id"]: response for response in res.json(parse_float=Decimal)
+        }
+        results = list()
+        for call_id, (method, _) in zip(ids, calls):
+            response = responses.get(call_id)
+            if response is None:
+                raise Exception(f"No response to {method}")
+            if response.get("error"):
+                raise Exception(
+                    f"{method} failed - {response['error'].get('message', response['error'])}"
+                )
+            results.append(response["result"])
+
+        return results
+
+
+class BitcoinCoreBackend(JsonRpcBackend):
+    """
+    A Bitcoin Core node, whose UTXO set is scanned for every address at once
+    with scantxoutset - no wallet or address index is needed.
+    Balances are in satoshis, as blockchain.info's are.
+    """
+
+    # every address is sent in the same scan
+    BATCH_SIZE = None
+    # scanning the UTXO set takes a minute or two
+    DEFAULT_TIMEOUT = 300.0
+
+    def get_height(self) -> int:
+        return self.call("getblockcount", list())
+
+    def get_balances(self, addresses: List[str]) -> Dict[Optional[str], int]:
+        with _scan_locks_lock:
+            scan_lock = _scan_locks.setdefault(self.url, threading.Lock())
+
+        with scan_lock:
+            res = self.call(
+                "scantxoutset", ["start", [f"addr({address})" for address in addresses]]
+            )
+        if not res.get("success", True):
+            raise Exception("scantxoutset was aborted")
+
+        balances: Dict[Optional[str], int] = {address: 0 for address in addresses}
+        for unspent in res["unspents"]:
+            # eg. "addr(bc1q...)#checksum"
+            address = unspent["desc"].partition("(")[2].partition(")")[0]
+            if address not in balances:
+                # the node wrote the address differently, eg. in lower case
+                address = None
+            balances[address] = balances.get(address, 0) + int(
+                Decimal(unspent["amount"]).scaleb(8)
+            )
+
+        return balances
+
+
+class EthereumJsonRpcBackend(JsonRpcBackend):
+    """
+    An Ethereum node (or any Ethereum JSON-RPC endpoint), sent every
+    address' eth_getBalance call in one batch.
+    Balances are in ETH, as ethplorer's are.
+    """
+
+    BATCH_SIZE = 500
+
+    def get_height(self) -> int:
+        return int(self.call("eth_blockNumber", list()), 16)
+
+    def get_balances(self, addresses: List[str]) -> Dict[str, Decimal]:
+        results = self.call_batch(
+            [("eth_getBalance", [address, "latest"]) for address in addresses]
+        )
+
+        # wei, in hex
+        return {
+            address: Decimal(int(result, 16)).scaleb(-18)
+            for address, result in zip(addresses, results)
+        }
+
+
+def create_backend(
+    config: Optional[Dict],
+    backend_types: Dict[str, Type[ChainBackend]],
+    transport: Transport,
+) -> Optional[ChainBackend]:
+    """
+    :param config: A column's "backend" configuration block, if it has one
+    :type config: Optional[Dict]
+    :param backend_types: The backends the column's institution supports, by name
+    :type backend_types: Dict[str, Type[ChainBackend]]
+    :param transport: The transport the backend sends requests through
+    :type transport: Transport
+    :return: The column's backend, if it has one
+    :rtype: Optional[ChainBackend]
+    :raises ValueError: If the backend isn't supported
+    """
+
+    if config is None:
+        return None
+
+    backend_type = config.get("type")
+    if backend_type not in backend_types:
+        raise ValueError(
+            f'Unknown backend type "{backend_type}" - expected one of {sorted(backend_types)}'
+        )
+
+    return backend_types[backend_type](config, transport)
@@ -1,30 +1,49 @@
 import logging
-from typing import Dict
-
-import requests
-from pycoingecko import CoinGeckoAPI
+from decimal import Decimal
+from typing import Dict, List, Optional
 
 from .institution import Institution
+from .transport import Transport
+from .valuation import Holding
 
 
 class ChiaInstitution(Institution):
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
-        super(type(self), self).__init__(type_name, name, config, logger)
+    COIN_ID = "chia"
+    REQUIRED_CONFIG = {"wallet_addrs": list}
+    OPTIONAL_CONFIG = {"address_recheck_interval": (int, float)}
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
+        super(type(self), self).__init__(type_name, name, config, logger, transport)
         self.name = name
         self.config = config
 
         self.ADDRESS_BALANCE_URL = "https://xchscan.com/api/account/balance"
-        self.current_exchange_rate = CoinGeckoAPI().get_price("chia", "usd")["chia"][
-            "usd"
-        ]
-
-    def get_balance(self) -> float:
-        total = 0
-        for wallet_addr in self.config["wallet_addrs"]:
-
-            res = requests.get(
-                self.ADDRESS_BALANCE_URL, params={"address": wallet_addr}
-            ).json()
-            total += res["xch"]
 
-        return round(total * self.current_exchange_rate, 2)
+    def get_holdings(self) -> List[Holding]:
+        balances = self.map_addresses(
+            lambda addrs: {addrs[0]: self._get_address_balance(addrs[0])},
+            self.config["wallet_addrs"],
+        ).values()
+
+        return [Holding(self.COIN_ID, sum(balances, Decimal(0)))]
+
+    def _get_address_balance(self, wallet_addr: str) -> Decimal:
+        """
+        :param wallet_addr: An XCH address
+        :type wallet_addr: str
+        :return: The address' balance, in XCH
+        :rtype: Decimal
+        """
+
+        res = self.transport.get(
+            self.ADDRESS_BALANCE_URL, params={"address": wallet_addr}
+        )
+        # parsed as a Decimal, so no precision is lost to a float
+        return Decimal(str(res.json(parse_float=Decimal)["xch"]))
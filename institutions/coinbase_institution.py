@@ -1,35 +1,127 @@
+import hashlib
 import logging
-import time
-from typing import Dict
+import os
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
 
 from coinbase.wallet.client import Client
 
+from .cache import JsonFileCache, default_cache_dir
 from .institution import Institution
+from .transport import Transport
+from .valuation import Holding, fiat_holding
 
 
 class CoinbaseInstitution(Institution):
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
-        super(type(self), self).__init__(type_name, name, config, logger)
+    REQUIRED_CONFIG = {"api_key": str, "api_secret": str}
+    OPTIONAL_CONFIG = {"account_cache": bool}
 
-        self.coinbase_client = Client(config["api_key"], config["api_secret"])
+    PAGE_SIZE = 100
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
+        super(type(self), self).__init__(type_name, name, config, logger, transport)
 
-    def get_balance(self) -> float:
-        total = 0
-        starting_after = None
+        self.coinbase_client = Client(config["api_key"], config["api_secret"])
+        self.transport.mount(self.coinbase_client.session)
 
-        while True:  # Paginate until we hit the last page
-            accounts = self.coinbase_client.get_accounts(
-                limit=100, starting_after=starting_after
+        # the cursor starting each page of accounts, remembered between runs
+        self.cursor_cache = None
+        if config.get("account_cache"):
+            key = hashlib.sha256(config["api_key"].encode()).hexdigest()[:16]
+            self.cursor_cache = JsonFileCache(
+                os.path.join(default_cache_dir(), "coinbase_accounts", f"{key}.json")
             )
-            if accounts.pagination.next_starting_after is not None:
-                starting_after = accounts.pagination.next_starting_after
-                for acct in accounts.data:
-                    total += float(acct.native_balance.amount)
-
-                time.sleep(1)  # Let's not hit the rate limit
-            else:
-                for acct in accounts.data:
-                    total += float(acct.native_balance.amount)
-                break
-
-        return round(total, 2)
+
+    def get_holdings(self) -> List[Holding]:
+        # each account's balance in the user's native currency, eg. USD
+        holdings = list()
+        for accounts in self._get_account_pages():
+            for acct in accounts:
+                # most accounts are empty wallets for coins never held
+                if Decimal(acct.native_balance.amount) == 0:
+                    continue
+                holdings.append(self._get_native_holding(acct))
+
+        return holdings
+
+    def _get_account_pages(self) -> List[List]:
+        """
+        Fetches every page of the user's accounts.
+
+        Each page's cursor is the ID of the previous page's last account,
+        so pages can only be walked one after another - unless the cursors
+        are cached from a previous run, in which case every page is fetched
+        at once, and the walk only resumes from the first page whose
+        successor has changed (eg. because an account was added).
+
+        :return: The accounts on each page
+        :rtype: List[List]
+        """
+
+        cursors: List[Optional[str]] = [None]
+        if self.cursor_cache is not None:
+            cursors += self.cursor_cache.load().get("cursors", list())
+
+        pages = self.map_concurrently(self._get_cached_account_page, cursors)
+
+        # keep pages up to the first one whose successor isn't the cached one
+        valid = 1
+        while (
+            valid < len(pages)
+            and pages[valid] is not None
+            and pages[valid - 1][1] == cursors[valid]
+        ):
+            valid += 1
+        pages, cursors = pages[:valid], cursors[:valid]
+
+        next_cursor = pages[-1][1]
+        while next_cursor is not None:
+            cursors.append(next_cursor)
+            pages.append(self._get_account_page(next_cursor))
+            next_cursor = pages[-1][1]
+
+        if self.cursor_cache is not None:
+            try:
+                self.cursor_cache.save({"cursors": cursors[1:]})
+            except OSError as oe:
+                self.logger.warning(f"Unable to cache account cursors - {oe}")
+
+        return [accounts for accounts, _ in pages]
+
+    def _get_cached_account_page(
+        self, starting_after: Optional[str]
+    ) -> Optional[Tuple[List, Optional[str]]]:
+        try:
+            return self._get_account_page(starting_after)
+        except Exception as e:
+            # a cached cursor may be an account that's since been deleted
+            if starting_after is None:
+                raise
+            self.logger.debug(f"Ignoring cached cursor {starting_after} - {e}")
+            return None
+
+    def _get_account_page(
+        self, starting_after: Optional[str]
+    ) -> Tuple[List, Optional[str]]:
+        """
+        :return: A page's accounts, and the cursor of the page after it, if any
+        :rtype: Tuple[List, Optional[str]]
+        """
+
+        accounts = self.coinbase_client.get_accounts(
+            limit=self.PAGE_SIZE, starting_after=starting_after
+        )
+        return accounts.data, accounts.pagination.next_starting_after
+
+    @staticmethod
+    def _get_native_holding(acct) -> Holding:
+        return fiat_holding(
+            Decimal(acct.native_balance.amount), acct.native_balance.currency
+        )
@@ -1,65 +1,190 @@
 import logging
-import time
-from typing import Dict
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Set
 
 import cbpro
-from pycoingecko import CoinGeckoAPI
 
+from .cache import HeldAssetCache
 from .institution import Institution
+from .price_oracle import get_price_oracle
+from .transport import Transport
+from .valuation import Holding, fiat_holding
 
 
 class CoinbaseProInstitution(Institution):
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
-        super(type(self), self).__init__(type_name, name, config, logger)
-
-        self.COIN_NAME_REPLACEMENTS = {
-            "avalanche": "avalanche-2",
-            "ether": "ethereum",
-            "polygon": "matic-network",
-        }
+    REQUIRED_CONFIG = {"api_key": str, "api_secret": str, "passphrase": str}
+    OPTIONAL_CONFIG = {"metadata_ttl": (int, float)}
+
+    # Coinbase Pro's currency list and the CoinGecko ID of each currency
+    # rarely change, so they're cached on disk, along with each API key's
+    # coins (so they can be priced with everything else, up front).
+    # Bump the version whenever the cached metadata changes shape.
+    METADATA_VERSION = 2
+    DEFAULT_METADATA_TTL = 7 * 24 * 60 * 60
+
+    # CoinGecko IDs that can't be derived from Coinbase Pro's currency names
+    COIN_NAME_REPLACEMENTS = {
+        "avalanche": "avalanche-2",
+        "ether": "ethereum",
+        "polygon": "matic-network",
+    }
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
+        super(type(self), self).__init__(type_name, name, config, logger, transport)
+
+        self.metadata_ttl = config.get("metadata_ttl", self.DEFAULT_METADATA_TTL)
 
         self.cb_pro_client = cbpro.AuthenticatedClient(
             config["api_key"], config["api_secret"], config["passphrase"]
         )
-        self.coin_gecko = CoinGeckoAPI()
+        self.transport.mount(self.cb_pro_client.session)
+
+    @classmethod
+    def get_metadata_cache(
+        cls, logger: Optional[logging.Logger] = None
+    ) -> HeldAssetCache:
+        return HeldAssetCache(
+            "coinbase_pro_metadata.json", cls.METADATA_VERSION, logger
+        )
 
-    def get_balance(self) -> float:
-        total = 0
+    @staticmethod
+    def get_key_id(config: Dict) -> str:
+        return HeldAssetCache.get_account_id(config["api_key"])
 
-        # Get ready to convert tickers to names,
-        # so we can ask coingecko for the price
-        ticker_lookup = dict()
-        currencies = self.cb_pro_client.get_currencies()
-        for currency in currencies:
-            ticker_lookup[currency["id"]] = currency["name"].lower().replace(" ", "-")
+    @classmethod
+    def get_coin_ids(cls, config: Dict) -> Set[str]:
+        # the coins held last time, so they're priced in the up-front batch
+        return cls.get_metadata_cache().get_held(cls.get_key_id(config))
 
-        accounts = self.cb_pro_client.get_accounts()
-        for acct in accounts:
+    def get_holdings(self) -> List[Holding]:
+        # eveything (except bools?) is a string!
+        balances: Dict[str, Decimal] = dict()
+        for acct in self.cb_pro_client.get_accounts():
             # note that we could also use the "available" field if we wanted to
-
-            # eveything (except bools?) is a string!
-            balance = float(acct["balance"])
+            balance = Decimal(acct["balance"])
             if balance > 0:
-                # acct has the coin's ticker, and coingecko wants the name
-                # eg BTC -> bitcoin
-                # TODO could operate on all coin IDs instead of one at a time
-
-                coin_name = ticker_lookup[acct["currency"]]
-
-                # See if we have a hard-coded re-name for this currency
-                # by default, stick to the current name
-                coin_name = self.COIN_NAME_REPLACEMENTS.get(coin_name, coin_name)
-
-                # here's to hoping there aren't any other odd cases like this
-                if coin_name == "united-states-dollar":
-                    usd_rate = 1
+                balances[acct["currency"]] = (
+                    balances.get(acct["currency"], Decimal(0)) + balance
+                )
+
+        currencies = self.get_currency_metadata(balances)
+
+        holdings = list()
+        for ticker, balance in balances.items():
+            currency = currencies[ticker]
+            if currency["fiat"]:
+                holdings.append(fiat_holding(balance, ticker))
+            elif currency["coin_id"] is not None:
+                holdings.append(Holding(currency["coin_id"], balance))
+            else:
+                # CoinGecko doesn't know the coin, so fall back to the exchange's price
+                holdings.append(fiat_holding(balance * self.get_ticker_price(ticker)))
+
+        self.get_metadata_cache(self.logger).save_held(
+            self.get_key_id(self.config),
+            {holding.asset for holding in holdings if not holding.fiat},
+        )
+        return holdings
+
+    def get_currency_metadata(self, tickers: Iterable[str]) -> Dict[str, Dict]:
+        """
+        :param tickers: The tickers that need metadata, eg. ["BTC"]
+        :type tickers: Iterable[str]
+        :return: A mapping of every currency's ticker to its metadata -
+            its CoinGecko ID (None if CoinGecko doesn't list it)
+            and whether it's fiat - refreshed if any ticker is missing
+            or the cache is older than metadata_ttl
+        :rtype: Dict[str, Dict]
+        """
+
+        cache = self.get_metadata_cache(self.logger)
+        with cache.lock:
+            currencies = cache.load_fresh(self.metadata_ttl)
+            if currencies is not None and all(
+                ticker in currencies for ticker in tickers
+            ):
+                return currencies
+
+            self.logger.debug("Refreshing Coinbase Pro's currency metadata")
+            currencies = self.fetch_currency_metadata()
+            missing = set(tickers) - currencies.keys()
+            if missing:
+                raise Exception(f"Unknown Coinbase Pro currencies: {sorted(missing)}")
+
+            cache.save_metadata(currencies)
+
+        return currencies
+
+    def fetch_currency_metadata(self) -> Dict[str, Dict]:
+        """
+        Maps every Coinbase Pro currency to a CoinGecko ID - the ID derived
+        from its name if CoinGecko lists it (eg. "Bitcoin" -> "bitcoin"),
+        otherwise the coin CoinGecko lists with the same ticker and name,
+        or the only coin with the same ticker
+
+        :return: A mapping of ticker to its metadata
+        :rtype: Dict[str, Dict]
+        """
+
+        try:
+            coins = get_price_oracle().get_coins_list()
+        except Exception as e:
+            # assume names map onto IDs, as they usually do
+            self.logger.warning(f"Unable to list CoinGecko's coins - {e}")
+            coins = None
+
+        coin_ids = {coin["id"] for coin in coins or list()}
+        coins_by_symbol: Dict[str, List[Dict]] = dict()
+        for coin in coins or list():
+            coins_by_symbol.setdefault(coin["symbol"].lower(), list()).append(coin)
+
+        currencies = dict()
+        for currency in self.cb_pro_client.get_currencies():
+            name = currency["name"].lower().replace(" ", "-")
+            coin_id = self.COIN_NAME_REPLACEMENTS.get(name, name)
+            details = currency.get("details") or dict()
+            fiat = details.get("type") == "fiat" or coin_id == "united-states-dollar"
+
+            if coins is not None and coin_id not in coin_ids:
+                candidates = coins_by_symbol.get(currency["id"].lower(), list())
+                named = [
+                    coin
+                    for coin in candidates
+                    if coin["name"].lower() == currency["name"].lower()
+                ]
+                if named:
+                    coin_id = named[0]["id"]
+                elif len(candidates) == 1:
+                    coin_id = candidates[0]["id"]
                 else:
-                    usd_rate = self.coin_gecko.get_price(coin_name, "usd")[coin_name][
-                        "usd"
-                    ]
-
-                total += balance * usd_rate
-
-                time.sleep(1)  # Let's not hit CG's rate limit
-
-        return round(total, 2)
+                    coin_id = None
+
+            currencies[currency["id"]] = {
+                "coin_id": None if fiat else coin_id,
+                "fiat": fiat,
+            }
+
+        return currencies
+
+    def get_ticker_price(self, ticker: str) -> Decimal:
+        """
+        :param ticker: A coin's ticker, eg. "BTC"
+        :type ticker: str
+        :return: The coin's last traded price on Coinbase Pro, in USD
+        :rtype: Decimal
+        """
+
+        res = self.cb_pro_client.get_product_ticker(f"{ticker}-USD")
+        if "price" not in res:
+            raise Exception(
+                f"Unable to price {ticker} - {res.get('message', 'no USD market')}"
+            )
+
+        return Decimal(res["price"])
@@ -1,10 +1,11 @@
 import logging
-from time import sleep
-from typing import Dict
+from typing import Dict, Hashable, List, Optional, Union
 
 import requests
 
 from .institution import Institution
+from .session_cache import get_session_cache
+from .transport import Transport
 
 
 def err_check(res: requests.models.Response) -> None:
@@ -32,8 +33,17 @@ def err_check(res: requests.models.Response) -> None:
 
 
 class DiscoverBankInstitution(Institution):
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
-        super(type(self), self).__init__(type_name, name, config, logger)
+    REQUIRED_CONFIG = {"api_key": str, "account_id": (str, int)}
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
+        super(type(self), self).__init__(type_name, name, config, logger, transport)
         self.name = name
         self.config = config
 
@@ -41,13 +51,46 @@ class DiscoverBankInstitution(Institution):
             "https://mapi.discovercard.com/cardsvcs/acs/quickview/v4/view"
         )
 
-        self.api_session = requests.Session()
+        self.api_session = self.transport.new_session()
         self.api_session.hooks = {"response": lambda r, *args, **kwargs: err_check(r)}
 
+        # Discover has no login, but its cookies are reused, as the app does
+        self.session_cache = get_session_cache()
+        self.session_cache.restore(
+            self.api_session, type(self).__name__, config["api_key"], config["api_key"]
+        )
+
         self.APP_VERSION = "2112.0"
         self.MAX_RETRIES = 5
 
+    @classmethod
+    def get_group_key(cls, config: Dict) -> Hashable:
+        # one quickview request returns every account behind an API key
+        return config["api_key"]
+
     def get_balance(self) -> float:
+        return self.find_balance(self.get_bank_accounts(), self.config)
+
+    def get_balances(self, configs: List[Dict]) -> Dict[str, Union[float, Exception]]:
+        bank_accounts = self.get_bank_accounts()
+
+        balances = dict()
+        for config in configs:
+            try:
+                balances[config["name"]] = self.find_balance(bank_accounts, config)
+            except Exception as e:
+                balances[config["name"]] = e
+
+        return balances
+
+    def get_bank_accounts(self) -> List[Dict]:
+        """
+        Fetches every bank account tied to this column's API key
+
+        :return: The "bankAccount" list from a quickview response
+        :rtype: List[Dict]
+        """
+
         headers = {
             "Host": "mapi.discovercard.com",
             "X-Client-Platform": "Android",
@@ -67,27 +110,41 @@ class DiscoverBankInstitution(Institution):
             "getCardImage": True,
         }
 
-        account_not_found = False
         last_exception = None
         for attempt in range(self.MAX_RETRIES):
             try:
+                cookies = self.api_session.cookies.get_dict()
                 res = self.api_session.post(
                     self.QUICK_VIEW_URL, json=data, headers=headers
                 )
-                for acct in res.json()["bankDetails"]["bankAccount"]:
-                    if acct["id"] == self.config["account_id"]:
-                        return round(float(acct["availableBalance"]["value"]), 2)
+                bank_accounts = res.json()["bankDetails"]["bankAccount"]
 
-                account_not_found = True
-                break
+                if self.api_session.cookies.get_dict() != cookies:
+                    self.session_cache.store(
+                        self.api_session,
+                        type(self).__name__,
+                        self.config["api_key"],
+                        self.config["api_key"],
+                    )
+                return bank_accounts
 
             except BaseException as be:
                 last_exception = be
-                sleep(5)
+                # the next attempt waits until the host's backoff expires
+                self.transport.back_off(self.QUICK_VIEW_URL, attempt)
                 continue
 
         # Raise any exception after we hit the retry timer
-        if account_not_found:
-            raise Exception(f'Account of id "{self.config["account_id"]}" not found')
-        elif last_exception:
-            raise last_exception
+        raise last_exception
+
+    def refresh_session(self) -> None:
+        self.api_session.cookies.clear()
+        self.session_cache.clear(type(self).__name__, self.config["api_key"])
+
+    @staticmethod
+    def find_balance(bank_accounts: List[Dict], config: Dict) -> float:
+        for acct in bank_accounts:
+            if acct["id"] == config["account_id"]:
+                return round(float(acct["availableBalance"]["value"]), 2)
+
+        raise Exception(f'Account of id "{config["account_id"]}" not found')
@@ -1,29 +1,280 @@
+import json
 import logging
-from typing import Dict
-
-import requests
-from pycoingecko import CoinGeckoAPI
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+from .cache import HeldAssetCache
+from .chain_backends import EthereumJsonRpcBackend, create_backend
 from .institution import Institution
+from .price_oracle import get_price_oracle
+from .transport import Transport
+from .valuation import Holding, fiat_holding, to_decimal
+
+# a token's (contract, quantity, ethplorer's USD rate - if it has one)
+TokenBalance = Tuple[str, Decimal, Optional[Decimal]]
 
 
 class EthereumInstitution(Institution):
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
-        super(type(self), self).__init__(type_name, name, config, logger)
+    COIN_ID = "ethereum"
+    REQUIRED_CONFIG = {"wallet_addrs": list}
+    OPTIONAL_CONFIG = {
+        "address_recheck_interval": (int, float),
+        "backend": {"type": str, "url": str},
+        "tokens": bool,
+        "token_dust_value": (int, float),
+        "metadata_ttl": (int, float),
+    }
+    BACKEND_TYPES = {"json-rpc": EthereumJsonRpcBackend}
+
+    # CoinGecko's platform for ERC-20 token contracts
+    PLATFORM = "ethereum"
+
+    # The CoinGecko ID of every token contract rarely changes, so the map is
+    # cached on disk, along with each wallet's tokens (so they can be priced
+    # with everything else, up front).
+    # Bump the version whenever the cached metadata changes shape.
+    TOKEN_METADATA_VERSION = 2
+    DEFAULT_METADATA_TTL = 7 * 24 * 60 * 60
+
+    # tokens worth less than this, in USD, are left out
+    DEFAULT_TOKEN_DUST_VALUE = 1
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
+        super(type(self), self).__init__(type_name, name, config, logger, transport)
         self.name = name
         self.config = config
+        self.backend = create_backend(
+            config.get("backend"), self.BACKEND_TYPES, self.transport
+        )
+
+        self.metadata_ttl = config.get("metadata_ttl", self.DEFAULT_METADATA_TTL)
+        self.token_dust_value = to_decimal(
+            config.get("token_dust_value", self.DEFAULT_TOKEN_DUST_VALUE)
+        )
 
         self.ADDRESS_BALANCE_URL = "https://ethplorer.io/service/service.php"
-        self.current_exchange_rate = CoinGeckoAPI().get_price("ethereum", "usd")[
-            "ethereum"
-        ]["usd"]
-
-    def get_balance(self) -> float:
-        total = 0
-        for wallet_addr in self.config.get("wallet_addrs", list()):
-            res = requests.get(
-                self.ADDRESS_BALANCE_URL, params={"data": wallet_addr}
-            ).json()
-            total += res["balance"] * self.current_exchange_rate
-
-        return round(total, 2)
+
+    @classmethod
+    def get_token_metadata_cache(
+        cls, logger: Optional[logging.Logger] = None
+    ) -> HeldAssetCache:
+        return HeldAssetCache(
+            "ethereum_tokens.json", cls.TOKEN_METADATA_VERSION, logger
+        )
+
+    @staticmethod
+    def get_wallet_id(config: Dict) -> str:
+        return HeldAssetCache.get_account_id(
+            *sorted(addr.lower() for addr in config.get("wallet_addrs", list()))
+        )
+
+    @classmethod
+    def get_coin_ids(cls, config: Dict) -> Set[str]:
+        if not config.get("tokens", True):
+            return {cls.COIN_ID}
+
+        # the tokens held last time, so they're priced in the up-front batch
+        return {
+            cls.COIN_ID,
+            *cls.get_token_metadata_cache().get_held(cls.get_wallet_id(config)),
+        }
+
+    def get_holdings(self) -> List[Holding]:
+        wallet_addrs = self.config.get("wallet_addrs", list())
+        include_tokens = self.config.get("tokens", True)
+
+        # each address' explorer response, which lists its tokens too
+        responses: Dict[str, Dict] = dict()
+
+        def fetch(addrs: List[str]) -> Dict[str, Decimal]:
+            responses[addrs[0]] = self._get_address_info(addrs[0])
+            # parsed as a Decimal, so no precision is lost to a float
+            return {addrs[0]: Decimal(str(responses[addrs[0]]["balance"]))}
+
+        def get_details(addrs: List[str]) -> Dict[str, str]:
+            # addresses whose balances came from a backend
+            # still need the explorer for their tokens
+            unfetched = [addr for addr in addrs if addr not in responses]
+            responses.update(
+                zip(unfetched, self.map_concurrently(self._get_address_info, unfetched))
+            )
+            return {
+                addr: self._dump_token_balances(
+                    self._get_token_balances(responses[addr])
+                )
+                for addr in addrs
+            }
+
+        # tokens are cached (and skipped) along with each address' ETH balance
+        states = self.map_address_states(
+            fetch, wallet_addrs, get_details=get_details if include_tokens else None
+        )
+        holdings = [
+            Holding(
+                self.COIN_ID,
+                sum((Decimal(state.balance) for state in states.values()), Decimal(0)),
+            )
+        ]
+
+        if include_tokens:
+            holdings.extend(
+                self.get_token_holdings(
+                    self._load_token_balances(state.details)
+                    for addr, state in states.items()
+                    if addr is not None
+                )
+            )
+
+        return holdings
+
+    def _get_address_info(self, wallet_addr: str) -> Dict:
+        """
+        :param wallet_addr: An ETH address
+        :type wallet_addr: str
+        :return: ethplorer's summary of the address - its "balance", in ETH,
+            its token "balances" (each token's contract and balance, in the
+            token's smallest unit) and the "tokens" they're of (each token's
+            "decimals" and, if ethplorer prices it, its USD "price" rate)
+        :rtype: Dict
+        """
+
+        res = self.transport.get(self.ADDRESS_BALANCE_URL, params={"data": wallet_addr})
+        return res.json(parse_float=Decimal)
+
+    def get_token_holdings(
+        self, token_balances: Iterable[List[TokenBalance]]
+    ) -> List[Holding]:
+        """
+        Sums the tokens the addresses hold.
+        Tokens CoinGecko lists are priced together in one request
+        (or up front, with everything else), and any others at ethplorer's rate -
+        tokens priced at neither, or worth less than token_dust_value, are left out
+
+        :param token_balances: Each address' token balances
+        :type token_balances: Iterable[List[TokenBalance]]
+        :return: The tokens' holdings
+        :rtype: List[Holding]
+        """
+
+        # contract -> (quantity, ethplorer's USD rate)
+        tokens: Dict[str, Tuple[Decimal, Optional[Decimal]]] = dict()
+        for balances in token_balances:
+            for contract, quantity, rate in balances:
+                held = tokens.get(contract, (Decimal(0), None))[0]
+                tokens[contract] = (held + quantity, rate)
+
+        coin_ids = self.get_contract_coin_ids() if tokens else dict()
+        listed = {coin_ids[contract] for contract in tokens if contract in coin_ids}
+        prices = {
+            coin_id: to_decimal(price)
+            for coin_id, price in get_price_oracle()
+            .get_prices(listed, require_all=False)
+            .items()
+        }
+
+        holdings = list()
+        for contract, (quantity, rate) in sorted(tokens.items()):
+            coin_id = coin_ids.get(contract)
+            price = prices.get(coin_id, rate)
+            if price is None:
+                self.logger.debug(f"Ignoring unpriced token {contract}")
+            elif quantity * price < self.token_dust_value:
+                self.logger.debug(f"Ignoring dust token {contract}")
+            elif coin_id in prices:
+                holdings.append(Holding(coin_id, quantity))
+            else:
+                # CoinGecko doesn't know the token, so fall back to ethplorer's price
+                holdings.append(fiat_holding(quantity * price))
+
+        self.get_token_metadata_cache(self.logger).save_held(
+            self.get_wallet_id(self.config),
+            {holding.asset for holding in holdings if not holding.fiat},
+        )
+        return holdings
+
+    @staticmethod
+    def _get_token_balances(response: Dict) -> List[TokenBalance]:
+        """
+        :param response: An address' explorer response
+        :type response: Dict
+        :return: The (contract, quantity, ethplorer's USD rate - if it has one)
+            of every token the address holds, with contracts in lower case
+        :rtype: List[TokenBalance]
+        """
+
+        token_infos = {
+            contract.lower(): token_info
+            for contract, token_info in (response.get("tokens") or dict()).items()
+        }
+
+        balances = list()
+        for balance in response.get("balances") or list():
+            contract = balance["contract"].lower()
+            token_info = token_infos.get(contract, dict())
+
+            quantity = Decimal(str(balance["balance"])).scaleb(
+                -int(token_info.get("decimals") or 0)
+            )
+            if quantity <= 0:
+                continue
+
+            # false for tokens ethplorer doesn't price
+            price = token_info.get("price")
+            rate = (
+                Decimal(str(price["rate"]))
+                if isinstance(price, dict) and price.get("rate")
+                else None
+            )
+            balances.append((contract, quantity, rate))
+
+        return balances
+
+    @staticmethod
+    def _dump_token_balances(balances: List[TokenBalance]) -> str:
+        # an address' details, in the address state cache
+        return json.dumps(
+            [
+                [contract, str(quantity), None if rate is None else str(rate)]
+                for contract, quantity, rate in balances
+            ]
+        )
+
+    @staticmethod
+    def _load_token_balances(details: Optional[str]) -> List[TokenBalance]:
+        return [
+            (contract, Decimal(quantity), None if rate is None else Decimal(rate))
+            for contract, quantity, rate in json.loads(details or "[]")
+        ]
+
+    def get_contract_coin_ids(self) -> Dict[str, str]:
+        """
+        :return: A mapping of every token contract CoinGecko lists,
+            in lower case, to its coin ID - refreshed if the cache is older
+            than metadata_ttl
+        :rtype: Dict[str, str]
+        """
+
+        cache = self.get_token_metadata_cache(self.logger)
+        with cache.lock:
+            contracts = cache.load_fresh(self.metadata_ttl)
+            if contracts is not None:
+                return contracts
+
+            self.logger.debug("Refreshing CoinGecko's token contracts")
+            try:
+                contracts = get_price_oracle().get_token_contracts(self.PLATFORM)
+            except Exception as e:
+                # tokens are still priced by ethplorer
+                self.logger.warning(f"Unable to list CoinGecko's token contracts - {e}")
+                return cache.load_metadata()
+
+            cache.save_metadata(contracts)
+
+        return contracts
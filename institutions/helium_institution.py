@@ -1,32 +1,47 @@
 import logging
-from typing import Dict
-
-import requests
-from pycoingecko import CoinGeckoAPI
+from decimal import Decimal
+from typing import Dict, List, Optional
 
 from .institution import Institution
+from .transport import Transport
+from .valuation import Holding
 
 
 class HeliumInstitution(Institution):
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
-        super(type(self), self).__init__(type_name, name, config, logger)
+    COIN_ID = "helium"
+    REQUIRED_CONFIG = {"wallet_addrs": list}
+    OPTIONAL_CONFIG = {"address_recheck_interval": (int, float)}
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
+        super(type(self), self).__init__(type_name, name, config, logger, transport)
         self.name = name
         self.config = config
 
         self.HELIUM_API_URL = "https://api.helium.io"
 
-        self.current_exchange_rate = CoinGeckoAPI().get_price("helium", "usd")[
-            "helium"
-        ]["usd"]
-
-    def get_balance(self) -> float:
-        total = 0
-        for wallet_addr in self.config.get("wallet_addrs", list()):
-            res = requests.get(
-                f"{self.HELIUM_API_URL}/v1/accounts/{wallet_addr}"
-            ).json()
-
-            # for some reason, I guess we use 10**8 representation of HNT?
-            total += (res["data"]["balance"] * 10 ** -8) * self.current_exchange_rate
-
-        return round(total, 2)
+    def get_holdings(self) -> List[Holding]:
+        balances = self.map_addresses(
+            lambda addrs: {addrs[0]: self._get_address_balance(addrs[0])},
+            self.config.get("wallet_addrs", list()),
+        ).values()
+
+        # for some reason, I guess we use 10**8 representation of HNT?
+        return [Holding(self.COIN_ID, Decimal(sum(balances)).scaleb(-8))]
+
+    def _get_address_balance(self, wallet_addr: str) -> int:
+        """
+        :param wallet_addr: An HNT address
+        :type wallet_addr: str
+        :return: The address' balance, in 10**-8 HNT
+        :rtype: int
+        """
+
+        res = self.transport.get(f"{self.HELIUM_API_URL}/v1/accounts/{wallet_addr}")
+        return res.json()["data"]["balance"]
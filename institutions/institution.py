@@ -1,5 +1,17 @@
+import asyncio
 import logging
-from typing import Dict, Set
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from functools import lru_cache
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple, Union
+
+from .address_state import AddressState, get_address_state_cache
+from .chain_backends import ChainBackend
+from .instrumentation import run_in_context
+from .registry import load_institution_class
+from .transport import Transport, get_transport
+from .valuation import Holding, fiat_holding, get_valuator
 
 
 class Institution:
@@ -9,36 +21,522 @@ class Institution:
     based on the name parameter passed in with it.
     If no Institution exists with the provided classname,
     an AttributeError is thrown.
+
+    Subclasses implement either get_holdings(), reporting the quantity of
+    each asset they hold (and leaving the pricing to the shared Valuator),
+    or get_balance(), reporting a USD balance directly.
     """
 
-    def __new__(cls, type_name: str, name: str, config: Dict, logger: logging.Logger):
+    # The CoinGecko ID of the coin this institution holds, if any.
+    # Declaring it lets the shared PriceOracle batch every column's price
+    # lookups into one request before any balances are fetched.
+    COIN_ID: Optional[str] = None
 
-        if cls.__name__ != "Institution":
-            return super(Institution, cls).__new__(cls)
+    # The column configuration keys this institution requires, and their types
+    # (or, for nested objects, their own required keys) - every column is
+    # checked against them by the config loader, before any are constructed
+    REQUIRED_CONFIG: Dict = dict()
+    # As REQUIRED_CONFIG, for keys that may be left out
+    OPTIONAL_CONFIG: Dict = dict()
+
+    # Wallet institutions whose column configures a "backend" - eg. a local node -
+    # ask it for addresses' balances (and the chain's height) instead of
+    # their public explorer, falling back to the explorer if it fails
+    backend: Optional[ChainBackend] = None
 
-        subclasses = all_subclasses(Institution)
-        for class_obj in subclasses:
-            if class_obj.__name__ == type_name:
-                return class_obj(type_name, name, config, logger)
+    # The default number of threads used by map_concurrently().
+    # Per-host limits are enforced by the shared Transport,
+    # so this only needs to be large enough to saturate them.
+    DEFAULT_MAX_WORKERS = 8
 
-        # TODO raise a custom exception here so we can address it
-        raise AttributeError("Invalid class name")
+    def __new__(
+        cls,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
 
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
+        if cls is not Institution:
+            return super(Institution, cls).__new__(cls)
+
+        # Return an uninitialized instance of the subclass -
+        # python then calls its __init__ exactly once
+        return super(Institution, cls).__new__(get_institution_class(type_name))
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
         self.name = name
         self.config = config
         self.logger = logger
 
-    def get_balance(self) -> int:
+        # all HTTP traffic should go through the shared transport,
+        # which handles connection pooling, rate limits and backoff
+        self.transport = transport or get_transport()
+
+    def get_balance(self) -> float:
+        """
+        Given a valid configuration in __init__,
+        return the balance (in USD) for this institution's account.
+        By default, this values get_holdings() in USD.
+
+        :return: The USD balance of the account
+        :rtype: float
+        """
+
+        if not self._implements("get_holdings"):
+            raise NotImplementedError()
+
+        return float(get_valuator().value(self.get_holdings(), ["usd"])["usd"])
+
+    def get_holdings(self) -> List[Holding]:
         """
         Given a valid configuration in __init__,
-        return the balance (in USD) for this institution's account
+        return the assets held in this institution's account,
+        in their own units (eg. BTC, not USD).
+        By default, this is get_balance() as a USD holding.
+
+        :return: The account's holdings
+        :rtype: List[Holding]
+        """
+
+        if not self._implements("get_balance"):
+            raise NotImplementedError()
+
+        return [fiat_holding(self.get_balance())]
+
+    def _implements(self, method_name: str) -> bool:
+        """
+        :return: Whether this institution's class overrides the given method
+        :rtype: bool
+        """
+
+        return getattr(type(self), method_name) is not getattr(Institution, method_name)
+
+    async def get_balance_async(self) -> float:
+        """
+        Asynchronous version of get_balance().
+
+        By default, this runs get_balance() on the event loop's executor.
+        Institutions backed by an async client can override this
+        to avoid tying up a worker thread.
 
         :return: The USD balance of the account
         :rtype: float
         """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, run_in_context(self.get_balance))
+
+    async def get_holdings_async(self) -> List[Holding]:
+        """
+        Asynchronous version of get_holdings().
+
+        Institutions that only implement get_balance_async natively
+        are awaited directly, and their balance reported as a USD holding.
+
+        :return: The account's holdings
+        :rtype: List[Holding]
+        """
+
+        if not self._implements("get_holdings") and self._implements(
+            "get_balance_async"
+        ):
+            return [fiat_holding(await self.get_balance_async())]
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, run_in_context(self.get_holdings))
+
+    @classmethod
+    def get_group_key(cls, config: Dict) -> Optional[Hashable]:
+        """
+        Columns of this type that share a (non-None) group key are served
+        by a single instance, with one call to get_balances() -
+        eg. several accounts behind the same login.
+        By default, every column is fetched on its own.
+
+        :param config: The column's configuration
+        :type config: Dict
+        :return: The column's group key, or None if it can't be grouped
+        :rtype: Optional[Hashable]
+        """
+
+        return None
+
+    def get_balances(self, configs: List[Dict]) -> Dict[str, Union[float, Exception]]:
+        """
+        Given the configurations of every column in this instance's group
+        (including its own), return all of their balances,
+        ideally with a single request
+
+        :param configs: The configurations of the group's columns
+        :type configs: List[Dict]
+        :return: A mapping of column name to its USD balance,
+            or to the exception raised while finding it
+        :rtype: Dict[str, Union[float, Exception]]
+        """
         raise NotImplementedError()
 
+    async def get_balances_async(
+        self, configs: List[Dict]
+    ) -> Dict[str, Union[float, Exception]]:
+        """
+        Asynchronous version of get_balances(), which by default
+        runs it on the event loop's executor
+
+        :param configs: The configurations of the group's columns
+        :type configs: List[Dict]
+        :return: A mapping of column name to its USD balance,
+            or to the exception raised while finding it
+        :rtype: Dict[str, Union[float, Exception]]
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, run_in_context(self.get_balances, configs)
+        )
+
+    async def get_holdings_many_async(
+        self, configs: List[Dict]
+    ) -> Dict[str, Union[List[Holding], Exception]]:
+        """
+        The holdings of every column in this instance's group -
+        their get_balances_async() results, as USD holdings
+
+        :param configs: The configurations of the group's columns
+        :type configs: List[Dict]
+        :return: A mapping of column name to its holdings,
+            or to the exception raised while finding them
+        :rtype: Dict[str, Union[List[Holding], Exception]]
+        """
+
+        return {
+            name: balance if isinstance(balance, Exception) else [fiat_holding(balance)]
+            for name, balance in (await self.get_balances_async(configs)).items()
+        }
+
+    def get_historical_holdings(
+        self, timestamps: List[float]
+    ) -> Dict[float, List[Holding]]:
+        """
+        Given a valid configuration in __init__,
+        return the assets held in this institution's account at each of
+        several past times, ideally with as few requests as possible.
+        Only institutions that can look up their history support backfills.
+
+        :param timestamps: The times to find the holdings at, in seconds since the epoch
+        :type timestamps: List[float]
+        :return: A mapping of each timestamp to the account's holdings at that time
+        :rtype: Dict[float, List[Holding]]
+        """
+
+        raise NotImplementedError(
+            f"{type(self).__name__} doesn't support historical balances"
+        )
+
+    def get_historical_holdings_many(
+        self, configs: List[Dict], timestamps: List[float]
+    ) -> Dict[str, Union[Dict[float, List[Holding]], Exception]]:
+        """
+        The grouped version of get_historical_holdings(), as get_balances()
+        is to get_balance()
+
+        :param configs: The configurations of the group's columns
+        :type configs: List[Dict]
+        :param timestamps: The times to find the holdings at, in seconds since the epoch
+        :type timestamps: List[float]
+        :return: A mapping of column name to its holdings at each time,
+            or to the exception raised while finding them
+        :rtype: Dict[str, Union[Dict[float, List[Holding]], Exception]]
+        """
+
+        raise NotImplementedError(
+            f"{type(self).__name__} doesn't support historical balances"
+        )
+
+    def refresh_session(self) -> None:
+        """
+        Re-authenticates with the institution, for long-lived instances
+        whose session has expired. Institutions that log in should override this.
+
+        :rtype: None
+        """
+
+    @staticmethod
+    def is_auth_error(exception: BaseException) -> bool:
+        """
+        :param exception: An exception raised by get_balance()
+        :type exception: BaseException
+        :return: Whether the exception means this institution's session
+            has expired (HTTP 401 or 403), and refresh_session() may fix it
+        :rtype: bool
+        """
+
+        response = getattr(exception, "response", None)
+        status_code = getattr(response, "status_code", None) or getattr(
+            exception, "status_code", None
+        )
+        return status_code in (401, 403)
+
+    def call_with_refresh(self, func: Callable, *args):
+        """
+        Calls func(*args), and if it fails with an auth error -
+        eg. because a session restored from the SessionCache has been revoked
+        before it was due to expire - refreshes the session and calls it again
+
+        :param func: A function making authenticated requests
+        :type func: Callable
+        :return: func's result
+        """
+
+        try:
+            return func(*args)
+        except Exception as e:
+            if not self.is_auth_error(e):
+                raise
+
+        self.logger.info(f"{self.name}'s session was rejected, logging in again")
+        self.refresh_session()
+        return func(*args)
+
+    def map_concurrently(self, func: Callable, items: Iterable) -> List:
+        """
+        Applies func to every item concurrently, eg. to look up many wallet
+        addresses at once. The number of threads can be set with the column's
+        "max_workers" config value.
+
+        :param func: A function taking a single item
+        :type func: Callable
+        :param items: The items to apply func to
+        :type items: Iterable
+        :return: The results of func, in the same order as items
+        :rtype: List
+        """
+
+        items = list(items)
+        if len(items) <= 1:
+            return [func(item) for item in items]
+
+        max_workers = min(
+            len(items), self.config.get("max_workers", self.DEFAULT_MAX_WORKERS)
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # each worker keeps the caller's context, eg. for instrumentation
+            futures = [executor.submit(run_in_context(func, item)) for item in items]
+            return [future.result() for future in futures]
+
+    def get_chain_height(self) -> Optional[int]:
+        """
+        Wallet institutions whose chain can cheaply report its height
+        (ie. with one request, rather than one per address) should override this.
+        While the height hasn't changed, no address' balance can have either.
+
+        :return: The chain's current height, if it can be found cheaply
+        :rtype: Optional[int]
+        """
+
+        return None
+
+    def map_addresses(
+        self,
+        fetch: Callable[[List[str]], Dict[Optional[str], Union[int, Decimal]]],
+        wallet_addrs: List[str],
+        batch_size: int = 1,
+    ) -> Dict[Optional[str], Decimal]:
+        """
+        Fetches the balances of many wallet addresses, concurrently,
+        skipping any whose last seen balance (from the AddressStateCache)
+        can't have changed - because the chain's height hasn't changed since,
+        or because it was seen within the column's "address_recheck_interval".
+        If the column has a backend, it's asked instead of fetch.
+
+        :param fetch: A function taking a batch of addresses, and returning
+            a mapping of each address to its balance - and, under None, any
+            balance that couldn't be attributed to a single address
+            (which is returned, but never cached)
+        :type fetch: Callable[[List[str]], Dict[Optional[str], Union[int, Decimal]]]
+        :param wallet_addrs: The addresses
+        :type wallet_addrs: List[str]
+        :param batch_size: The most addresses fetch takes at once
+        :type batch_size: int
+        :return: A mapping of each address to its balance, as fetch returns them
+        :rtype: Dict[Optional[str], Decimal]
+        """
+
+        return {
+            address: Decimal(state.balance)
+            for address, state in self.map_address_states(
+                fetch, wallet_addrs, batch_size
+            ).items()
+        }
+
+    def map_address_states(
+        self,
+        fetch: Callable[[List[str]], Dict[Optional[str], Union[int, Decimal]]],
+        wallet_addrs: List[str],
+        batch_size: int = 1,
+        get_details: Optional[Callable[[List[str]], Dict[str, str]]] = None,
+    ) -> Dict[Optional[str], AddressState]:
+        """
+        As map_addresses, but returning each address' whole state -
+        including, if get_details is provided, its details, which are cached
+        and skipped along with its balance
+
+        :param fetch: As map_addresses' fetch
+        :type fetch: Callable[[List[str]], Dict[Optional[str], Union[int, Decimal]]]
+        :param wallet_addrs: The addresses
+        :type wallet_addrs: List[str]
+        :param batch_size: The most addresses fetch takes at once
+        :type batch_size: int
+        :param get_details: A function taking the addresses whose balances
+            were just fetched, and returning each one's details
+        :type get_details: Optional[Callable[[List[str]], Dict[str, str]]]
+        :return: A mapping of each address to its state
+        :rtype: Dict[Optional[str], AddressState]
+        """
+
+        with_details = get_details is not None
+        states = None
+        if self.backend is not None:
+            try:
+                states, refreshed = self._map_addresses(
+                    self.backend.get_balances,
+                    self.backend.get_height,
+                    wallet_addrs,
+                    # None sends every address at once
+                    self.backend.BATCH_SIZE or max(len(wallet_addrs), 1),
+                    with_details,
+                )
+            except Exception as e:
+                self.logger.warning(
+                    f"Falling back to the public explorer - {type(self.backend).__name__} "
+                    f"failed - {type(e).__name__}: {str(e)}"
+                )
+
+        if states is None:
+            states, refreshed = self._map_addresses(
+                fetch, self.get_chain_height, wallet_addrs, batch_size, with_details
+            )
+
+        if with_details and refreshed:
+            details = get_details(refreshed)
+            for address in refreshed:
+                states[address] = states[address]._replace(details=details.get(address))
+
+        get_address_state_cache().put(
+            self.COIN_ID, {address: states[address] for address in refreshed}
+        )
+        return states
+
+    def _map_addresses(
+        self,
+        fetch: Callable[[List[str]], Dict[Optional[str], Union[int, Decimal]]],
+        get_height: Callable[[], Optional[int]],
+        wallet_addrs: List[str],
+        batch_size: int,
+        with_details: bool,
+    ) -> Tuple[Dict[Optional[str], AddressState], List[str]]:
+        """
+        :return: Every address' state, and the addresses whose balances
+            were fetched (rather than found in the AddressStateCache)
+        :rtype: Tuple[Dict[Optional[str], AddressState], List[str]]
+        """
+
+        cache = get_address_state_cache()
+        cached = cache.get(self.COIN_ID, wallet_addrs)
+
+        # probed before any balances, so a block found meanwhile is never missed
+        height = None
+        if cache.enabled:
+            try:
+                height = get_height()
+            except Exception as e:
+                self.logger.debug(f"Unable to get the chain's height - {e}")
+
+        now = time.time()
+        recheck_interval = self.config.get("address_recheck_interval", 0)
+        states: Dict[Optional[str], AddressState] = {
+            address: state
+            for address, state in cached.items()
+            if (
+                (height is not None and state.height == height)
+                or now - state.checked_at < recheck_interval
+            )
+            # states cached without details can't answer for them
+            and (state.details is not None or not with_details)
+        }
+
+        stale = [address for address in wallet_addrs if address not in states]
+        if len(stale) < len(wallet_addrs):
+            self.logger.debug(
+                f"{len(wallet_addrs) - len(stale)} of {len(wallet_addrs)} addresses unchanged"
+            )
+
+        unattributed = Decimal(0)
+        refreshed = list()
+        for fetched in self.map_concurrently(
+            fetch,
+            [stale[i : i + batch_size] for i in range(0, len(stale), batch_size)],
+        ):
+            for address, balance in fetched.items():
+                if address is None:
+                    unattributed += Decimal(balance)
+                    continue
+
+                states[address] = AddressState(str(balance), height, now)
+                refreshed.append(address)
+
+        if unattributed:
+            states[None] = AddressState(str(unattributed), height, now)
+
+        return states, refreshed
+
+    @classmethod
+    def get_coin_ids(cls, config: Dict) -> Set[str]:
+        """
+        Given a column's configuration, return the CoinGecko IDs
+        that this institution will need prices for
+
+        :param config: The column's configuration
+        :type config: Dict
+        :return: A set of CoinGecko coin IDs
+        :rtype: Set[str]
+        """
+
+        return {cls.COIN_ID} if cls.COIN_ID else set()
+
+
+@lru_cache(maxsize=None)
+def get_institution_class(type_name: str) -> type:
+    """
+    Returns the Institution subclass with the provided name,
+    importing its module if it hasn't been already
+
+    :param type_name: The class name of an Institution, eg. "BitcoinInstitution"
+    :type type_name: str
+    :return: The matching Institution subclass
+    :rtype: type
+    """
+
+    class_obj = load_institution_class(type_name)
+    if class_obj is not None:
+        return class_obj
+
+    # fall back to subclasses that were imported some other way
+    for class_obj in all_subclasses(Institution):
+        if class_obj.__name__ == type_name:
+            return class_obj
+
+    # TODO raise a custom exception here so we can address it
+    raise AttributeError("Invalid class name")
+
 
 def all_subclasses(cls) -> Set:
     """
@@ -0,0 +1,413 @@
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+# The span and metrics of whatever is running in the current context.
+# Executor calls must copy the context (see run_in_context) to keep these.
+_current_span: contextvars.ContextVar = contextvars.ContextVar(
+    "balance_sheet_gen_span", default=None
+)
+_current_metrics: contextvars.ContextVar = contextvars.ContextVar(
+    "balance_sheet_gen_metrics", default=None
+)
+
+
+class Span:
+    """
+    A timed operation, eg. one column's get_balance call or one HTTP request
+    """
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str] = None,
+        attributes: Optional[Dict] = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or dict())
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+        # the Instrumentation recording this span
+        self.instrumentation: Optional["Instrumentation"] = None
+
+    @property
+    def duration(self) -> float:
+        """
+        :return: The span's duration (so far), in seconds
+        :rtype: float
+        """
+
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def to_otlp(self) -> Dict:
+        """
+        :return: The span in the OpenTelemetry (OTLP) JSON format
+        :rtype: Dict
+        """
+
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 3 if self.name.startswith("HTTP ") else 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or self.start_ns),
+            "attributes": [
+                {"key": key, "value": otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": (
+                {"code": 2, "message": self.error}
+                if self.error is not None
+                else {"code": 1}
+            ),
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+
+        return span
+
+
+def otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class ColumnMetrics:
+    """
+    Everything recorded while fetching one group of columns
+    (usually a single column) - the duration of each lifecycle phase,
+    and the HTTP traffic it caused
+    """
+
+    COUNTERS = [
+        "http_calls",
+        "http_requests",
+        "request_bytes",
+        "response_bytes",
+        "retries",
+        "backoff_seconds",
+        "wait_seconds",
+    ]
+
+    def __init__(self, name: str, type_name: str):
+        self.name = name
+        self.type_name = type_name
+        self.phases: Dict[str, float] = dict()
+        self.counters: Dict[str, float] = {counter: 0 for counter in self.COUNTERS}
+        self.succeeded = True
+
+        self._lock = threading.Lock()
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(self.phases.values())
+
+    def add(self, **counters: float) -> None:
+        """
+        Adds to any of the metrics' counters, eg. add(retries=1)
+
+        :rtype: None
+        """
+
+        with self._lock:
+            for counter, value in counters.items():
+                self.counters[counter] += value
+
+    def add_phase(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+
+class Instrumentation:
+    """
+    Records a trace of a run's spans, and each column's metrics.
+
+    The engine opens a column() around every group of columns, and a phase()
+    around each step of its Institution's lifecycle (__init__, get_balance).
+    Anything running inside them - including HTTP requests sent through
+    the Transport, on any thread the context was copied to -
+    is attributed to that column.
+    """
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.spans: List[Span] = list()
+        self.columns: List[ColumnMetrics] = list()
+
+        self._lock = threading.Lock()
+        self.root = self._start_span("run", None)
+
+    def _start_span(
+        self, name: str, parent: Optional[Span], attributes: Optional[Dict] = None
+    ) -> Span:
+        span = Span(
+            name,
+            self.trace_id,
+            parent.span_id if parent is not None else None,
+            attributes,
+        )
+        span.instrumentation = self
+        self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """
+        Times the enclosed block as a child of the current span
+
+        :param name: The span's name
+        :type name: str
+        """
+
+        parent = _current_span.get() or self.root
+        with self._lock:
+            span = self._start_span(name, parent, attributes)
+
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as be:
+            span.error = f"{type(be).__name__}: {str(be)}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+
+    @contextmanager
+    def column(self, names: List[str], type_name: str) -> Iterator[ColumnMetrics]:
+        """
+        Attributes everything in the enclosed block to a group of columns
+
+        :param names: The names of the columns in the group
+        :type names: List[str]
+        :param type_name: The columns' institution type
+        :type type_name: str
+        """
+
+        metrics = ColumnMetrics(", ".join(names), type_name)
+        with self._lock:
+            self.columns.append(metrics)
+
+        token = _current_metrics.set(metrics)
+        try:
+            with self.span("column", column=metrics.name, type=type_name):
+                yield metrics
+        except BaseException:
+            metrics.succeeded = False
+            raise
+        finally:
+            _current_metrics.reset(token)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[Span]:
+        """
+        Times one step of the current column's lifecycle, eg. "init"
+
+        :param name: The phase's name
+        :type name: str
+        """
+
+        metrics = _current_metrics.get()
+        with self.span(name) as span:
+            try:
+                yield span
+            finally:
+                if metrics is not None:
+                    metrics.add_phase(name, span.duration)
+
+    def finish(self) -> None:
+        self.root.end_ns = time.time_ns()
+
+    def get_otlp_trace(self) -> Dict:
+        """
+        :return: Every span recorded, as an OTLP JSON trace
+        :rtype: Dict
+        """
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": otlp_value("balance_sheet_gen"),
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "balance_sheet_gen"},
+                            "spans": [span.to_otlp() for span in self.spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def get_prometheus_text(self) -> str:
+        """
+        :return: Each column's metrics, in the Prometheus text format
+        :rtype: str
+        """
+
+        lines = [
+            "# HELP balance_sheet_gen_run_duration_seconds The duration of the whole run",
+            "# TYPE balance_sheet_gen_run_duration_seconds gauge",
+            f"balance_sheet_gen_run_duration_seconds {self.root.duration}",
+            "# HELP balance_sheet_gen_phase_duration_seconds The duration of each column's lifecycle phases",
+            "# TYPE balance_sheet_gen_phase_duration_seconds gauge",
+        ]
+        for metrics in self.columns:
+            for phase, seconds in metrics.phases.items():
+                lines.append(
+                    f'balance_sheet_gen_phase_duration_seconds{{{prometheus_labels(metrics)},phase="{phase}"}} {seconds}'
+                )
+
+        lines.extend(
+            [
+                "# HELP balance_sheet_gen_column_success Whether the column's balance was fetched",
+                "# TYPE balance_sheet_gen_column_success gauge",
+            ]
+        )
+        for metrics in self.columns:
+            lines.append(
+                f"balance_sheet_gen_column_success{{{prometheus_labels(metrics)}}} {int(metrics.succeeded)}"
+            )
+
+        for counter in ColumnMetrics.COUNTERS:
+            name = f"balance_sheet_gen_{counter}_total"
+            lines.extend([f"# TYPE {name} counter"])
+            for metrics in self.columns:
+                lines.append(
+                    f"{name}{{{prometheus_labels(metrics)}}} {metrics.counters[counter]}"
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def get_profile_table(self) -> str:
+        """
+        :return: A summary of each column's metrics, slowest first
+        :rtype: str
+        """
+
+        header = f"{'column':<32} {'type':<24} {'init (s)':>9} {'fetch (s)':>9} {'calls':>6} {'sent':>6} {'KiB in':>8} {'retries':>7} {'backoff (s)':>11} {'wait (s)':>8}  ok"
+        lines = [header, "-" * len(header)]
+        for metrics in sorted(
+            self.columns, key=lambda metrics: metrics.total_seconds, reverse=True
+        ):
+            counters = metrics.counters
+            lines.append(
+                f"{metrics.name[:32]:<32} {metrics.type_name[:24]:<24} "
+                f"{metrics.phases.get('init', 0):>9.2f} "
+                f"{metrics.total_seconds - metrics.phases.get('init', 0):>9.2f} "
+                f"{int(counters['http_calls']):>6} {int(counters['http_requests']):>6} "
+                f"{counters['response_bytes'] / 1024:>8.1f} {int(counters['retries']):>7} "
+                f"{counters['backoff_seconds']:>11.2f} {counters['wait_seconds']:>8.2f}  "
+                f"{'yes' if metrics.succeeded else 'no'}"
+            )
+        lines.append(f"total run time: {self.root.duration:.2f}s")
+        return "\n".join(lines)
+
+    def write_prometheus_file(self, path: str) -> None:
+        # written atomically, for node_exporter's textfile collector
+        write_atomically(path, self.get_prometheus_text())
+
+    def write_trace_file(self, path: str) -> None:
+        write_atomically(path, json.dumps(self.get_otlp_trace()))
+
+
+def prometheus_labels(metrics: ColumnMetrics) -> str:
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return f'column="{escape(metrics.name)}",type="{escape(metrics.type_name)}"'
+
+
+def write_atomically(path: str, text: str) -> None:
+    path = os.path.expanduser(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def get_current_metrics() -> Optional[ColumnMetrics]:
+    """
+    :return: The metrics of the column being fetched in this context, if any
+    :rtype: Optional[ColumnMetrics]
+    """
+
+    return _current_metrics.get()
+
+
+@contextmanager
+def collect_metrics(metrics: ColumnMetrics) -> Iterator[ColumnMetrics]:
+    """
+    Attributes everything in the enclosed block to metrics, without tracing it -
+    eg. in a worker process, whose metrics are sent back to the run
+
+    :param metrics: The metrics to add to
+    :type metrics: ColumnMetrics
+    """
+
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+
+
+@contextmanager
+def child_span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Times the enclosed block as a child of the current span,
+    if anything is being traced in this context
+
+    :param name: The span's name
+    :type name: str
+    """
+
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    with parent.instrumentation.span(name, **attributes) as span:
+        yield span
+
+
+def run_in_context(func, *args):
+    """
+    :return: A zero-argument callable running func(*args) in a copy of
+        the current context, so that work handed to another thread
+        (eg. an executor) stays attributed to the current column
+    """
+
+    context = contextvars.copy_context()
+    return lambda: context.run(func, *args)
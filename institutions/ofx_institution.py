@@ -1,25 +1,165 @@
 import datetime
 import logging
 import xml.etree.ElementTree as ET
-from typing import Dict
+from collections import Counter
+from decimal import Decimal
+from typing import BinaryIO, Dict, Hashable, List, Optional, Set, Tuple, Union
 
 import ofxtools
 from ofxtools.Client import InvStmtRq
+from ofxtools.Types import DateTime
 
 
 from .institution import Institution
+from .transport import Transport
+from .valuation import Holding, fiat_holding
+
+
+def extract_networths(stmt_res: BinaryIO, account_ids: Set[str]) -> Dict[str, float]:
+    """
+    Incrementally parses an investment statement response,
+    returning each account's "Networth" balance from INVBAL's BALLIST.
+    Parsing stops as soon as every requested account's balance is found,
+    and every element that isn't part of a balance is freed as soon as
+    it's parsed, so large responses are never held in memory.
+
+    :param stmt_res: An OFX (XML) statement response
+    :type stmt_res: BinaryIO
+    :param account_ids: The accounts whose balances are wanted
+    :type account_ids: Set[str]
+    :return: A mapping of account ID to net worth,
+        for every requested account found in the response
+    :rtype: Dict[str, float]
+    """
+
+    networths = dict()
+    acct_id = None
+    path = list()
+    for event, elem in ET.iterparse(stmt_res, events=("start", "end")):
+        if event == "start":
+            path.append(elem.tag)
+            continue
+
+        path.pop()
+        if elem.tag == "ACCTID" and path[-1:] == ["INVACCTFROM"]:
+            acct_id = elem.text
+        elif elem.tag == "BAL" and path[-2:] == ["INVBAL", "BALLIST"]:
+            if acct_id in account_ids and elem.findtext("NAME") == "Networth":
+                networths[acct_id] = float(elem.findtext("VALUE"))
+                if networths.keys() >= account_ids:
+                    break
+
+        # keep a BAL's children until the BAL itself is checked
+        if not path or path[-1] != "BAL":
+            elem.clear()
+
+    return networths
+
+
+def extract_position_values(
+    stmt_res: BinaryIO,
+) -> List[Tuple[str, Optional[datetime.datetime], Decimal]]:
+    """
+    Incrementally parses an investment statement response,
+    returning each statement's account ID, as-of date and value -
+    the market value of its positions as of DTASOF, plus its available cash.
+    Like extract_networths, elements are freed as soon as they're parsed.
+
+    The cash balance (INVBAL) has no date of its own - it's current as of
+    the server's response (DTSERVER) - so it's only counted in statements
+    as of that same (UTC) day. Older statements are valued by their
+    positions alone, rather than mixing today's cash with past holdings.
+
+    Rejected statement requests come back as a bare error STATUS,
+    with no statement at all, so statements can't be matched to
+    requests by their position in the response.
+
+    :param stmt_res: An OFX (XML) statement response
+    :type stmt_res: BinaryIO
+    :return: Each statement's (account ID, DTASOF - if it has one, value)
+    :rtype: List[Tuple[str, Optional[datetime.datetime], Decimal]]
+    """
+
+    values = list()
+    dtserver = None
+    acct_id = None
+    dtasof = None
+    total = Decimal(0)
+    cash = Decimal(0)
+    path = list()
+    for event, elem in ET.iterparse(stmt_res, events=("start", "end")):
+        if event == "start":
+            path.append(elem.tag)
+            continue
+
+        path.pop()
+        if elem.tag == "DTSERVER" and path[-1:] == ["SONRS"]:
+            dtserver = DateTime().convert(elem.text)
+        elif elem.tag == "ACCTID" and path[-1:] == ["INVACCTFROM"]:
+            acct_id = elem.text
+        elif elem.tag == "DTASOF" and path[-1:] == ["INVSTMTRS"]:
+            dtasof = DateTime().convert(elem.text)
+        elif elem.tag == "MKTVAL" and "INVPOSLIST" in path:
+            total += Decimal(elem.text)
+        elif elem.tag == "AVAILCASH" and path[-1:] == ["INVBAL"]:
+            cash = Decimal(elem.text)
+        elif elem.tag == "INVSTMTRS":
+            if (
+                dtserver is not None
+                and dtasof is not None
+                and dtasof.astimezone(datetime.timezone.utc).date()
+                == dtserver.astimezone(datetime.timezone.utc).date()
+            ):
+                total += cash
+            values.append((acct_id, dtasof, total))
+            acct_id, dtasof, total, cash = None, None, Decimal(0), Decimal(0)
+
+        elem.clear()
+
+    return values
 
 
 class OfxInstitution(Institution):
-    def __init__(self, type_name: str, name: str, config: Dict, logger: logging.Logger):
-        super(type(self), self).__init__(type_name, name, config, logger)
+    REQUIRED_CONFIG = {
+        "username": str,
+        "password": str,
+        "account_id": str,
+        "institution_info": {"url": str, "org": str, "fid": str, "broker_id": str},
+    }
+    OPTIONAL_CONFIG = {
+        "account_type": str,
+        "include_positions": bool,
+        "include_transactions": bool,
+        "lookback_days": int,
+    }
+
+    # DTASOFs are in UTC, so a date-only DTASOF is a multiple of this
+    SECONDS_PER_DAY = 24 * 60 * 60
+
+    def __init__(
+        self,
+        type_name: str,
+        name: str,
+        config: Dict,
+        logger: logging.Logger,
+        transport: Optional[Transport] = None,
+    ):
+        super(type(self), self).__init__(type_name, name, config, logger, transport)
         self.name = name
         self.config = config
-        # assert some time in the past
-        self.dtstart = datetime.datetime(1990, 1, 1, tzinfo=ofxtools.utils.UTC)
-        # assert some time in the future
-        self.dtend = datetime.datetime(
-            datetime.date.today().year + 1, 1, 1, tzinfo=ofxtools.utils.UTC
+
+        # Only the balance is needed, so by default request nothing else -
+        # brokerages will otherwise happily send decades of transactions
+        self.DEFAULT_LOOKBACK_DAYS = 30
+        self.include_transactions = self.config.get("include_transactions", False)
+        self.include_positions = self.config.get("include_positions", False)
+
+        # transactions (if requested at all) only go back this far
+        self.dtend = datetime.datetime.now(tz=ofxtools.utils.UTC) + datetime.timedelta(
+            days=1
+        )
+        self.dtstart = self.dtend - datetime.timedelta(
+            days=self.config.get("lookback_days", self.DEFAULT_LOOKBACK_DAYS) + 1
         )
 
         # init OFX client, but don't auth
@@ -73,38 +213,155 @@ class OfxInstitution(Institution):
             clientuid=self.DEFAULT_CLIENT_UID,
         )
 
+    @classmethod
+    def get_group_key(cls, config: Dict) -> Hashable:
+        # one OFX request can carry a statement request for every account
+        return (config["institution_info"]["url"], config["username"])
+
     def get_balance(self) -> float:
+        return self.get_balances([self.config])[self.name]
+
+    def get_balances(self, configs: List[Dict]) -> Dict[str, float]:
         # if self.config['account_type'] == 'investment':
         # elif self.config['account_type'] == 'credit':
 
-        # TODO assuming this is indeed an investment account
-        stmt_req = InvStmtRq(
-            acctid=self.config["account_id"],
-            dtstart=self.dtstart,
-            dtend=self.dtend,
-            dtasof=None,
-            inctran=True,
-            incoo=False,
-            incpos=True,
-            incbal=True,
-        )
+        account_ids = {config["account_id"] for config in configs}
+
+        # TODO assuming these are indeed investment accounts
+        stmt_reqs = [
+            InvStmtRq(
+                acctid=account_id,
+                dtstart=self.dtstart,
+                dtend=self.dtend,
+                dtasof=None,
+                inctran=self.include_transactions,
+                incoo=False,
+                incpos=self.include_positions,
+                incbal=True,
+            )
+            for account_id in sorted(account_ids)
+        ]
 
+        # ofxtools doesn't use the transport, but should respect its timeouts
         stmt_res = self.client.request_statements(
-            self.config["password"], stmt_req, dryrun=False, gen_newfileuid=False
+            self.config["password"],
+            *stmt_reqs,
+            dryrun=False,
+            gen_newfileuid=False,
+            timeout=self.transport.get_timeout(),
         )
-        tree = ET.parse(stmt_res)
-        acct_balance = 0
 
         # TODO do we need to check for account types besides "investment"?
         # if self.config['account_type'] == 'investment':
 
         # TODO is this valid for all types of investment accounts?
-        balances = tree.findall(
-            "./INVSTMTMSGSRSV1/INVSTMTTRNRS/INVSTMTRS/INVBAL/BALLIST/"
+        networths = extract_networths(stmt_res, account_ids)
+
+        balances = dict()
+        for config in configs:
+            if config["account_id"] not in networths:
+                self.logger.warning(
+                    f"No Networth balance found in statement for {config['name']}"
+                )
+            balances[config["name"]] = networths.get(config["account_id"], 0)
+
+        return balances
+
+    def get_historical_holdings(
+        self, timestamps: List[float]
+    ) -> Dict[float, List[Holding]]:
+        history = self.get_historical_holdings_many([self.config], timestamps)[
+            self.name
+        ]
+        if isinstance(history, Exception):
+            raise history
+
+        return history
+
+    def get_historical_holdings_many(
+        self, configs: List[Dict], timestamps: List[float]
+    ) -> Dict[str, Union[Dict[float, List[Holding]], Exception]]:
+        # a statement request per account and date, all in one OFX request -
+        # the balance list is always current, so positions (as of dtasof) are used
+        account_ids = sorted({config["account_id"] for config in configs})
+        requested = [
+            (account_id, timestamp)
+            for account_id in account_ids
+            for timestamp in sorted(timestamps)
+        ]
+        stmt_reqs = [
+            InvStmtRq(
+                acctid=account_id,
+                dtstart=None,
+                dtend=None,
+                dtasof=datetime.datetime.fromtimestamp(
+                    timestamp, tz=ofxtools.utils.UTC
+                ),
+                inctran=False,
+                incoo=False,
+                incpos=True,
+                incbal=True,
+            )
+            for account_id, timestamp in requested
+        ]
+
+        stmt_res = self.client.request_statements(
+            self.config["password"],
+            *stmt_reqs,
+            dryrun=False,
+            gen_newfileuid=False,
+            timeout=self.transport.get_timeout(),
+        )
+
+        # matched to their requests by account and DTASOF, to the second -
+        # never by position, since a rejected request has no statement
+        # and would shift every later one onto the wrong date
+        statements = {
+            (stmt_account_id, int(dtasof.timestamp())): value
+            for stmt_account_id, dtasof, value in extract_position_values(stmt_res)
+            if dtasof is not None
+        }
+        requested_days = Counter(
+            (account_id, int(timestamp // self.SECONDS_PER_DAY))
+            for account_id, timestamp in requested
         )
-        for balance in balances:
-            if balance.find("./NAME").text == "Networth":
-                acct_balance = float(balance.find("./VALUE").text)
-                break
 
-        return acct_balance
+        values: Dict[str, Dict[float, Decimal]] = dict()
+        for account_id, timestamp in requested:
+            day = int(timestamp // self.SECONDS_PER_DAY)
+            keys = [(account_id, int(timestamp))]
+            # servers that only keep daily statements report just the date,
+            # which only answers a request if it's the only one that day
+            if requested_days[(account_id, day)] == 1:
+                keys.append((account_id, day * self.SECONDS_PER_DAY))
+
+            for key in keys:
+                if key in statements:
+                    values.setdefault(account_id, dict())[timestamp] = statements[key]
+                    break
+
+        histories = dict()
+        for config in configs:
+            account_values = values.get(config["account_id"], dict())
+            missing = [
+                timestamp for timestamp in timestamps if timestamp not in account_values
+            ]
+            if missing:
+                histories[config["name"]] = Exception(
+                    f"No statement returned for {len(missing)} of {len(timestamps)} dates"
+                    " - missing "
+                    + ", ".join(
+                        datetime.datetime.fromtimestamp(
+                            timestamp, tz=ofxtools.utils.UTC
+                        ).isoformat(timespec="seconds")
+                        for timestamp in sorted(missing)
+                    )
+                )
+                continue
+
+            histories[config["name"]] = {
+                timestamp: [fiat_holding(value)]
+                for timestamp, value in account_values.items()
+            }
+
+        return histories
@@ -0,0 +1,496 @@
+import bisect
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+
+from .cache import JsonFileCache
+from .transport import get_transport
+
+if TYPE_CHECKING:
+    from pycoingecko import CoinGeckoAPI
+
+
+class PriceOracle:
+    """
+    Process-wide CoinGecko price service.
+
+    Columns register the coin IDs that they need before any of them are
+    fetched, so every price can be resolved with a single batched
+    get_price(ids=[...]) call rather than one call per column.
+    Results are cached in memory for `ttl` seconds,
+    and optionally on disk so back-to-back runs can share them.
+
+    Historical prices (for backfills) are fetched as a whole range per coin,
+    so pricing a year of dates costs one request per coin and currency
+    rather than one per date.
+
+    Requests are sent without holding the oracle's lock - callers that need
+    a price (or history) that's already being fetched wait for that request
+    instead of sending their own.
+    """
+
+    DEFAULT_TTL = 300
+
+    # how far a historical price may be from the time it's wanted for -
+    # CoinGecko's ranges longer than 90 days are daily
+    HISTORY_TOLERANCE = 2 * 24 * 60 * 60
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_TTL,
+        cache_file: Optional[str] = None,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.ttl = ttl
+        self.logger = logger or logging.getLogger("balance_sheet_gen.price_oracle")
+        self.disk_cache = JsonFileCache(cache_file) if cache_file else None
+
+        # created when first needed, so importing the package stays cheap
+        self._coin_gecko = None
+        self._coin_gecko_lock = threading.Lock()
+
+        # (coin_id, vs_currency) -> (price, fetched_at)
+        self._prices: Dict[Tuple[str, str], Tuple[float, float]] = dict()
+        self._registered: Set[Tuple[str, str]] = set()
+
+        # (coin_id, vs_currency) -> the (start, end) range that's been fetched,
+        # and its (timestamp, price) points, oldest first
+        self._history: Dict[
+            Tuple[str, str], Tuple[Tuple[float, float], List[Tuple[float, float]]]
+        ] = dict()
+        self._history_registered: Dict[Tuple[str, str], Tuple[float, float]] = dict()
+
+        # (coin_id, vs_currency) -> the request fetching its price (or history)
+        self._in_flight: Dict[Tuple[str, str], Future] = dict()
+        self._history_in_flight: Dict[Tuple[str, str], Future] = dict()
+
+        self._lock = threading.Lock()
+
+    @property
+    def coin_gecko(self) -> "CoinGeckoAPI":
+        with self._coin_gecko_lock:
+            if self._coin_gecko is None:
+                from pycoingecko import CoinGeckoAPI
+
+                self._coin_gecko = CoinGeckoAPI()
+                get_transport().mount(self._coin_gecko.session)
+
+        return self._coin_gecko
+
+    def configure(self, ttl: Optional[float] = None, cache_file: Optional[str] = None):
+        """
+        Applies the top-level "price_oracle" configuration block
+
+        :param ttl: How long (in seconds) a fetched price stays fresh
+        :type ttl: Optional[float]
+        :param cache_file: If provided, a path to persist prices to between runs
+        :type cache_file: Optional[str]
+        :rtype: None
+        """
+
+        if ttl is not None:
+            self.ttl = ttl
+
+        if cache_file:
+            self.disk_cache = JsonFileCache(cache_file)
+            self._load_disk_cache()
+
+    def register(self, coin_ids: Iterable[str], vs_currency: str = "usd") -> None:
+        """
+        Declares that the given coin IDs will be needed during this run
+
+        :param coin_ids: CoinGecko coin IDs, eg. "bitcoin"
+        :type coin_ids: Iterable[str]
+        :param vs_currency: The currency to price the coins in
+        :type vs_currency: str
+        :rtype: None
+        """
+
+        with self._lock:
+            self._registered.update((coin_id, vs_currency) for coin_id in coin_ids)
+
+    def register_history(
+        self,
+        coin_ids: Iterable[str],
+        start: float,
+        end: float,
+        vs_currency: str = "usd",
+    ) -> None:
+        """
+        Declares that the given coins' prices will be needed
+        for times between start and end
+
+        :param coin_ids: CoinGecko coin IDs, eg. "bitcoin"
+        :type coin_ids: Iterable[str]
+        :param start: The earliest time needed, in seconds since the epoch
+        :type start: float
+        :param end: The latest time needed, in seconds since the epoch
+        :type end: float
+        :param vs_currency: The currency to price the coins in
+        :type vs_currency: str
+        :rtype: None
+        """
+
+        with self._lock:
+            for coin_id in coin_ids:
+                registered = self._history_registered.get((coin_id, vs_currency))
+                if registered is not None:
+                    start, end = min(start, registered[0]), max(end, registered[1])
+                self._history_registered[(coin_id, vs_currency)] = (start, end)
+
+    def prefetch(self) -> None:
+        """
+        Resolves every registered coin ID that isn't already cached,
+        in every registered currency, with a single request -
+        and every registered historical range, with one request per coin
+
+        :rtype: None
+        """
+
+        with self._lock:
+            history_registered = sorted(self._history_registered.items())
+
+        for (coin_id, vs_currency), (start, end) in history_registered:
+            self._ensure_history(coin_id, vs_currency, start, end)
+
+        with self._lock:
+            now = time.time()
+            stale = {
+                (coin_id, vs_currency)
+                for coin_id, vs_currency in self._registered
+                if not self._is_fresh(coin_id, vs_currency, now)
+            }
+
+        # every coin in every currency, in one request
+        self._resolve(stale)
+
+    def get_price(self, coin_id: str, vs_currency: str = "usd") -> float:
+        """
+        :param coin_id: A CoinGecko coin ID, eg. "bitcoin"
+        :type coin_id: str
+        :param vs_currency: The currency to price the coin in
+        :type vs_currency: str
+        :return: The price of one unit of the coin
+        :rtype: float
+        """
+
+        return self.get_prices([coin_id], vs_currency)[coin_id]
+
+    def get_prices(
+        self,
+        coin_ids: Iterable[str],
+        vs_currency: str = "usd",
+        require_all: bool = True,
+    ) -> Dict[str, float]:
+        """
+        Returns prices for all of the given coins,
+        fetching any stale or missing ones in a single batched request
+
+        :param coin_ids: CoinGecko coin IDs, eg. ["bitcoin", "ethereum"]
+        :type coin_ids: Iterable[str]
+        :param vs_currency: The currency to price the coins in
+        :type vs_currency: str
+        :param require_all: Whether to raise if any coin has no price,
+            rather than leaving it out
+        :type require_all: bool
+        :return: A mapping of coin ID to price
+        :rtype: Dict[str, float]
+        """
+
+        coin_ids = set(coin_ids)
+        prices = dict()
+
+        with self._lock:
+            now = time.time()
+            missing = set()
+            for coin_id in coin_ids:
+                cached = self._prices.get((coin_id, vs_currency))
+                if cached is not None and now - cached[1] < self.ttl:
+                    prices[coin_id] = cached[0]
+                else:
+                    missing.add((coin_id, vs_currency))
+
+            if missing:
+                # anything registered but not yet fetched rides along for free
+                missing.update(
+                    (registered_id, vs_currency)
+                    for registered_id, registered_currency in self._registered
+                    if registered_currency == vs_currency
+                    and not self._is_fresh(registered_id, vs_currency, now)
+                )
+
+        prices.update(
+            {
+                coin_id: price
+                for (coin_id, _), price in self._resolve(missing).items()
+                if coin_id in coin_ids
+            }
+        )
+
+        not_found = coin_ids - prices.keys()
+        if not_found and require_all:
+            raise Exception(
+                f"No {vs_currency} price found for coin IDs: {sorted(not_found)}"
+            )
+
+        return prices
+
+    def get_coins_list(self) -> List[Dict]:
+        """
+        :return: Every coin CoinGecko knows of, as {"id", "symbol", "name"} dicts -
+            a large response, so anything derived from it should be cached
+        :rtype: List[Dict]
+        """
+
+        return self.coin_gecko.get_coins_list()
+
+    def get_token_contracts(self, platform: str) -> Dict[str, str]:
+        """
+        :param platform: A CoinGecko asset platform, eg. "ethereum"
+        :type platform: str
+        :return: A mapping of every token contract CoinGecko knows of on the
+            platform, in lower case, to its coin ID - a large response,
+            so it should be cached
+        :rtype: Dict[str, str]
+        """
+
+        return {
+            coin["platforms"][platform].lower(): coin["id"]
+            for coin in self.coin_gecko.get_coins_list(include_platform="true")
+            if (coin.get("platforms") or dict()).get(platform)
+        }
+
+    def get_historical_prices(
+        self, coin_ids: Iterable[str], timestamp: float, vs_currency: str = "usd"
+    ) -> Dict[str, float]:
+        """
+        Returns prices for all of the given coins as of a past time,
+        fetching the registered range of any coin whose history isn't cached
+
+        :param coin_ids: CoinGecko coin IDs, eg. ["bitcoin", "ethereum"]
+        :type coin_ids: Iterable[str]
+        :param timestamp: The time to price the coins at, in seconds since the epoch
+        :type timestamp: float
+        :param vs_currency: The currency to price the coins in
+        :type vs_currency: str
+        :return: A mapping of coin ID to price
+        :rtype: Dict[str, float]
+        """
+
+        prices = dict()
+        for coin_id in set(coin_ids):
+            with self._lock:
+                start, end = self._history_registered.get(
+                    (coin_id, vs_currency), (timestamp, timestamp)
+                )
+            self._ensure_history(
+                coin_id, vs_currency, min(start, timestamp), max(end, timestamp)
+            )
+
+            with self._lock:
+                points = self._history[(coin_id, vs_currency)][1]
+            # the latest price at or before the timestamp
+            index = bisect.bisect_right(points, (timestamp, float("inf"))) - 1
+            if index < 0 or timestamp - points[index][0] > self.HISTORY_TOLERANCE:
+                raise Exception(
+                    f"No {vs_currency} price found for {coin_id} as of {time.ctime(timestamp)}"
+                )
+            prices[coin_id] = points[index][1]
+
+        return prices
+
+    def _has_history(
+        self, coin_id: str, vs_currency: str, start: float, end: float
+    ) -> bool:
+        cached = self._history.get((coin_id, vs_currency))
+        return cached is not None and cached[0][0] <= start and end <= cached[0][1]
+
+    def _ensure_history(
+        self, coin_id: str, vs_currency: str, start: float, end: float
+    ) -> None:
+        """
+        Fetches a coin's prices over a range of time, unless they're cached -
+        waiting for any fetch of the coin's history that's already in flight,
+        then fetching the range itself if that fetch didn't cover it
+
+        :rtype: None
+        """
+
+        key = (coin_id, vs_currency)
+        while True:
+            with self._lock:
+                if self._has_history(coin_id, vs_currency, start, end):
+                    return
+
+                future = self._history_in_flight.get(key)
+                if future is None:
+                    future = Future()
+                    self._history_in_flight[key] = future
+                    break
+
+            future.result()
+
+        try:
+            points = self._fetch_history(coin_id, vs_currency, start, end)
+        except BaseException as be:
+            with self._lock:
+                del self._history_in_flight[key]
+            future.set_exception(be)
+            raise
+
+        with self._lock:
+            self._history[key] = ((start, end), points)
+            del self._history_in_flight[key]
+        future.set_result(None)
+
+    def _fetch_history(
+        self, coin_id: str, vs_currency: str, start: float, end: float
+    ) -> List[Tuple[float, float]]:
+        """
+        Fetches a coin's prices over a range of time
+
+        :return: The range's (timestamp, price) points, oldest first
+        :rtype: List[Tuple[float, float]]
+        """
+
+        self.logger.debug(
+            f"Fetching {vs_currency} prices for {coin_id} from {time.ctime(start)} to {time.ctime(end)}"
+        )
+        # start early enough that the first point is at or before start
+        res = self.coin_gecko.get_coin_market_chart_range_by_id(
+            id=coin_id,
+            vs_currency=vs_currency,
+            from_timestamp=int(start - self.HISTORY_TOLERANCE),
+            to_timestamp=int(end) + 1,
+        )
+
+        return sorted((ms / 1000, price) for ms, price in res.get("prices", list()))
+
+    def _is_fresh(self, coin_id: str, vs_currency: str, now: float) -> bool:
+        cached = self._prices.get((coin_id, vs_currency))
+        return cached is not None and now - cached[1] < self.ttl
+
+    def _resolve(self, pairs: Set[Tuple[str, str]]) -> Dict[Tuple[str, str], float]:
+        """
+        Fetches the prices of every (coin ID, currency) pair in one request,
+        except those already being fetched, which are waited for instead
+
+        :param pairs: The (coin ID, currency) pairs to fetch
+        :type pairs: Set[Tuple[str, str]]
+        :return: A mapping of (coin ID, currency) to price,
+            for every pair that was found
+        :rtype: Dict[Tuple[str, str], float]
+        """
+
+        if not pairs:
+            return dict()
+
+        with self._lock:
+            waiting = {
+                self._in_flight[pair] for pair in pairs if pair in self._in_flight
+            }
+            fetching = {pair for pair in pairs if pair not in self._in_flight}
+            future = Future()
+            for pair in fetching:
+                self._in_flight[pair] = future
+
+        prices: Dict[Tuple[str, str], float] = dict()
+        if fetching:
+            try:
+                prices.update(
+                    self._fetch(
+                        {coin_id for coin_id, _ in fetching},
+                        {vs_currency for _, vs_currency in fetching},
+                    )
+                )
+            except BaseException as be:
+                with self._lock:
+                    for pair in fetching:
+                        del self._in_flight[pair]
+                future.set_exception(be)
+                raise
+
+            with self._lock:
+                for pair in fetching:
+                    del self._in_flight[pair]
+            future.set_result(dict(prices))
+
+        for waiting_future in waiting:
+            prices.update(waiting_future.result())
+
+        return {pair: price for pair, price in prices.items() if pair in pairs}
+
+    def _fetch(
+        self, coin_ids: Set[str], vs_currencies: Set[str]
+    ) -> Dict[Tuple[str, str], float]:
+        """
+        Fetches prices from CoinGecko and updates the caches
+
+        :return: A mapping of (coin ID, currency) to price
+        :rtype: Dict[Tuple[str, str], float]
+        """
+
+        self.logger.debug(
+            f"Fetching {', '.join(sorted(vs_currencies))} prices for {len(coin_ids)} coins"
+        )
+        res = self.coin_gecko.get_price(
+            ids=sorted(coin_ids), vs_currencies=",".join(sorted(vs_currencies))
+        )
+
+        fetched_at = time.time()
+        prices = dict()
+        for coin_id, quote in res.items():
+            for vs_currency in vs_currencies:
+                if vs_currency in quote:
+                    prices[(coin_id, vs_currency)] = quote[vs_currency]
+
+        with self._lock:
+            self._prices.update(
+                {pair: (price, fetched_at) for pair, price in prices.items()}
+            )
+            doc = self._get_disk_cache_doc()
+
+        self._save_disk_cache(doc)
+        return prices
+
+    def _load_disk_cache(self) -> None:
+        if self.disk_cache is None:
+            return
+
+        with self._lock:
+            for coin_id, quotes in self.disk_cache.load().items():
+                for vs_currency, (price, fetched_at) in quotes.items():
+                    cached = self._prices.get((coin_id, vs_currency))
+                    if cached is None or cached[1] < fetched_at:
+                        self._prices[(coin_id, vs_currency)] = (price, fetched_at)
+
+    def _get_disk_cache_doc(self) -> Dict[str, Dict[str, Tuple[float, float]]]:
+        # the caller must hold self._lock
+        doc: Dict[str, Dict[str, Tuple[float, float]]] = dict()
+        for (coin_id, vs_currency), entry in self._prices.items():
+            doc.setdefault(coin_id, dict())[vs_currency] = entry
+
+        return doc
+
+    def _save_disk_cache(self, doc: Dict[str, Dict[str, Tuple[float, float]]]) -> None:
+        if self.disk_cache is None:
+            return
+
+        try:
+            self.disk_cache.save(doc)
+        except OSError as oe:
+            self.logger.warning(f"Unable to write price cache - {oe}")
+
+
+_price_oracle = PriceOracle()
+
+
+def get_price_oracle() -> PriceOracle:
+    """
+    :return: The PriceOracle shared by every Institution in this process
+    :rtype: PriceOracle
+    """
+
+    return _price_oracle
@@ -0,0 +1,69 @@
+import importlib
+import logging
+from typing import Dict, Optional
+
+# The built-in connectors, by type name.
+# Each module is only imported once a column of its type is configured.
+INSTITUTION_MODULES: Dict[str, str] = {
+    "AtmosInstitution": "institutions.atmos_institution",
+    "BitcoinInstitution": "institutions.bitcoin_institution",
+    "ChiaInstitution": "institutions.chia_institution",
+    "CoinbaseInstitution": "institutions.coinbase_institution",
+    "CoinbaseProInstitution": "institutions.coinbase_pro_institution",
+    "DiscoverBankInstitution": "institutions.discover_bank_institution",
+    "EthereumInstitution": "institutions.ethereum_institution",
+    "HeliumInstitution": "institutions.helium_institution",
+    "OfxInstitution": "institutions.ofx_institution",
+}
+
+# Third-party packages can provide connectors by declaring an entry point
+# in this group, named after the type name, eg.
+#   [project.entry-points."balance_sheet_gen.institutions"]
+#   VenmoInstitution = "venmo_connector:VenmoInstitution"
+ENTRY_POINT_GROUP = "balance_sheet_gen.institutions"
+
+logger = logging.getLogger("balance_sheet_gen.registry")
+
+
+def load_institution_class(type_name: str) -> Optional[type]:
+    """
+    Imports and returns the connector registered under a type name,
+    either as a built-in or through an entry point
+
+    :param type_name: The class name of an Institution, eg. "BitcoinInstitution"
+    :type type_name: str
+    :return: The connector's class, or None if no connector is registered
+        under that name
+    :rtype: Optional[type]
+    """
+
+    module_path = INSTITUTION_MODULES.get(type_name)
+    if module_path is not None:
+        return getattr(importlib.import_module(module_path), type_name)
+
+    entry_point = _find_entry_point(type_name)
+    if entry_point is not None:
+        return entry_point.load()
+
+    return None
+
+
+def _find_entry_point(type_name: str):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        # python < 3.8
+        return None
+
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        group = eps.select(group=ENTRY_POINT_GROUP)
+    else:
+        group = eps.get(ENTRY_POINT_GROUP, list())
+
+    for entry_point in group:
+        if entry_point.name == type_name:
+            logger.debug(f"Loading {type_name} from {entry_point.value}")
+            return entry_point
+
+    return None
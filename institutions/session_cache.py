@@ -0,0 +1,304 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+import requests
+
+from .cache import JsonFileCache, default_cache_dir
+
+
+class SessionCache:
+    """
+    Persists login sessions - bearer tokens, cookies and their expiry -
+    between runs, so institutions only log in (and answer MFA challenges)
+    when their last session has expired or been revoked.
+
+    Each session is stored in its own file, named by a hash of its institution
+    type and login, and encrypted with a key derived (with scrypt) from the
+    login's secret, eg. its password - so a session can only be read
+    with the credentials that created it, which a run needs anyway.
+    Requires the cryptography package - without it, nothing is cached,
+    as sessions are never written in plain text.
+    """
+
+    # bump whenever the cached document changes shape
+    VERSION = 1
+
+    # how long a session is trusted for, if it doesn't say when it expires
+    DEFAULT_TTL = 12 * 60 * 60
+
+    # sessions this close to expiring are treated as expired
+    EXPIRY_MARGIN = 60
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        enabled: bool = True,
+        ttl: float = DEFAULT_TTL,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.directory = directory
+        self.enabled = enabled
+        self.ttl = ttl
+        self.logger = logger or logging.getLogger("balance_sheet_gen.session_cache")
+
+        self._warned = False
+        self._lock = threading.Lock()
+
+    def configure(
+        self,
+        directory: Optional[str] = None,
+        enabled: Optional[bool] = None,
+        ttl: Optional[float] = None,
+    ) -> None:
+        """
+        Applies the top-level "session_cache" configuration block
+
+        :param directory: Where to store sessions - defaults to the cache directory
+        :type directory: Optional[str]
+        :param enabled: Whether to cache sessions at all
+        :type enabled: Optional[bool]
+        :param ttl: How long, in seconds, a session that doesn't say when
+            it expires is reused for
+        :type ttl: Optional[float]
+        :rtype: None
+        """
+
+        if directory is not None:
+            self.directory = directory
+        if enabled is not None:
+            self.enabled = enabled
+        if ttl is not None:
+            self.ttl = ttl
+
+    @property
+    def available(self) -> bool:
+        if not self.enabled:
+            return False
+
+        # imported when first needed, so runs without logins never load it
+        try:
+            import cryptography  # noqa: F401
+        except ImportError:
+            with self._lock:
+                if not self._warned:
+                    self.logger.warning(
+                        "Install cryptography to cache login sessions between runs"
+                    )
+                    self._warned = True
+            return False
+
+        return True
+
+    def get_file(self, namespace: str, identity: str) -> JsonFileCache:
+        directory = os.path.expanduser(
+            self.directory or os.path.join(default_cache_dir(), "sessions")
+        )
+        key = hashlib.sha256(f"{namespace}\0{identity}".encode()).hexdigest()
+        return JsonFileCache(os.path.join(directory, f"{key}.json"), self.VERSION)
+
+    def load(self, namespace: str, identity: str, secret: str) -> Optional[Dict]:
+        """
+        :param namespace: The institution's type, eg. "AtmosInstitution"
+        :type namespace: str
+        :param identity: The login, eg. an email address
+        :type identity: str
+        :param secret: The login's secret, eg. its password
+        :type secret: str
+        :return: The login's cached session, if it has one that hasn't expired
+        :rtype: Optional[Dict]
+        """
+
+        if not self.available:
+            return None
+
+        cached = self.get_file(namespace, identity).load()
+        if not cached:
+            return None
+
+        from cryptography.fernet import InvalidToken
+
+        try:
+            fernet = self.get_fernet(secret, base64.b64decode(cached["salt"]))
+            session = json.loads(fernet.decrypt(cached["token"].encode()))
+        except (InvalidToken, KeyError, ValueError):
+            # eg. the password has changed
+            self.logger.debug(f"Ignoring an unreadable {namespace} session")
+            return None
+
+        if session["expires_at"] - self.EXPIRY_MARGIN < time.time():
+            return None
+
+        return session
+
+    def save(
+        self,
+        namespace: str,
+        identity: str,
+        secret: str,
+        session: Dict,
+        expires_at: Optional[float] = None,
+    ) -> None:
+        """
+        :param namespace: The institution's type, eg. "AtmosInstitution"
+        :type namespace: str
+        :param identity: The login, eg. an email address
+        :type identity: str
+        :param secret: The login's secret, eg. its password
+        :type secret: str
+        :param session: The JSON-serializable session, eg. its headers and cookies
+        :type session: Dict
+        :param expires_at: When the session expires, in seconds since the epoch -
+            if None, it's trusted for ttl seconds
+        :type expires_at: Optional[float]
+        :rtype: None
+        """
+
+        if not self.available:
+            return
+
+        session = dict(
+            session, expires_at=expires_at if expires_at else time.time() + self.ttl
+        )
+        salt = os.urandom(16)
+        token = self.get_fernet(secret, salt).encrypt(json.dumps(session).encode())
+
+        cache_file = self.get_file(namespace, identity)
+        try:
+            os.makedirs(os.path.dirname(cache_file.path), mode=0o700, exist_ok=True)
+            # mkstemp creates the file as 0600
+            cache_file.save(
+                {"salt": base64.b64encode(salt).decode(), "token": token.decode()}
+            )
+        except OSError as oe:
+            self.logger.warning(f"Unable to cache {namespace} session - {oe}")
+
+    def clear(self, namespace: str, identity: str) -> None:
+        """
+        Forgets a login's session, eg. once it's been rejected
+
+        :rtype: None
+        """
+
+        if self.enabled:
+            self.get_file(namespace, identity).clear()
+
+    @staticmethod
+    def get_fernet(secret: str, salt: bytes) -> "Fernet":
+        from cryptography.fernet import Fernet
+        from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+        key = Scrypt(salt=salt, length=32, n=2**14, r=8, p=1).derive(secret.encode())
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def restore(
+        self,
+        http_session: requests.Session,
+        namespace: str,
+        identity: str,
+        secret: str,
+        headers: Iterable[str] = (),
+    ) -> bool:
+        """
+        Applies a login's cached headers and cookies to an HTTP session
+
+        :param http_session: The session to apply them to
+        :type http_session: requests.Session
+        :param headers: The names of the headers to restore, eg. ["Authorization"]
+        :type headers: Iterable[str]
+        :return: Whether a cached session was found
+        :rtype: bool
+        """
+
+        session = self.load(namespace, identity, secret)
+        if session is None:
+            return False
+
+        for header in headers:
+            if header in session["headers"]:
+                http_session.headers[header] = session["headers"][header]
+        for cookie in session["cookies"]:
+            http_session.cookies.set(**cookie)
+
+        return True
+
+    def store(
+        self,
+        http_session: requests.Session,
+        namespace: str,
+        identity: str,
+        secret: str,
+        headers: Iterable[str] = (),
+        expires_at: Optional[float] = None,
+    ) -> None:
+        """
+        Caches an HTTP session's headers and cookies for a login
+
+        :param http_session: The logged in session
+        :type http_session: requests.Session
+        :param headers: The names of the headers to cache, eg. ["Authorization"]
+        :type headers: Iterable[str]
+        :param expires_at: When the session expires, in seconds since the epoch
+        :type expires_at: Optional[float]
+        :rtype: None
+        """
+
+        self.save(
+            namespace,
+            identity,
+            secret,
+            {
+                "headers": {
+                    header: http_session.headers[header]
+                    for header in headers
+                    if header in http_session.headers
+                },
+                "cookies": [
+                    {
+                        "name": cookie.name,
+                        "value": cookie.value,
+                        "domain": cookie.domain,
+                        "path": cookie.path,
+                    }
+                    for cookie in http_session.cookies
+                ],
+            },
+            expires_at,
+        )
+
+
+def get_jwt_expiry(token: str) -> Optional[float]:
+    """
+    :param token: A bearer token
+    :type token: str
+    :return: If the token is a JWT with an "exp" claim, when it expires,
+        in seconds since the epoch (the token isn't verified)
+    :rtype: Optional[float]
+    """
+
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+
+    try:
+        payload = base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4))
+        return float(json.loads(payload)["exp"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+_session_cache = SessionCache()
+
+
+def get_session_cache() -> SessionCache:
+    """
+    :return: The SessionCache shared by every Institution in this process
+    :rtype: SessionCache
+    """
+
+    return _session_cache
@@ -0,0 +1,904 @@
+import contextvars
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, wait
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from .instrumentation import ColumnMetrics, child_span, get_current_metrics
+
+# When the work running in this context must finish, as a time.monotonic() value
+_deadline: contextvars.ContextVar = contextvars.ContextVar(
+    "balance_sheet_gen_deadline", default=None
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when a request can't be sent (or retried)
+    before the current context's deadline
+    """
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """
+    Requires every request sent in the enclosed block
+    (and on any thread its context is copied to) to complete within
+    `seconds` - or by any earlier deadline that's already in effect
+
+    :param seconds: The time budget, or None for no (additional) deadline
+    :type seconds: Optional[float]
+    """
+
+    if seconds is None:
+        yield
+        return
+
+    deadline_at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline_at if current is None else min(current, deadline_at))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def get_time_remaining() -> Optional[float]:
+    """
+    :return: The number of seconds left before the current context's deadline,
+        or None if it has none
+    :rtype: Optional[float]
+    """
+
+    deadline_at = _deadline.get()
+    if deadline_at is None:
+        return None
+
+    return deadline_at - time.monotonic()
+
+
+class HostRateLimiter:
+    """
+    A token bucket for a single host.
+
+    Tokens refill at `rate` per second, up to `burst`.
+    When the host pushes back (HTTP 429, or a Retry-After header),
+    the bucket is paused for everyone and its rate is halved,
+    then creeps back up to the configured rate as requests succeed.
+    A limiter with no rate never throttles, but still honors pauses.
+    """
+
+    # the fraction of the configured rate recovered after each success
+    RECOVERY_STEP = 0.1
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 1.0)
+        self.tokens = self.burst
+        self.paused_until = 0.0
+
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline_at: Optional[float] = None) -> float:
+        """
+        Blocks until a request may be sent to this host
+
+        :param deadline_at: If provided, the time.monotonic() value
+            by which the request must be sent
+        :type deadline_at: Optional[float]
+        :return: The number of seconds spent waiting
+        :rtype: float
+        """
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = self.paused_until - now
+
+                if delay <= 0 and self.rate is None:
+                    return waited
+
+                if delay <= 0:
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self._last_refill) * self.rate
+                    )
+                    self._last_refill = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+
+                    delay = (1 - self.tokens) / self.rate
+
+            if deadline_at is not None and time.monotonic() + delay > deadline_at:
+                raise DeadlineExceeded("Deadline reached waiting for the rate limit")
+
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, delay: float, slow_down: bool = True) -> None:
+        """
+        Stops any request from being sent to this host for `delay` seconds,
+        and slows the host's rate down
+
+        :param delay: The number of seconds to pause for
+        :type delay: float
+        :param slow_down: Whether to slow the host's rate down too -
+            not when the host has simply said when its quota resets
+        :type slow_down: bool
+        :rtype: None
+        """
+
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            if slow_down and self.rate is not None:
+                self.rate = max(self.max_rate * self.RECOVERY_STEP, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+
+    def succeeded(self) -> None:
+        """
+        Records a successful request, letting the rate recover
+
+        :rtype: None
+        """
+
+        if self.rate is None or self.rate >= self.max_rate:
+            return
+
+        with self._lock:
+            self.rate = min(
+                self.max_rate, self.rate + self.max_rate * self.RECOVERY_STEP
+            )
+
+
+class SingleFlight:
+    """
+    Coalesces identical requests within a run.
+
+    While a request is in flight, identical requests wait for it and
+    share its response rather than being sent again, and successful
+    responses are memoized for `window` seconds afterwards.
+    Every caller gets its own copy of the response.
+
+    Waiting callers are still bound by their own deadlines, and if the
+    request fails only because of its sender's deadline (or is cancelled),
+    one of them sends it again instead of failing too.
+    """
+
+    def __init__(self, window: float = 0.0):
+        self.window = window
+
+        self.sent = 0
+        self.coalesced = 0
+        self.memoized = 0
+
+        self._in_flight: Dict[Hashable, Future] = dict()
+        self._memo: Dict[Hashable, Tuple[float, requests.Response]] = dict()
+        self._lock = threading.Lock()
+
+    def call(
+        self,
+        key: Hashable,
+        send: Callable[[], requests.Response],
+        request: requests.PreparedRequest,
+    ) -> requests.Response:
+        """
+        :param key: Identifies the request - equal keys must be
+            interchangeable requests
+        :type key: Hashable
+        :param send: Sends the request, if it has to be sent
+        :type send: Callable[[], requests.Response]
+        :param request: The request, attached to any copied response
+        :type request: requests.PreparedRequest
+        :return: The request's response
+        :rtype: requests.Response
+        :raises DeadlineExceeded: If the current context's deadline is reached
+            while waiting for an identical request
+        """
+
+        # a caller that waits again (after a leader gives up)
+        # is still only one coalesced request
+        waited = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                memo = self._memo.get(key)
+                if memo is not None and memo[0] > now:
+                    self.memoized += 1
+                    return copy_response(memo[1], request)
+
+                future = self._in_flight.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = Future()
+                    self._in_flight[key] = future
+                    self.sent += 1
+                elif not waited:
+                    self.coalesced += 1
+                    waited = True
+
+            if is_leader:
+                break
+
+            # followers wait no longer than their own deadline allows
+            remaining = get_time_remaining()
+            if not wait(
+                [future], timeout=max(0.0, remaining) if remaining is not None else None
+            ).done:
+                raise DeadlineExceeded(
+                    "Deadline reached waiting for an identical request"
+                )
+
+            response = future.result()
+            # None if the leader gave up on its own account - so retry,
+            # and one of the followers takes its place
+            if response is not None:
+                return copy_response(response, request)
+
+        try:
+            response = send()
+            # read the body now, so it can be shared
+            response.content
+        except BaseException as be:
+            with self._lock:
+                del self._in_flight[key]
+            # the leader's deadline (or cancellation) isn't its followers'
+            if isinstance(be, DeadlineExceeded) or not isinstance(be, Exception):
+                future.set_result(None)
+            else:
+                future.set_exception(be)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            if self.window > 0 and response.ok and not response.is_redirect:
+                now = time.monotonic()
+                self._memo = {
+                    memo_key: memo
+                    for memo_key, memo in self._memo.items()
+                    if memo[0] > now
+                }
+                self._memo[key] = (now + self.window, response)
+
+        future.set_result(response)
+        return response
+
+
+def copy_response(
+    response: requests.Response, request: requests.PreparedRequest
+) -> requests.Response:
+    """
+    :param response: A response whose body has already been read
+    :type response: requests.Response
+    :param request: The request the copy is in response to
+    :type request: requests.PreparedRequest
+    :return: An independent copy of the response
+    :rtype: requests.Response
+    """
+
+    copied = requests.Response()
+    copied.status_code = response.status_code
+    copied.reason = response.reason
+    copied.headers = CaseInsensitiveDict(response.headers)
+    copied.encoding = response.encoding
+    copied.url = response.url
+    copied.cookies = response.cookies.copy()
+    copied.elapsed = datetime.timedelta(0)
+    copied.request = request
+    copied._content = response.content
+    copied._content_consumed = True
+    return copied
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """
+    A requests transport adapter that routes every request through its
+    Transport's per-host concurrency caps and rate limiters,
+    and retries throttled responses after backing off - 429s always,
+    as the host didn't process the request, but 503s only for idempotent
+    methods, as a POST (eg. a JSON-RPC call) may have been acted on.
+
+    Mounting a single instance on several sessions
+    also makes them share one connection pool per host.
+    """
+
+    RETRY_STATUSES = {429, 503}
+    IDEMPOTENT_RETRY_STATUSES = {503}
+    IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"}
+
+    # a request that times out within this many seconds of its deadline
+    # is considered to have run out of time, rather than to have hung
+    DEADLINE_SLACK = 0.1
+
+    def __init__(self, transport: "Transport", **kwargs):
+        super(ScheduledAdapter, self).__init__(**kwargs)
+        self.transport = transport
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        metrics = get_current_metrics()
+        if metrics is not None:
+            metrics.add(http_calls=1)
+
+        key = self.transport.get_dedupe_key(request)
+        if key is None:
+            return self._send(request, **kwargs)
+
+        return self.transport.single_flight.call(
+            key, lambda: self._send(request, **kwargs), request
+        )
+
+    def is_retryable(
+        self, request: requests.PreparedRequest, response: requests.Response
+    ) -> bool:
+        """
+        :return: Whether the response is throttling a request that's safe to resend
+        :rtype: bool
+        """
+
+        if response.status_code not in self.RETRY_STATUSES:
+            return False
+        if response.status_code in self.IDEMPOTENT_RETRY_STATUSES:
+            return (request.method or "GET").upper() in self.IDEMPOTENT_METHODS
+        return True
+
+    def _send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        # rate limits and caps belong to the original host, even if redirected
+        host = urlsplit(request.url).hostname or ""
+        request = self.transport.apply_url_overrides(request)
+        limiter = self.transport.get_rate_limiter(host)
+        metrics = get_current_metrics()
+        deadline_at = _deadline.get()
+        timeout = kwargs.get("timeout")
+
+        with child_span(f"HTTP {request.method}", host=host) as span:
+            attempt = 0
+            while True:
+                waiting_since = time.monotonic()
+                # take a token first, so a request held back by the rate limit
+                # doesn't hold one of the host's slots while it waits
+                limiter.acquire(deadline_at)
+                with self.transport.host_slot(host):
+                    self.record_request(
+                        metrics, request, time.monotonic() - waiting_since
+                    )
+                    kwargs["timeout"] = self.transport.get_timeout(timeout)
+                    try:
+                        response = super(ScheduledAdapter, self).send(request, **kwargs)
+                    except requests.exceptions.Timeout as e:
+                        # the timeout was cut short to fit the deadline
+                        if (
+                            deadline_at is not None
+                            and deadline_at - time.monotonic() < self.DEADLINE_SLACK
+                        ):
+                            raise DeadlineExceeded(
+                                f"Deadline reached waiting for {host}"
+                            ) from e
+                        raise
+
+                if (
+                    not self.is_retryable(request, response)
+                    or attempt >= self.transport.max_retries
+                ):
+                    break
+
+                delay = self.transport.get_retry_after(response)
+                if delay is None:
+                    delay = self.transport.get_backoff_delay(attempt)
+
+                # a retry that can't finish in time isn't worth waiting for
+                if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+                    break
+
+                self.transport.logger.debug(
+                    f"{host} returned {response.status_code}, backing off {delay:.1f}s"
+                )
+                if metrics is not None:
+                    metrics.add(retries=1, backoff_seconds=delay)
+
+                response.close()
+                limiter.pause(delay)
+                attempt += 1
+
+            if response.status_code not in self.RETRY_STATUSES:
+                limiter.succeeded()
+
+            # wait out a used-up quota, rather than finding out with a 429
+            quota_reset = self.transport.get_quota_reset(response)
+            if quota_reset:
+                self.transport.logger.debug(
+                    f"{host}'s rate limit is used up, pausing {quota_reset:.1f}s"
+                )
+                limiter.pause(quota_reset, slow_down=False)
+
+            if metrics is not None and not kwargs.get("stream"):
+                metrics.add(response_bytes=len(response.content))
+            if span is not None:
+                span.attributes.update(
+                    {"http.status_code": response.status_code, "retries": attempt}
+                )
+
+        return response
+
+    @staticmethod
+    def record_request(
+        metrics: Optional[ColumnMetrics],
+        request: requests.PreparedRequest,
+        waited: float,
+    ) -> None:
+        """
+        Attributes a request that's about to be sent to the current column
+
+        :param metrics: The current column's metrics, if it's being instrumented
+        :type metrics: Optional[ColumnMetrics]
+        :param request: The request
+        :type request: requests.PreparedRequest
+        :param waited: How long the request waited for its host's
+            concurrency cap and rate limit, in seconds
+        :type waited: float
+        :rtype: None
+        """
+
+        if metrics is None:
+            return
+
+        body = request.body
+        metrics.add(
+            http_requests=1,
+            request_bytes=len(body) if isinstance(body, (bytes, str)) else 0,
+            wait_seconds=waited,
+        )
+
+
+class Transport:
+    """
+    The HTTP layer shared by all institutions.
+
+    Requests are sent over pooled keep-alive connections,
+    the number of simultaneous requests to any one host is capped,
+    hosts with a declared rate limit are throttled with a token bucket,
+    and throttled responses are retried with adaptive backoff,
+    so institutions never need to sleep to stay under a provider's limits.
+    """
+
+    DEFAULT_HOST_CONCURRENCY = 4
+    DEFAULT_MAX_RETRIES = 5
+    DEFAULT_BACKOFF_BASE = 1.0
+    DEFAULT_BACKOFF_MAX = 60.0
+    DEFAULT_DEDUPE_WINDOW = 5.0
+
+    # seconds to wait for a connection, and then between bytes of a response,
+    # for requests that don't set their own timeout
+    DEFAULT_TIMEOUT = 15.0
+
+    # rate limit reset headers larger than this are a time, not a delay
+    EPOCH_THRESHOLD = 1e9
+
+    # Only requests without side effects are ever coalesced
+    DEDUPE_METHODS = {"GET", "HEAD"}
+
+    # Headers that differ between otherwise-identical requests
+    # (eg. per-request signatures), so are left out of the dedupe key.
+    # Every other header - notably any credentials - is part of the key,
+    # so requests made with different credentials are never coalesced.
+    VOLATILE_HEADERS = {
+        "cb-access-sign",
+        "cb-access-timestamp",
+        "date",
+        "x-request-id",
+    }
+
+    # URL prefixes whose responses don't depend on who's asking,
+    # so they're coalesced even across different credentials
+    DEFAULT_PUBLIC_URLS = [
+        "https://api.pro.coinbase.com/currencies",
+        "https://api.pro.coinbase.com/products",
+    ]
+
+    # Requests per second (and burst size) for the providers we know about.
+    # These can be overridden per host with the "rate_limits" config value.
+    DEFAULT_RATE_LIMITS = {
+        # 10,000 requests per hour, per API key
+        "api.coinbase.com": {"rate": 2.5, "burst": 10},
+        "api.pro.coinbase.com": {"rate": 5, "burst": 10},
+        # the free tier allows 30 calls per minute
+        "api.coingecko.com": {"rate": 0.5, "burst": 5},
+        # quickview calls sent within a few seconds of each other
+        # fail with errorRetrievingBankData
+        "mapi.discovercard.com": {"rate": 0.2, "burst": 1},
+    }
+
+    def __init__(self, logger: Optional[logging.Logger] = None):
+        self.logger = logger or logging.getLogger("balance_sheet_gen.transport")
+        self.session = requests.Session()
+
+        self.host_concurrency: Dict[str, int] = dict()
+        self.default_host_concurrency = self.DEFAULT_HOST_CONCURRENCY
+        self.rate_limits: Dict[str, Dict[str, float]] = dict(self.DEFAULT_RATE_LIMITS)
+        self.max_retries = self.DEFAULT_MAX_RETRIES
+        self.backoff_base = self.DEFAULT_BACKOFF_BASE
+        self.backoff_max = self.DEFAULT_BACKOFF_MAX
+        self.single_flight = SingleFlight(self.DEFAULT_DEDUPE_WINDOW)
+        self.public_urls = list(self.DEFAULT_PUBLIC_URLS)
+        self.url_overrides: Dict[str, str] = dict()
+        self.timeout = self.DEFAULT_TIMEOUT
+
+        self._host_semaphores: Dict[str, threading.BoundedSemaphore] = dict()
+        self._rate_limiters: Dict[str, HostRateLimiter] = dict()
+        self._lock = threading.Lock()
+
+        self.adapter = ScheduledAdapter(self)
+        self.mount(self.session)
+        self.configure()
+
+    def configure(
+        self,
+        host_concurrency: Optional[Dict[str, int]] = None,
+        default_host_concurrency: Optional[int] = None,
+        rate_limits: Optional[Dict[str, Dict[str, float]]] = None,
+        max_retries: Optional[int] = None,
+        backoff_base: Optional[float] = None,
+        backoff_max: Optional[float] = None,
+        dedupe_window: Optional[float] = None,
+        public_urls: Optional[List[str]] = None,
+        url_overrides: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """
+        Applies the top-level "transport" configuration block
+
+        :param host_concurrency: A mapping of hostname to the maximum number
+            of simultaneous requests allowed to that host
+        :type host_concurrency: Optional[Dict[str, int]]
+        :param default_host_concurrency: The limit for hosts not listed above
+        :type default_host_concurrency: Optional[int]
+        :param rate_limits: A mapping of hostname to its token bucket,
+            eg. {"api.coingecko.com": {"rate": 0.5, "burst": 5}}
+        :type rate_limits: Optional[Dict[str, Dict[str, float]]]
+        :param max_retries: How many times to retry a throttled request
+        :type max_retries: Optional[int]
+        :param backoff_base: The first retry's delay, in seconds,
+            if the host didn't send a Retry-After header
+        :type backoff_base: Optional[float]
+        :param backoff_max: The longest delay between retries, in seconds
+        :type backoff_max: Optional[float]
+        :param dedupe_window: How long, in seconds, a response is reused for
+            identical requests - 0 still coalesces requests that are in flight
+            at the same time, but memoizes nothing
+        :type dedupe_window: Optional[float]
+        :param public_urls: Additional URL prefixes whose responses are the same
+            regardless of credentials, so can be shared between columns
+        :type public_urls: Optional[List[str]]
+        :param url_overrides: A mapping of URL prefix to its replacement,
+            eg. to point every institution at a local stand-in server
+        :type url_overrides: Optional[Dict[str, str]]
+        :param timeout: The timeout, in seconds, of requests
+            that don't set their own
+        :type timeout: Optional[float]
+        :rtype: None
+        """
+
+        with self._lock:
+            if host_concurrency is not None:
+                self.host_concurrency = dict(host_concurrency)
+            if default_host_concurrency is not None:
+                self.default_host_concurrency = default_host_concurrency
+            if rate_limits is not None:
+                self.rate_limits.update(rate_limits)
+            if max_retries is not None:
+                self.max_retries = max_retries
+            if backoff_base is not None:
+                self.backoff_base = backoff_base
+            if backoff_max is not None:
+                self.backoff_max = backoff_max
+            if dedupe_window is not None:
+                self.single_flight.window = dedupe_window
+            if public_urls is not None:
+                self.public_urls = self.DEFAULT_PUBLIC_URLS + list(public_urls)
+            if url_overrides is not None:
+                self.url_overrides = dict(url_overrides)
+            if timeout is not None:
+                self.timeout = timeout
+
+            self._host_semaphores.clear()
+            self._rate_limiters.clear()
+
+            # size each host's connection pool to its concurrency cap,
+            # so no request ever waits on (or discards) a pooled connection
+            pool_size = max(
+                [self.default_host_concurrency, *self.host_concurrency.values()]
+            )
+            self.adapter.init_poolmanager(DEFAULT_POOLSIZE, pool_size)
+
+    def mount(self, session: requests.Session) -> requests.Session:
+        """
+        Routes all of a session's requests through this transport,
+        eg. the session owned by a third-party API client.
+        The session keeps its own headers, auth, cookies and hooks.
+
+        :param session: The session to route through this transport
+        :type session: requests.Session
+        :return: The same session
+        :rtype: requests.Session
+        """
+
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        return session
+
+    def new_session(self) -> requests.Session:
+        """
+        :return: A new session, for institutions that need their own
+            headers or cookies, routed through this transport
+        :rtype: requests.Session
+        """
+
+        return self.mount(requests.Session())
+
+    def get_rate_limiter(self, host: str) -> HostRateLimiter:
+        """
+        :param host: A hostname, eg. "api.coingecko.com"
+        :type host: str
+        :return: The host's rate limiter
+        :rtype: HostRateLimiter
+        """
+
+        with self._lock:
+            limiter = self._rate_limiters.get(host)
+            if limiter is None:
+                limit = self.rate_limits.get(host, dict())
+                limiter = HostRateLimiter(limit.get("rate"), limit.get("burst"))
+                self._rate_limiters[host] = limiter
+
+        return limiter
+
+    @contextmanager
+    def host_slot(self, host: str) -> Iterator[None]:
+        """
+        Blocks until a request to the host is allowed to proceed
+
+        :param host: A hostname, eg. "api.coingecko.com"
+        :type host: str
+        """
+
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(
+                    self.host_concurrency.get(host, self.default_host_concurrency)
+                )
+                self._host_semaphores[host] = semaphore
+
+        remaining = get_time_remaining()
+        if not semaphore.acquire(
+            timeout=max(0.0, remaining) if remaining is not None else None
+        ):
+            raise DeadlineExceeded(f"Deadline reached waiting for a slot on {host}")
+
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def get_timeout(
+        self, timeout: Union[None, float, Tuple[float, float]] = None
+    ) -> Union[float, Tuple[float, float]]:
+        """
+        :param timeout: A request's own timeout, if it set one
+        :type timeout: Union[None, float, Tuple[float, float]]
+        :return: The timeout to send the request with -
+            the transport's default if it didn't set one,
+            shortened to fit within the current context's deadline
+        :rtype: Union[float, Tuple[float, float]]
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        remaining = get_time_remaining()
+        if remaining is None:
+            return timeout
+
+        if remaining <= 0:
+            raise DeadlineExceeded("Deadline reached before the request was sent")
+
+        if isinstance(timeout, tuple):
+            return tuple(min(value, remaining) for value in timeout)
+
+        return min(timeout, remaining)
+
+    def apply_url_overrides(
+        self, request: requests.PreparedRequest
+    ) -> requests.PreparedRequest:
+        """
+        :param request: A request about to be sent
+        :type request: requests.PreparedRequest
+        :return: The request, or a copy of it sent to an overridden URL
+        :rtype: requests.PreparedRequest
+        """
+
+        for prefix, replacement in self.url_overrides.items():
+            if request.url.startswith(prefix):
+                request = request.copy()
+                request.url = replacement + request.url[len(prefix) :]
+                break
+
+        return request
+
+    def get_dedupe_key(self, request: requests.PreparedRequest) -> Optional[Hashable]:
+        """
+        :param request: A request about to be sent
+        :type request: requests.PreparedRequest
+        :return: A key that's equal for interchangeable requests -
+            the same method, URL (including its parameters), body and
+            credentials - or None if the request must always be sent
+        :rtype: Optional[Hashable]
+        """
+
+        if request.method not in self.DEDUPE_METHODS:
+            return None
+
+        body = request.body
+        if isinstance(body, str):
+            body = body.encode()
+        elif body is not None and not isinstance(body, bytes):
+            # eg. a streamed upload, which can't be compared
+            return None
+
+        if any(request.url.startswith(prefix) for prefix in self.public_urls):
+            headers = tuple()
+        else:
+            headers = tuple(
+                sorted(
+                    (name.lower(), value)
+                    for name, value in request.headers.items()
+                    if name.lower() not in self.VOLATILE_HEADERS
+                )
+            )
+        return (request.method, request.url, body, headers)
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        :return: How many GET/HEAD requests were sent,
+            coalesced with an identical in-flight request, or served from the memo
+        :rtype: Dict[str, int]
+        """
+
+        return {
+            "sent": self.single_flight.sent,
+            "coalesced": self.single_flight.coalesced,
+            "memoized": self.single_flight.memoized,
+        }
+
+    def get_backoff_delay(self, attempt: int) -> float:
+        """
+        :param attempt: The number of failed attempts so far, starting at 0
+        :type attempt: int
+        :return: An exponential backoff delay (with jitter), in seconds
+        :rtype: float
+        """
+
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+    @staticmethod
+    def get_retry_after(response: requests.Response) -> Optional[float]:
+        """
+        :param response: A throttled response
+        :type response: requests.Response
+        :return: The delay requested by the response's Retry-After header,
+            in seconds, if it has one
+        :rtype: Optional[float]
+        """
+
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is None:
+            return None
+
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+
+        return max(0.0, retry_at.timestamp() - time.time())
+
+    def get_quota_reset(self, response: requests.Response) -> Optional[float]:
+        """
+        :param response: Any response
+        :type response: requests.Response
+        :return: If the response's rate limit headers (eg. X-RateLimit-Remaining)
+            say the host's quota is used up, the number of seconds until it resets,
+            at most backoff_max
+        :rtype: Optional[float]
+        """
+
+        for prefix in ("X-RateLimit-", "RateLimit-"):
+            remaining = response.headers.get(f"{prefix}Remaining")
+            if remaining is None:
+                continue
+
+            try:
+                if float(remaining) > 0:
+                    return None
+                reset = float(response.headers.get(f"{prefix}Reset", 1))
+            except ValueError:
+                return None
+
+            # some hosts send the time it resets at, rather than how long until it does
+            if reset > self.EPOCH_THRESHOLD:
+                reset -= time.time()
+
+            return min(self.backoff_max, max(0.0, reset))
+
+        return None
+
+    def back_off(self, url: str, attempt: int) -> None:
+        """
+        Pauses requests to a URL's host after an error that the host
+        reports in-band (eg. in a 2XX response's JSON),
+        rather than with a 429 status
+
+        :param url: The URL that failed
+        :type url: str
+        :param attempt: The number of failed attempts so far, starting at 0
+        :type attempt: int
+        :rtype: None
+        """
+
+        host = urlsplit(url).hostname or ""
+        delay = self.get_backoff_delay(attempt)
+
+        metrics = get_current_metrics()
+        if metrics is not None:
+            metrics.add(retries=1, backoff_seconds=delay)
+
+        self.get_rate_limiter(host).pause(delay)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request through the shared session
+
+        :param method: The HTTP method, eg. "GET"
+        :type method: str
+        :param url: The URL to request
+        :type url: str
+        :return: The response
+        :rtype: requests.Response
+        """
+
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+_transport = Transport()
+
+
+def get_transport() -> Transport:
+    """
+    :return: The Transport shared by every Institution in this process
+    :rtype: Transport
+    """
+
+    return _transport
@@ -0,0 +1,360 @@
+from decimal import ROUND_HALF_EVEN, Decimal
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from .price_oracle import PriceOracle, get_price_oracle
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+class Holding(NamedTuple):
+    """
+    A quantity of a single asset, in the asset's own units (eg. BTC, not satoshis)
+    """
+
+    # a CoinGecko coin ID, eg. "bitcoin" - or, for fiat, a currency code, eg. "usd"
+    asset: str
+    quantity: Decimal
+    fiat: bool = False
+
+
+def fiat_holding(amount: Union[float, str, Decimal], currency: str = "usd") -> Holding:
+    """
+    :param amount: An amount of fiat currency - floats are converted
+        through their shortest repr, so 0.1 stays 0.1
+    :type amount: Union[float, str, Decimal]
+    :param currency: The currency's code, eg. "usd"
+    :type currency: str
+    :return: The amount, as a Holding
+    :rtype: Holding
+    """
+
+    return Holding(currency.lower(), to_decimal(amount), fiat=True)
+
+
+def to_decimal(value: Union[int, float, str, Decimal]) -> Decimal:
+    if isinstance(value, float):
+        return Decimal(repr(value))
+
+    return Decimal(value)
+
+
+class Valuator:
+    """
+    Values holdings in every reporting currency.
+
+    Institutions report what they hold, rather than what it's worth,
+    and every column in a group is priced in a single pass -
+    an (assets x currencies) matrix of rates is built from the shared
+    PriceOracle's (batched, cached) prices, and each column's quantities
+    are multiplied through it at once.
+    All arithmetic is exact Decimal arithmetic, on NumPy object arrays,
+    and only the final per-currency totals are rounded.
+    Fiat holdings in a currency other than the reporting currency
+    are converted through bitcoin's price in both currencies.
+    Holdings can also be valued as of a past time, for backfills,
+    with the PriceOracle's historical prices.
+    """
+
+    # the coin used to derive fiat cross rates, eg. EUR -> USD
+    BRIDGE_COIN_ID = "bitcoin"
+    CENT = Decimal("0.01")
+
+    def __init__(
+        self,
+        currencies: Iterable[str] = ("usd",),
+        price_oracle: Optional[PriceOracle] = None,
+    ):
+        self.currencies = [currency.lower() for currency in currencies]
+        self.price_oracle = price_oracle or get_price_oracle()
+
+    def configure(self, currencies: Optional[Iterable[str]] = None) -> None:
+        """
+        :param currencies: The currencies to report balances in -
+            the first is the primary currency
+        :type currencies: Optional[Iterable[str]]
+        :rtype: None
+        """
+
+        if currencies is not None:
+            currencies = [currency.lower() for currency in currencies]
+            if not currencies:
+                raise ValueError("At least one reporting currency is required")
+            self.currencies = currencies
+
+    def get_required_prices(self, coin_ids: Iterable[str]) -> Set[Tuple[str, str]]:
+        """
+        :param coin_ids: The coins that will be held
+        :type coin_ids: Iterable[str]
+        :return: Every (coin ID, currency) price needed to value them,
+            including those needed for fiat cross rates
+        :rtype: Set[Tuple[str, str]]
+        """
+
+        required = {
+            (coin_id, currency) for coin_id in coin_ids for currency in self.currencies
+        }
+        # institutions without coins report USD
+        if any(currency != "usd" for currency in self.currencies):
+            required.update(
+                (self.BRIDGE_COIN_ID, currency)
+                for currency in ["usd", *self.currencies]
+            )
+
+        return required
+
+    def get_prices(
+        self, coin_ids: Iterable[str], currency: str, as_of: Optional[float] = None
+    ) -> Dict[str, Decimal]:
+        """
+        :param coin_ids: CoinGecko coin IDs
+        :type coin_ids: Iterable[str]
+        :param currency: The currency to price the coins in
+        :type currency: str
+        :param as_of: If provided, the past time to price the coins at
+        :type as_of: Optional[float]
+        :return: A mapping of coin ID to price
+        :rtype: Dict[str, Decimal]
+        """
+
+        coin_ids = set(coin_ids)
+        if not coin_ids:
+            return dict()
+
+        if as_of is None:
+            prices = self.price_oracle.get_prices(coin_ids, currency)
+        else:
+            prices = self.price_oracle.get_historical_prices(coin_ids, as_of, currency)
+
+        return {coin_id: to_decimal(price) for coin_id, price in prices.items()}
+
+    def get_rates(
+        self, assets: List[Tuple[str, bool]], as_of: Optional[float] = None
+    ) -> "np.ndarray":
+        """
+        :param assets: (asset, fiat) pairs, as in Holding
+        :type assets: List[Tuple[str, bool]]
+        :param as_of: If provided, the past time to get the rates at
+        :type as_of: Optional[float]
+        :return: An (assets x currencies) object array of Decimal rates,
+            the value of one unit of each asset in each reporting currency
+        :rtype: np.ndarray
+        """
+
+        # imported when first needed, so importing the package stays cheap
+        import numpy as np
+
+        coin_ids = {asset for asset, fiat in assets if not fiat}
+        fiat_codes = {asset for asset, fiat in assets if fiat}
+
+        # bitcoin is only needed for fiat that isn't a reporting currency
+        if any(code != currency for code in fiat_codes for currency in self.currencies):
+            coin_ids.add(self.BRIDGE_COIN_ID)
+
+        prices = {
+            currency: self.get_prices(coin_ids, currency, as_of)
+            for currency in self.currencies
+        }
+
+        bridge_prices = dict()
+        for code in fiat_codes - set(self.currencies):
+            bridge_prices[code] = self.get_prices([self.BRIDGE_COIN_ID], code, as_of)[
+                self.BRIDGE_COIN_ID
+            ]
+
+        rates = np.empty((len(assets), len(self.currencies)), dtype=object)
+        for i, (asset, fiat) in enumerate(assets):
+            for j, currency in enumerate(self.currencies):
+                if not fiat:
+                    rates[i, j] = prices[currency][asset]
+                elif asset == currency:
+                    rates[i, j] = Decimal(1)
+                else:
+                    # eg. EUR -> USD = (USD per BTC) / (EUR per BTC)
+                    bridge = prices[currency][self.BRIDGE_COIN_ID]
+                    asset_bridge = (
+                        prices[asset][self.BRIDGE_COIN_ID]
+                        if asset in prices
+                        else bridge_prices[asset]
+                    )
+                    rates[i, j] = bridge / asset_bridge
+
+        return rates
+
+    def value_many(
+        self, holdings: Dict[str, List[Holding]], as_of: Optional[float] = None
+    ) -> Dict[str, Dict[str, Decimal]]:
+        """
+        Values several columns' holdings in a single pass
+
+        :param holdings: A mapping of column name to its holdings
+        :type holdings: Dict[str, List[Holding]]
+        :param as_of: If provided, the past time to value the holdings at
+        :type as_of: Optional[float]
+        :return: A mapping of column name to its value in each reporting currency,
+            rounded to the cent
+        :rtype: Dict[str, Dict[str, Decimal]]
+        """
+
+        import numpy as np
+
+        names = list(holdings)
+        assets = sorted(
+            {
+                (holding.asset, holding.fiat)
+                for column_holdings in holdings.values()
+                for holding in column_holdings
+            }
+        )
+        asset_index = {asset: i for i, asset in enumerate(assets)}
+
+        # (columns x assets) quantities - summed exactly, as Decimals
+        quantities = np.full((len(names), len(assets)), Decimal(0), dtype=object)
+        for i, name in enumerate(names):
+            for holding in holdings[name]:
+                quantities[i, asset_index[(holding.asset, holding.fiat)]] += to_decimal(
+                    holding.quantity
+                )
+
+        if assets:
+            totals = quantities.dot(self.get_rates(assets, as_of))
+        else:
+            totals = np.full(
+                (len(names), len(self.currencies)), Decimal(0), dtype=object
+            )
+
+        return {
+            name: {
+                currency: Decimal(totals[i, j]).quantize(self.CENT, ROUND_HALF_EVEN)
+                for j, currency in enumerate(self.currencies)
+            }
+            for i, name in enumerate(names)
+        }
+
+    def value(
+        self, holdings: List[Holding], as_of: Optional[float] = None
+    ) -> Dict[str, Decimal]:
+        """
+        :param holdings: A single column's holdings
+        :type holdings: List[Holding]
+        :param as_of: If provided, the past time to value the holdings at
+        :type as_of: Optional[float]
+        :return: The holdings' value in each reporting currency, rounded to the cent
+        :rtype: Dict[str, Decimal]
+        """
+
+        return self.value_many({"": holdings}, as_of)[""]
+
+    def value_results(
+        self,
+        results: Dict[str, Union[List[Holding], Exception]],
+        as_of: Optional[float] = None,
+    ) -> Dict[str, Union[Dict[str, Decimal], Exception]]:
+        """
+        Values a group's results, passing along any exceptions.
+        If the group can't be valued together (eg. one column holds a coin
+        without a price), each column is valued on its own,
+        so only the columns at fault fail.
+
+        :param results: A mapping of column name to its holdings,
+            or to the exception raised while fetching them
+        :type results: Dict[str, Union[List[Holding], Exception]]
+        :param as_of: If provided, the past time to value the holdings at
+        :type as_of: Optional[float]
+        :return: A mapping of column name to its value in each reporting currency,
+            or to the exception raised while fetching or valuing it
+        :rtype: Dict[str, Union[Dict[str, Decimal], Exception]]
+        """
+
+        values: Dict[str, Union[Dict[str, Decimal], Exception]] = {
+            name: result
+            for name, result in results.items()
+            if isinstance(result, Exception)
+        }
+        holdings = {
+            name: result
+            for name, result in results.items()
+            if not isinstance(result, Exception)
+        }
+
+        try:
+            values.update(self.value_many(holdings, as_of))
+        except Exception:
+            for name, column_holdings in holdings.items():
+                try:
+                    values[name] = self.value(column_holdings, as_of)
+                except Exception as e:
+                    values[name] = e
+
+        return values
+
+    def value_history(
+        self, results: Dict[str, Union[Dict[float, List[Holding]], Exception]]
+    ) -> Dict[str, Union[Dict[float, Dict[str, Decimal]], Exception]]:
+        """
+        Values a group's historical holdings, one pass per date.
+        A column that can't be valued on any date fails as a whole.
+
+        :param results: A mapping of column name to its holdings at each time,
+            or to the exception raised while fetching them
+        :type results: Dict[str, Union[Dict[float, List[Holding]], Exception]]
+        :return: A mapping of column name to its value in each reporting currency
+            at each time, or to the exception raised while fetching or valuing it
+        :rtype: Dict[str, Union[Dict[float, Dict[str, Decimal]], Exception]]
+        """
+
+        values: Dict[str, Union[Dict[float, Dict[str, Decimal]], Exception]] = {
+            name: result
+            for name, result in results.items()
+            if isinstance(result, Exception)
+        }
+        histories = {
+            name: result
+            for name, result in results.items()
+            if not isinstance(result, Exception)
+        }
+        valued_histories: Dict[str, Dict[float, Dict[str, Decimal]]] = dict()
+
+        for timestamp in sorted(
+            {timestamp for history in histories.values() for timestamp in history}
+        ):
+            valued = self.value_results(
+                {
+                    name: history[timestamp]
+                    for name, history in histories.items()
+                    if timestamp in history and name not in values
+                },
+                as_of=timestamp,
+            )
+            for name, value in valued.items():
+                if isinstance(value, Exception):
+                    values[name] = value
+                else:
+                    valued_histories.setdefault(name, dict())[timestamp] = value
+
+        for name in histories:
+            values.setdefault(name, valued_histories.get(name, dict()))
+
+        return values
+
+
+_valuator = Valuator()
+
+
+def get_valuator() -> Valuator:
+    """
+    :return: The Valuator shared by every Institution in this process
+    :rtype: Valuator
+    """
+
+    return _valuator
@@ -0,0 +1,395 @@
+import asyncio
+import logging
+import multiprocessing
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Set, Union
+
+from institutions.address_state import get_address_state_cache
+from institutions.institution import Institution
+from institutions.instrumentation import (
+    ColumnMetrics,
+    child_span,
+    collect_metrics,
+    get_current_metrics,
+)
+from institutions.session_cache import get_session_cache
+from institutions.transport import deadline, get_transport
+from institutions.valuation import Holding
+
+logger = logging.getLogger("balance_sheet_gen.isolation")
+
+
+class WorkerError(Exception):
+    """
+    An exception raised in a worker process, sent back as its type's name
+    and message - the original may not survive pickling
+    """
+
+    def __init__(self, type_name: str, message: str):
+        self.type_name = type_name
+        super().__init__(f"{type_name}: {message}")
+
+
+class IsolationPool:
+    """
+    Fetches the holdings of selected institution types in a pool of
+    worker processes, rather than on the engine's threads.
+
+    Connectors that parse heavily in Python (eg. OFX's XML) no longer
+    contend with every other column for the GIL, and one that hangs
+    in C code or leaks memory only takes its own worker down with it.
+    Each worker constructs the group's Institution itself, from its
+    configuration, and sends back a compact message - every holding
+    as an (asset, quantity, fiat) triple, with exact decimal strings,
+    any exceptions as their type's name and message, and the group's
+    phase timings and HTTP counters. Valuation stays in the run's process,
+    so prices are still fetched once.
+
+    Workers can be given an address space limit, and are replaced after
+    a number of tasks, so slow leaks never build up.
+    If a worker dies (eg. by exceeding its memory limit), the pool is
+    replaced and each group that was in flight is retried once,
+    so only a group that kills its worker twice fails.
+    """
+
+    DEFAULT_WORKERS = 2
+
+    def __init__(
+        self,
+        types: Iterable[str],
+        workers: int = DEFAULT_WORKERS,
+        max_tasks_per_worker: Optional[int] = None,
+        memory_limit_mb: Optional[int] = None,
+        worker_config: Optional[Dict[str, Dict]] = None,
+        log_level: Union[int, str] = logging.WARNING,
+    ):
+        """
+        :param types: The institution types to fetch in worker processes,
+            eg. ["OfxInstitution"]
+        :type types: Iterable[str]
+        :param workers: The number of worker processes
+        :type workers: int
+        :param max_tasks_per_worker: If provided, the number of groups each
+            worker fetches before it's replaced (requires Python 3.11)
+        :type max_tasks_per_worker: Optional[int]
+        :param memory_limit_mb: If provided, each worker's address space limit,
+            in MiB - allocations beyond it raise MemoryError (Unix only)
+        :type memory_limit_mb: Optional[int]
+        :param worker_config: The top-level "transport", "session_cache"
+            and "address_state" configuration blocks, by name,
+            applied to each worker's shared services
+        :type worker_config: Optional[Dict[str, Dict]]
+        :param log_level: The workers' logging level
+        :type log_level: Union[int, str]
+        """
+
+        if workers < 1:
+            raise ValueError(f"Workers must be at least 1, got {workers}")
+        if max_tasks_per_worker is not None and max_tasks_per_worker < 1:
+            raise ValueError(
+                f"Max tasks per worker must be at least 1, got {max_tasks_per_worker}"
+            )
+
+        self.types = set(types)
+        self.workers = workers
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.memory_limit_mb = memory_limit_mb
+        self.worker_config = worker_config or dict()
+        self.log_level = log_level
+
+        if max_tasks_per_worker is not None and sys.version_info < (3, 11):
+            logger.warning("Recycling workers requires Python 3.11 - ignoring it")
+            self.max_tasks_per_worker = None
+
+        # created when the first isolated group is fetched
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._in_flight: Set[Future] = set()
+
+    def __enter__(self) -> "IsolationPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+    def isolates(self, type_name: str) -> bool:
+        """
+        :param type_name: A column's (resolved) type
+        :type type_name: str
+        :return: Whether the type's columns are fetched in worker processes
+        :rtype: bool
+        """
+
+        return type_name in self.types
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            kwargs = dict()
+            if self.max_tasks_per_worker is not None:
+                kwargs["max_tasks_per_child"] = self.max_tasks_per_worker
+
+            # workers are spawned, not forked, as the run already has threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(self.worker_config, self.log_level, self.memory_limit_mb),
+                **kwargs,
+            )
+
+        return self._executor
+
+    async def fetch_group(
+        self,
+        group: List[Dict],
+        as_of: Optional[List[float]] = None,
+        budget: Optional[float] = None,
+    ) -> Dict[str, Union[List[Holding], Dict[float, List[Holding]], Exception]]:
+        """
+        Fetches a group's holdings (or, given as_of, historical holdings)
+        in a worker process, adding the worker's metrics to the current column's
+
+        :param group: The configurations of the group's columns
+        :type group: List[Dict]
+        :param as_of: If provided, the times to fetch historical holdings at
+        :type as_of: Optional[List[float]]
+        :param budget: If provided, how long, in seconds, the worker may take
+        :type budget: Optional[float]
+        :return: A mapping of column name to its holdings (or holdings at
+            each time), or to the exception raised while fetching them
+        :rtype: Dict[str, Union[List[Holding], Dict[float, List[Holding]], Exception]]
+        :raises WorkerError: If the group's Institution couldn't be initialized
+        :raises TimeoutError: If the group's Institution timed out initializing
+        """
+
+        with child_span("worker"):
+            try:
+                message = await self._submit(group, as_of, budget)
+            except BrokenProcessPool:
+                logger.warning(
+                    f"A worker died fetching {group[0]['type']}, retrying on a new pool"
+                )
+                try:
+                    message = await self._submit(group, as_of, budget)
+                except BrokenProcessPool:
+                    return {
+                        column["name"]: WorkerError(
+                            "BrokenProcessPool", "The worker fetching it died"
+                        )
+                        for column in group
+                    }
+
+        metrics = get_current_metrics()
+        if metrics is not None:
+            for phase, seconds in message["phases"].items():
+                metrics.add_phase(phase, seconds)
+            metrics.add(**message["counters"])
+
+        if "init_error" in message:
+            raise decode_error(message["init_error"])
+
+        return {
+            name: decode_result(result, as_of is not None)
+            for name, result in message["results"].items()
+        }
+
+    async def _submit(
+        self, group: List[Dict], as_of: Optional[List[float]], budget: Optional[float]
+    ) -> Dict:
+        executor = self.get_executor()
+        try:
+            future = executor.submit(run_group, group, as_of, budget)
+        except BrokenProcessPool:
+            self._replace(executor)
+            raise
+
+        self._in_flight.add(future)
+        try:
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            self._replace(executor)
+            raise
+        finally:
+            if future.done():
+                self._in_flight.discard(future)
+
+    def _replace(self, executor: ProcessPoolExecutor) -> None:
+        # only the first group to notice a broken pool replaces it
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        """
+        Stops every worker - including any still working on a group
+        that was given up on, eg. one hung in C code
+
+        :rtype: None
+        """
+
+        if self._executor is None:
+            return
+
+        executor, self._executor = self._executor, None
+        hung = [future for future in self._in_flight if not future.done()]
+        for future in hung:
+            future.cancel()
+
+        if hung:
+            logger.warning(
+                f"Terminating workers still running {len(hung)} abandoned group(s)"
+            )
+            # ProcessPoolExecutor has no public way to stop a running worker
+            for process in list((getattr(executor, "_processes", None) or {}).values()):
+                process.terminate()
+
+        executor.shutdown(wait=not hung)
+
+
+def init_worker(
+    worker_config: Dict[str, Dict],
+    log_level: Union[int, str],
+    memory_limit_mb: Optional[int],
+) -> None:
+    """
+    Prepares a worker process - called once, as it starts
+
+    :rtype: None
+    """
+
+    logging.basicConfig(level=log_level)
+    get_transport().configure(**worker_config.get("transport", dict()))
+    get_session_cache().configure(**worker_config.get("session_cache", dict()))
+    get_address_state_cache().configure(**worker_config.get("address_state", dict()))
+
+    if memory_limit_mb is None:
+        return
+
+    try:
+        import resource
+    except ImportError:
+        logger.warning("Worker memory limits are only supported on Unix - ignoring it")
+        return
+
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+    limit = memory_limit_mb * 1024 * 1024
+    if hard_limit != resource.RLIM_INFINITY:
+        limit = min(limit, hard_limit)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard_limit))
+
+
+def run_group(
+    group: List[Dict], as_of: Optional[List[float]], budget: Optional[float]
+) -> Dict:
+    """
+    Fetches a group's holdings - in a worker process
+
+    :return: The group's results, timings and counters, as a compact message
+    :rtype: Dict
+    """
+
+    column_logger = logging.getLogger("balance_sheet_gen").getChild(group[0]["name"])
+    metrics = ColumnMetrics(group[0]["name"], group[0]["type"])
+    message: Dict = {"phases": metrics.phases, "counters": metrics.counters}
+
+    with collect_metrics(metrics), deadline(budget):
+        started = time.monotonic()
+        try:
+            institution = Institution(
+                type_name=group[0]["type"],
+                name=group[0]["name"],
+                config=group[0],
+                logger=column_logger,
+                transport=get_transport(),
+            )
+        except Exception as be:
+            message["init_error"] = encode_error(be)
+            return message
+        finally:
+            metrics.add_phase("init", time.monotonic() - started)
+
+        started = time.monotonic()
+        try:
+            if as_of is not None:
+                results = fetch_history(institution, group, as_of)
+            elif len(group) == 1:
+                results = {
+                    group[0]["name"]: asyncio.run(institution.get_holdings_async())
+                }
+            else:
+                results = asyncio.run(institution.get_holdings_many_async(group))
+        except Exception as be:
+            results = {column["name"]: be for column in group}
+        finally:
+            metrics.add_phase("get_balance", time.monotonic() - started)
+
+    message["results"] = {
+        name: encode_result(result, as_of is not None)
+        for name, result in results.items()
+    }
+    return message
+
+
+def fetch_history(
+    institution: Institution, group: List[Dict], as_of: List[float]
+) -> Dict[str, Union[Dict[float, List[Holding]], Exception]]:
+    if len(group) == 1:
+        return {group[0]["name"]: institution.get_historical_holdings(as_of)}
+
+    return institution.get_historical_holdings_many(group, as_of)
+
+
+def encode_result(result, history: bool):
+    if isinstance(result, Exception):
+        return {"error": encode_error(result)}
+    if history:
+        return {
+            "history": [
+                [timestamp, encode_holdings(holdings)]
+                for timestamp, holdings in result.items()
+            ]
+        }
+    return {"holdings": encode_holdings(result)}
+
+
+def decode_result(result: Dict, history: bool):
+    if "error" in result:
+        return decode_error(result["error"])
+    if history:
+        return {
+            timestamp: decode_holdings(holdings)
+            for timestamp, holdings in result["history"]
+        }
+    return decode_holdings(result["holdings"])
+
+
+def encode_holdings(holdings: List[Holding]) -> List[List]:
+    # Decimals as strings, so quantities arrive exactly as they left
+    return [
+        [holding.asset, str(holding.quantity), holding.fiat] for holding in holdings
+    ]
+
+
+def decode_holdings(holdings: List[List]) -> List[Holding]:
+    return [
+        Holding(asset, Decimal(quantity), fiat) for asset, quantity, fiat in holdings
+    ]
+
+
+def encode_error(exception: Exception) -> List:
+    return [
+        type(exception).__name__,
+        str(exception),
+        isinstance(exception, TimeoutError),
+    ]
+
+
+def decode_error(error: List) -> Exception:
+    type_name, message, timed_out = error
+    # timeouts stay TimeoutErrors, so the column's reported as stale
+    if timed_out:
+        return TimeoutError(message)
+    return WorkerError(type_name, message)
@@ -0,0 +1,42 @@
+from typing import NamedTuple, Tuple
+
+
+class BalanceRecord(NamedTuple):
+    """
+    A single column's balance, as of a point in time
+    """
+
+    column_name: str
+    balance: float
+    # seconds since the epoch
+    timestamp: float
+    # whether this is a previously fetched balance, served because
+    # the column couldn't be fetched in time
+    stale: bool = False
+    # the reporting currency the balance is in, eg. "usd"
+    currency: str = "usd"
+    # whether this balance was reconstructed for a past time by a backfill,
+    # in which case its timestamp is that time, rather than when it was fetched
+    backfilled: bool = False
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        """
+        :return: The (column name, currency) pair identifying this balance
+        :rtype: Tuple[str, str]
+        """
+
+        return self.column_name, self.currency
+
+    @property
+    def label(self) -> str:
+        """
+        :return: The column's name, followed by the balance's currency
+            unless it's USD (eg. "Savings (EUR)") - for sinks with one field per balance
+        :rtype: str
+        """
+
+        if self.currency == "usd":
+            return self.column_name
+
+        return f"{self.column_name} ({self.currency.upper()})"
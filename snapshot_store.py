@@ -0,0 +1,253 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from records import BalanceRecord
+
+
+class SnapshotStore:
+    """
+    An append-only SQLite history of every column's balance.
+
+    Each successful fetch is recorded with its timestamp (and currency),
+    so columns that change rarely can be served from their latest snapshot
+    rather than re-fetched on every run.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            column_name TEXT NOT NULL,
+            balance REAL NOT NULL,
+            timestamp REAL NOT NULL,
+            currency TEXT NOT NULL DEFAULT 'usd'
+        );
+        CREATE INDEX IF NOT EXISTS snapshots_by_column
+            ON snapshots (column_name, timestamp);
+    """
+
+    # stores created before balances had a currency were all in USD
+    MIGRATIONS = {
+        "currency": "ALTER TABLE snapshots ADD COLUMN currency TEXT NOT NULL DEFAULT 'usd'",
+    }
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript(self.SCHEMA)
+
+            columns = {
+                row[1]
+                for row in self._conn.execute("PRAGMA table_info(snapshots)").fetchall()
+            }
+            for column, migration in self.MIGRATIONS.items():
+                if column not in columns:
+                    self._conn.execute(migration)
+
+    def record(
+        self,
+        column_name: str,
+        balance: float,
+        timestamp: Optional[float] = None,
+        currency: str = "usd",
+    ):
+        """
+        :param column_name: The column's name
+        :type column_name: str
+        :param balance: The column's balance
+        :type balance: float
+        :param timestamp: When the balance was fetched, in seconds since the epoch -
+            defaults to now
+        :type timestamp: Optional[float]
+        :param currency: The currency the balance is in
+        :type currency: str
+        :rtype: None
+        """
+
+        self.record_many(
+            [
+                BalanceRecord(
+                    column_name, balance, timestamp or time.time(), currency=currency
+                )
+            ]
+        )
+
+    def record_many(self, records: Iterable[BalanceRecord]) -> None:
+        """
+        Appends many snapshots in a single transaction
+
+        :param records: The balances to store
+        :type records: Iterable[BalanceRecord]
+        :rtype: None
+        """
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO snapshots (column_name, balance, timestamp, currency) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (
+                        record.column_name,
+                        record.balance,
+                        record.timestamp,
+                        record.currency,
+                    )
+                    for record in records
+                ),
+            )
+
+    def latest(
+        self, column_names: Iterable[str], currency: str = "usd"
+    ) -> Dict[str, BalanceRecord]:
+        """
+        :param column_names: The columns to look up
+        :type column_names: Iterable[str]
+        :param currency: The currency of the snapshots to look up
+        :type currency: str
+        :return: A mapping of column name to its most recent snapshot,
+            for every column that has one
+        :rtype: Dict[str, BalanceRecord]
+        """
+
+        latest = dict()
+        with self._lock:
+            for column_name in column_names:
+                row = self._conn.execute(
+                    "SELECT column_name, balance, timestamp FROM snapshots "
+                    "WHERE column_name = ? AND currency = ? "
+                    "ORDER BY timestamp DESC LIMIT 1",
+                    (column_name, currency),
+                ).fetchone()
+                if row is not None:
+                    latest[column_name] = BalanceRecord(*row, currency=currency)
+
+        return latest
+
+    def latest_in(
+        self, column_names: Iterable[str], currencies: Iterable[str]
+    ) -> Dict[Tuple[str, str], BalanceRecord]:
+        """
+        :param column_names: The columns to look up
+        :type column_names: Iterable[str]
+        :param currencies: The currencies to look up each column's snapshots in
+        :type currencies: Iterable[str]
+        :return: A mapping of (column name, currency) to its most recent snapshot,
+            for every pair that has one
+        :rtype: Dict[Tuple[str, str], BalanceRecord]
+        """
+
+        column_names = list(column_names)
+        return {
+            record.key: record
+            for currency in currencies
+            for record in self.latest(column_names, currency).values()
+        }
+
+    def get_fresh(
+        self,
+        columns: List[Dict],
+        default_max_age: Optional[float],
+        currency: str = "usd",
+    ) -> Dict[str, BalanceRecord]:
+        """
+        Finds the columns that don't need to be re-fetched -
+        those whose latest snapshot is younger than their staleness limit.
+        A column's limit is its "max_age" config value, in seconds,
+        falling back to default_max_age.
+
+        :param columns: The "columns" list from the configuration file
+        :type columns: List[Dict]
+        :param default_max_age: The limit for columns without a "max_age" -
+            if None, those columns are always considered stale
+        :type default_max_age: Optional[float]
+        :param currency: The currency of the snapshots to consider
+        :type currency: str
+        :return: A mapping of column name to its latest snapshot,
+            for every column that's still fresh
+        :rtype: Dict[str, BalanceRecord]
+        """
+
+        now = time.time()
+        latest = self.latest((column["name"] for column in columns), currency)
+
+        fresh = dict()
+        for column in columns:
+            max_age = column.get("max_age", default_max_age)
+            snapshot = latest.get(column["name"])
+            if (
+                max_age is not None
+                and snapshot is not None
+                and now - snapshot.timestamp <= max_age
+            ):
+                fresh[column["name"]] = snapshot
+
+        return fresh
+
+    def history(
+        self,
+        column_name: str,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        currency: str = "usd",
+    ) -> List[BalanceRecord]:
+        """
+        :param column_name: The column to look up
+        :type column_name: str
+        :param since: If provided, only return snapshots at or after this time
+        :type since: Optional[float]
+        :param until: If provided, only return snapshots at or before this time
+        :type until: Optional[float]
+        :param currency: The currency of the snapshots to return
+        :type currency: str
+        :return: The column's snapshots, oldest first
+        :rtype: List[BalanceRecord]
+        """
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT column_name, balance, timestamp FROM snapshots "
+                "WHERE column_name = ? AND currency = ? "
+                "AND timestamp >= ? AND timestamp <= ? "
+                "ORDER BY timestamp",
+                (
+                    column_name,
+                    currency,
+                    since if since is not None else float("-inf"),
+                    until if until is not None else float("inf"),
+                ),
+            ).fetchall()
+
+        return [BalanceRecord(*row, currency=currency) for row in rows]
+
+    def rows_after(self, rowid: int) -> Tuple[int, List[Tuple[str, float, float, str]]]:
+        """
+        Reads the snapshots appended since a previous read, eg. to keep a copy in sync
+
+        :param rowid: The last rowid previously read - 0 to read every snapshot
+        :type rowid: int
+        :return: The last rowid in the store (lower than rowid if the store
+            has been recreated since), and the (column name, balance, timestamp,
+            currency) of every snapshot after rowid, in the order they were appended
+        :rtype: Tuple[int, List[Tuple[str, float, float, str]]]
+        """
+
+        with self._lock:
+            last_rowid = self._conn.execute(
+                "SELECT COALESCE(MAX(rowid), 0) FROM snapshots"
+            ).fetchone()[0]
+            rows = self._conn.execute(
+                "SELECT column_name, balance, timestamp, currency FROM snapshots "
+                "WHERE rowid > ? AND rowid <= ? ORDER BY rowid",
+                (rowid, last_rowid),
+            ).fetchall()
+
+        return last_rowid, rows
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()